@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+#
+#  aggregate.py
+#  pyobserver
+#
+#  Created by Alexander Rudy on 2014-06-19.
+#  Copyright 2014 Alexander Rudy. All rights reserved.
+#
+"""
+:mod:`fits.aggregate` – Group aggregates
+========================================
+
+Nightly reports need more than the number of files in each group: the total exposure time, the first and last ``DATE-OBS``, and so on. :class:`Aggregates` computes these while headers are grouped, so that each header is only examined once, and nothing but a small running state is kept for each group.
+
+Aggregates are given as a mapping of expressions to operations, or as a list of ``EXPRESSION=operation[,operation]`` strings on the command line::
+
+    {"EXPTIME" : "sum", "DATE-OBS" : ("min", "max"), "ITIME*COADDS" : "sum"}
+    EXPTIME=sum DATE-OBS=min,max ITIME*COADDS=sum
+
+An expression is a header keyword, or the product of several keywords separated by ``*``. The operations are listed in :data:`OPERATIONS`. Headers which are missing a keyword in the expression are skipped, as are values which aren't numbers for the ``sum`` and ``mean`` operations.
+
+.. autoclass:: Aggregates
+    :members:
+
+.. autodata:: OPERATIONS
+
+"""
+from __future__ import (absolute_import, unicode_literals, division,
+                        print_function)
+
+import collections
+import numbers
+import operator
+
+import six
+
+try:
+    import astropy.io.fits as pf
+except ImportError as e:
+    try:
+        import pyfits as pf
+    except ImportError:
+        raise e
+
+OPERATIONS = collections.OrderedDict([
+    ('sum', operator.add),
+    ('mean', operator.add),
+    ('count', lambda value, other : value),
+    ('min', min),
+    ('max', max),
+])
+"""The aggregate operations, and the function which combines two running values for each."""
+
+NUMERIC = set(['sum', 'mean'])
+"""Operations which only apply to numbers."""
+
+def _number(value):
+    """Whether `value` is a number which can be summed."""
+    return isinstance(value, numbers.Number) and not isinstance(value, bool)
+
+class Aggregates(object):
+    """A set of aggregate columns, computed incrementally for each group.
+
+    :param aggregates: A mapping of expressions to an operation or a tuple of operations, or a list of ``(expression, operation)`` pairs.
+
+    The running state for a group is a list with a ``[count, value]`` pair for each column. A new state is made with :meth:`start`, headers are added with :meth:`add`, and states from separate collections of headers (e.g. from separate processes) are combined with :meth:`combine`. States are plain lists, so they can be pickled along with their group.
+    """
+
+    def __init__(self, aggregates):
+        super(Aggregates, self).__init__()
+        if isinstance(aggregates, collections.Mapping):
+            aggregates = aggregates.items()
+        self._columns = []
+        for expression, operations in aggregates:
+            if isinstance(operations, six.string_types):
+                operations = [operations]
+            for operation in operations:
+                operation = operation.strip().lower()
+                if operation not in OPERATIONS:
+                    raise ValueError("Unknown aggregate '{}' for '{}', expected one of {}".format(operation, expression, ", ".join(OPERATIONS)))
+                keywords = tuple(keyword.strip().upper() for keyword in expression.split("*"))
+                self._columns.append((keywords, operation))
+
+    def __repr__(self):
+        """Representation of this object."""
+        return "<{:s} {:s}>".format(self.__class__.__name__, ", ".join(self.names))
+
+    def __len__(self):
+        """The number of aggregate columns."""
+        return len(self._columns)
+
+    def __eq__(self, other):
+        """Aggregates are equal if they compute the same columns."""
+        return isinstance(other, Aggregates) and self._columns == other._columns
+
+    def __ne__(self, other):
+        return not self == other
+
+    @classmethod
+    def parse(cls, arguments):
+        """Parse a list of ``EXPRESSION=operation[,operation]`` strings, as given on the command line.
+
+        :param arguments: The list of strings.
+        :return: A new :class:`Aggregates` object.
+
+        """
+        aggregates = []
+        for argument in arguments:
+            expression, sep, operations = argument.rpartition("=")
+            if not sep or not expression.strip():
+                raise ValueError("Can't parse aggregate '{}', expected EXPRESSION=operation".format(argument))
+            aggregates += [ (expression.strip(), operation) for operation in operations.split(",") ]
+        return cls(aggregates)
+
+    @property
+    def names(self):
+        """The list of column names, like ``sum(EXPTIME)``."""
+        return [ "{}({})".format(operation, "*".join(keywords)) for keywords, operation in self._columns ]
+
+    @property
+    def keywords(self):
+        """The list of header keywords used by these aggregates."""
+        keywords = []
+        for _keywords, operation in self._columns:
+            keywords += [ keyword for keyword in _keywords if keyword not in keywords ]
+        return keywords
+
+    def start(self):
+        """Start a new, empty running state."""
+        return [ [0, None] for column in self._columns ]
+
+    def _value(self, header, keywords, operation):
+        """The value of an expression for `header`, or ``None`` if it should be skipped."""
+        values = []
+        for keyword in keywords:
+            value = header.get(keyword, None)
+            if value is None or isinstance(value, pf.card.Undefined):
+                return None
+            values.append(value)
+        if len(values) == 1 and operation not in NUMERIC:
+            return values[0]
+        if not all(_number(value) for value in values):
+            return None
+        product = values[0]
+        for value in values[1:]:
+            product *= value
+        return product
+
+    def add(self, state, header):
+        """Add a single `header` to a running `state`."""
+        for column, (keywords, operation) in zip(state, self._columns):
+            value = self._value(header, keywords, operation)
+            if value is None:
+                continue
+            if column[0]:
+                column[1] = OPERATIONS[operation](column[1], value)
+            else:
+                column[1] = value
+            column[0] += 1
+        return state
+
+    def extend(self, state, headers):
+        """Add each header from `headers` to a running `state`."""
+        for header in headers:
+            self.add(state, header)
+        return state
+
+    def combine(self, state, other):
+        """Combine the running state `other` into `state`."""
+        for column, ocolumn, (keywords, operation) in zip(state, other, self._columns):
+            if not ocolumn[0]:
+                continue
+            if column[0]:
+                column[1] = OPERATIONS[operation](column[1], ocolumn[1])
+            else:
+                column[1] = ocolumn[1]
+            column[0] += ocolumn[0]
+        return state
+
+    def result(self, state):
+        """The aggregate values for a running `state`.
+
+        :return: An ordered dictionary mapping column names to values. Columns with no values are ``None``, except for ``count``, which is zero.
+
+        """
+        values = []
+        for (count, value), (keywords, operation) in zip(state, self._columns):
+            if operation == 'count':
+                value = count
+            elif count and operation == 'mean':
+                value = value / count
+            values.append(value)
+        return collections.OrderedDict(zip(self.names, values))
+
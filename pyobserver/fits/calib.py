@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+#
+#  calib.py
+#  pyobserver
+#
+#  Created by Alexander Rudy on 2014-06-23.
+#  Copyright 2014 Alexander Rudy. All rights reserved.
+#
+"""
+:mod:`fits.calib` – Calibration association
+===========================================
+
+Each science frame is usually reduced with the darks or flats which were taken closest in time, with the same instrument configuration (e.g. the same ``EXPTIME``, ``FILTER`` and readout mode). A :class:`CalibrationIndex` keeps a sorted array of observation times for each configuration of calibration frames, so that the nearest calibrations to a science frame are found by binary search, rather than by comparing every science frame to every calibration frame.
+
+Observation times are read from ``DATE-OBS`` by default. When the date and time of day are kept in separate keywords (e.g. ``DATE-OBS`` and ``UTC``), give both keywords, and they are joined as ``DATE-OBSTUTC``.
+
+.. autoclass:: CalibrationIndex
+    :members:
+
+"""
+from __future__ import (absolute_import, unicode_literals, division,
+                        print_function)
+
+import collections
+
+import numpy as np
+import six
+
+try:
+    import astropy.io.fits as pf
+except ImportError as e:
+    try:
+        import pyfits as pf
+    except ImportError:
+        raise e
+
+def _seconds(timestamps):
+    """Convert a list of ISO timestamps to an array of seconds since the epoch. Timestamps which can't be read are ``nan``."""
+    try:
+        return np.array(timestamps, dtype="datetime64[ms]").astype(np.int64) / 1e3
+    except ValueError:
+        pass
+    seconds = np.empty(len(timestamps), dtype=float)
+    for i, timestamp in enumerate(timestamps):
+        try:
+            seconds[i] = np.datetime64(timestamp, "ms").astype(np.int64) / 1e3
+        except ValueError:
+            seconds[i] = np.nan
+    return seconds
+
+class CalibrationIndex(object):
+    """An index of calibration frames, by configuration and observation time.
+
+    :param keywords: The header keywords which must match between a science frame and its calibrations, e.g. ``["EXPTIME", "FILTER"]``.
+    :param time: The header keyword with the observation time, or a pair of keywords with the date and the time of day.
+
+    Calibrations are added with :meth:`add` or :meth:`update`. The times for each configuration are sorted the first time the configuration is searched after new calibrations have been added.
+    """
+
+    def __init__(self, keywords, time="DATE-OBS"):
+        super(CalibrationIndex, self).__init__()
+        self._keywords = list(keywords)
+        self._time = [time] if isinstance(time, six.string_types) else list(time)
+        self._pending = collections.defaultdict(list)
+        self._configurations = {}
+
+    def __repr__(self):
+        """Representation of this object."""
+        return "<{:s} {:d} calibrations in {:d} configurations>".format(self.__class__.__name__, len(self), len(self.configurations))
+
+    def __len__(self):
+        """The number of calibration frames."""
+        return sum(len(headers) for headers in self._pending.values()) + sum(len(headers) for times, headers in self._configurations.values())
+
+    @property
+    def keywords(self):
+        """The keywords which must match."""
+        return self._keywords
+
+    @property
+    def configurations(self):
+        """The set of configurations (tuples of the values of :attr:`keywords`) with at least one calibration."""
+        return set(self._pending) | set(self._configurations)
+
+    def key(self, header):
+        """The configuration of `header`, or ``None`` if it is missing one of :attr:`keywords`."""
+        values = []
+        for keyword in self._keywords:
+            value = header.get(keyword, None)
+            if value is None or isinstance(value, pf.card.Undefined):
+                return None
+            values.append(value)
+        return tuple(values)
+
+    def timestamp(self, header):
+        """The observation time of `header` as an ISO timestamp string, or ``None`` if it is missing."""
+        values = [ header.get(keyword, None) for keyword in self._time ]
+        if values[0] is None or isinstance(values[0], pf.card.Undefined):
+            return None
+        timestamp = six.text_type(values[0]).strip()
+        if len(values) > 1 and "T" not in timestamp and values[1] is not None:
+            timestamp += "T" + six.text_type(values[1]).strip()
+        return timestamp
+
+    def add(self, header):
+        """Add a single calibration frame.
+
+        :return: Whether the frame was added. Frames without a configuration or an observation time are skipped.
+        """
+        key, timestamp = self.key(header), self.timestamp(header)
+        if key is None or timestamp is None:
+            return False
+        self._pending[key].append((timestamp, header))
+        return True
+
+    def update(self, headers):
+        """Add each header from `headers`.
+
+        :return: The number of frames which were added.
+        """
+        return sum(self.add(header) for header in headers)
+
+    def _configuration(self, key):
+        """The sorted times and the headers for the configuration `key`, including any pending calibrations."""
+        pending = self._pending.pop(key, None)
+        times, headers = self._configurations.get(key, (np.zeros(0, dtype=float), []))
+        if pending:
+            times = np.concatenate((times, _seconds([ timestamp for timestamp, header in pending ])))
+            headers = headers + [ header for timestamp, header in pending ]
+            keep = np.flatnonzero(np.isfinite(times))
+            order = keep[np.argsort(times[keep], kind='mergesort')]
+            times, headers = times[order], [ headers[row] for row in order ]
+            self._configurations[key] = (times, headers)
+        return times, headers
+
+    def nearest(self, header, n=1, within=None):
+        """Find the calibrations nearest in time to a single frame.
+
+        :param header: The science frame header.
+        :param int n: The number of calibrations to find.
+        :param float within: The largest time difference allowed, in seconds.
+        :return: A list of up to `n` pairs of a calibration header and its time offset from `header` in seconds, from the nearest.
+
+        """
+        key, timestamp = self.key(header), self.timestamp(header)
+        if key is None or timestamp is None:
+            return []
+        times, headers = self._configuration(key)
+        time = _seconds([timestamp])[0]
+        if not np.isfinite(time):
+            return []
+        return [ (headers[row], offset) for row, offset in _nearest(times, time, np.searchsorted(times, time), n, within) ]
+
+    def associate(self, headers, n=1, within=None):
+        """Find the nearest calibrations for many frames.
+
+        :param headers: An iterable of science frame headers.
+        :param int n: The number of calibrations to find for each frame.
+        :param float within: The largest time difference allowed, in seconds.
+        :return: A list of ``(header, matches)`` pairs, in the same order as `headers`, where `matches` is a list like that from :meth:`nearest`.
+
+        Frames are grouped by configuration, and the times of each group are searched with a single :func:`numpy.searchsorted` call.
+        """
+        headers = list(headers)
+        results = [ [] for header in headers ]
+        rows = collections.defaultdict(list)
+        for row, header in enumerate(headers):
+            key, timestamp = self.key(header), self.timestamp(header)
+            if key is not None and timestamp is not None:
+                rows[key].append((row, timestamp))
+        for key, frames in six.iteritems(rows):
+            if key not in self._pending and key not in self._configurations:
+                continue
+            times, calibrations = self._configuration(key)
+            frame_times = _seconds([ timestamp for row, timestamp in frames ])
+            positions = np.searchsorted(times, frame_times)
+            for (row, timestamp), time, position in zip(frames, frame_times, positions):
+                if np.isfinite(time):
+                    results[row] = [ (calibrations[match], offset) for match, offset in _nearest(times, time, position, n, within) ]
+        return list(zip(headers, results))
+
+def _nearest(times, time, position, n, within=None):
+    """Walk outwards from `position` in the sorted array `times`, to find the `n` rows nearest to `time`.
+
+    :return: A list of ``(row, offset)`` pairs, from the nearest.
+    """
+    matches = []
+    lower, upper = position - 1, position
+    while len(matches) < n and (lower >= 0 or upper < len(times)):
+        if upper >= len(times) or (lower >= 0 and time - times[lower] <= times[upper] - time):
+            row, lower = lower, lower - 1
+        else:
+            row, upper = upper, upper + 1
+        offset = times[row] - time
+        if within is not None and abs(offset) > within:
+            break
+        matches.append((row, offset))
+    return matches
@@ -11,6 +11,7 @@ from __future__ import (absolute_import, unicode_literals, division,
                         print_function)
 
 import os, os.path, glob, sys
+import io
 import shlex
 import re, ast
 import warnings, logging
@@ -24,18 +25,28 @@ import numpy as np
 from pyshell.subcommand import SCController, SCEngine
 from pyshell.util import query_yes_no, force_dir_path, collapseuser, check_exists, deprecatedmethod, query_string, query_select
 
-from astropy.coordinates import ICRS
+from astropy.coordinates import ICRS, Angle
 import astropy.units as u
-from astropy.io import fits
 
-from .fits.core import FITSHeaderTable, readfilelist
-from .starlist import StarlistToRegion
+from .core import FITSHeaderTable, FITSDataGroups, FITSDataRollup, readfilelist, iter_headers, pool_getheaders, shard_group, POOLS, BACKENDS
+from .index import FITSHeaderIndex
+from .query import Query
+from .aggregate import Aggregates
+from .stream import WRITERS, FixedWidthWriter, write_rows
+from .spatial import SkyIndex, friends_of_friends, _degrees
+from .patch import HeaderPatch, patch_headers
+from .calib import CalibrationIndex
+from .crossmatch import target_frames
+from ..starlist import StarlistToRegion, parse_starlist
 
 class FITSCLI(SCEngine):
     """A base class for command line interfaces using pyshell."""
     
     options = []
     
+    required_keywords = []
+    """Header keywords which this command always needs, in addition to the search keywords. If ``None``, every keyword is read."""
+    
     def after_configure(self):
         """Configure the logging"""
         super(FITSCLI, self).after_configure()
@@ -43,6 +54,16 @@ class FITSCLI(SCEngine):
         if "i" in self.options:
             self.parser.add_argument('-i','--input',help="Either a glob or a list contianing the files to use.",
                 action='store',nargs="+",type=unicode,default=unicode(self.config.get("Defaults.Files.Input","*.fits")))
+            self.parser.add_argument('-j','--jobs',help="Number of workers used to read FITS headers.",
+                action='store',type=int,default=self.config.get("Defaults.Files.Jobs",1),metavar="N")
+            self.parser.add_argument('--pool',help="Use threads (I/O bound) or processes (parsing bound) to read FITS headers.",
+                action='store',choices=POOLS,default=self.config.get("Defaults.Files.Pool","thread"))
+            self.parser.add_argument('--index',help="Cache FITS headers in an index file, and only re-read files which have changed. Without a file name, the index is kept next to the FITS files.",
+                action='store',nargs="?",const=True,default=self.config.get("Defaults.Files.Index",False),metavar="index.sqlite")
+            self.parser.add_argument('--backend',help="The FITS header reader. 'scan' reads header blocks directly, and falls back to 'astropy' for files it can't read.",
+                action='store',choices=sorted(BACKENDS),default=self.config.get("Defaults.Files.Backend","astropy"))
+            self.parser.add_argument('--lazy',help="Only parse header cards when their keywords are used.",
+                action='store_true',default=self.config.get("Defaults.Files.Lazy",False))
         
         if "s" in self.options:
             self.parser.add_argument('-s','--single',help="Use only the first found file.",
@@ -64,12 +85,19 @@ class FITSCLI(SCEngine):
         elif "oi" in self.options:
             self.opts.log = False
         
+        if "ol" in self.options or "oil" in self.options:
+            self.parser.add_argument('--stream',action='store',choices=sorted(WRITERS),
+                default=self.config.get("UI.Table.stream",None),
+                help="Write each row as soon as its file passes the search, as newline delimited JSON, tab separated values, or fixed width columns.")
+            self.parser.add_argument('--widths',action='store',nargs="+",type=int,default=None,metavar="N",
+                help="Column widths for '--stream fixed'. By default, widths are set from the first {:d} rows.".format(FixedWidthWriter.SAMPLE))
+        
         # Search settings:
         if "skw" in self.options:
             self.parser.add_argument('--re',action='store_true',
                 help="Use regular expressions to parse header values.")
             self.parser.add_argument('keywords',nargs="*",action='store',
-                help="File Header search keywords. 'KWD' is the FITS header keyword to seach for, and 'value' is the search value. See `--re` to use 'value' as a regular expression.",metavar='KWD=value')
+                help="File Header search keywords. 'KWD' is the FITS header keyword to seach for, and 'value' is the search value. Keywords can also be compared with '!=', '<', '<=', '>', '>=' and 'in [value, ...]', and 'OR' separates alternative searches. See `--re` to use 'value' as a regular expression.",metavar='KWD=value')
         if "gkw" in self.options:
             self.parser.add_argument('keywords',nargs="*",help="Keywords to group.",action='store',default=self.config.get("Log.Keywords"))
                 
@@ -87,7 +115,7 @@ class FITSCLI(SCEngine):
             inputs = self.opts.input
         files = []
         for _input in inputs:
-            if check_exists(_input) and not (_input.endswith(".fit") or _input.endswith(".fits") or _input.endswith("fits.gz")):
+            if check_exists(_input) and not _input.endswith((".fit", ".fits", "fits.gz", "fits.fz")):
                 files += readfilelist(_input)
             else:
                 infiles = shlex.split(_input)
@@ -101,25 +129,69 @@ class FITSCLI(SCEngine):
         
         return files
     
+    def get_index(self, files):
+        """Open the header index requested by the --index command line argument, or return ``None``."""
+        index = getattr(self.opts, 'index', False)
+        if not index:
+            return None
+        if index is True:
+            return FITSHeaderIndex.sidecar(files)
+        return FITSHeaderIndex(index)
+    
+    def get_projection(self):
+        """Get the list of header keywords which this command needs, or ``None`` if it needs every keyword.
+        
+        The keywords are the search keywords from :meth:`get_query` (or the grouping keywords, which default to the ``Log.Keywords`` configuration value) and the :attr:`required_keywords` for this command.
+        """
+        if self.required_keywords is None:
+            return None
+        if "skw" in self.options:
+            keywords = self.get_query().keywords
+        else:
+            keywords = list(getattr(self.opts, 'keywords', None) or [])
+        return keywords + list(self.required_keywords)
+    
+    def read_headers(self, files):
+        """Read the FITS headers for `files` into a :class:`FITSHeaderTable`, using the -j, --pool, --index, --backend and --lazy command line arguments.
+        
+        Only the keywords from :meth:`get_projection` are kept.
+        """
+        index = self.get_index(files)
+        try:
+            return FITSHeaderTable.fromfiles(files, workers=getattr(self.opts, 'jobs', None), pool=getattr(self.opts, 'pool', 'thread'),
+                index=index, backend=getattr(self.opts, 'backend', 'astropy'), keywords=self.get_projection(), lazy=getattr(self.opts, 'lazy', False))
+        finally:
+            if index is not None:
+                index.close()
+    
+    def iter_headers(self, files):
+        """Iterate over the FITS headers for `files`, without keeping them all in memory. See :func:`~pyobserver.fits.core.iter_headers`.
+        
+        With an --index, the headers are read into a table with :meth:`read_headers` instead, as the index answers for unchanged files without reading them.
+        """
+        if getattr(self.opts, 'index', False):
+            return iter(self.read_headers(files))
+        return iter_headers(files, workers=getattr(self.opts, 'jobs', None), pool=getattr(self.opts, 'pool', 'thread'),
+            backend=getattr(self.opts, 'backend', 'astropy'), keywords=self.get_projection(), lazy=getattr(self.opts, 'lazy', False))
+    
+    @property
+    def status(self):
+        """The stream for messages about the command's progress. With --stream, this is standard error, so that standard output only holds the rows."""
+        return sys.stderr if getattr(self.opts, 'stream', None) else sys.stdout
+    
+    def get_query(self):
+        """Get the :class:`~pyobserver.fits.query.Query` from the search keywords."""
+        try:
+            return Query.parse(self.opts.keywords, regex=self.opts.re)
+        except ValueError as e:
+            self.parser.error("Malformed Keyword Search: {!s}".format(e))
+    
     def get_keywords(self):
         """Get the dictionaries for search keywords"""
-        search = collections.OrderedDict()
-        for pair in self.opts.keywords:
-            if len(pair.split("=",1)) == 2:
-                key,value = pair.split("=",1)
-                if self.opts.re:
-                    value = re.compile(value)
-                else:
-                    try:
-                        value = ast.literal_eval(value)
-                    except:
-                        value = value
-            elif len(pair.split("=")) == 1:
-                key,value = pair,True
-            else:
-                self.parser.error("Argument for Malformed Keyword Pair: '%s'" % pair)
-            search[key] = value
-        return search
+        try:
+            return self.get_query().todict()
+        except ValueError as e:
+            self.parser.error(str(e))
     
     def get_ds9(self, target=None):
         """Open DS9"""
@@ -161,7 +233,7 @@ class FITSCLI(SCEngine):
             table.write(output, format=_format, bookend=False, delimiter=None, include_names=include)
             print("Wrote file {:s} to '{:s}'".format("log" if log else "list", output))
         elif less:
-            from .util import stream_less
+            from ..util import stream_less
             writer = lambda stream : table.write(stream, format=_format, bookend=False, delimiter=None, include_names=include)
             stream_less(writer)
             print("{size:d} files {verb:s}.".format(size=len(table),verb=verb))
@@ -175,6 +247,49 @@ class FITSCLI(SCEngine):
             table.write(sys.stdout, format=_format, bookend=False, delimiter=None, include_names=include)
             print("{size:d} files {verb:s}.".format(size=len(table),verb=verb))
         
+    def output_stream(self, headers, keywords, less=None, verb="found"):
+        """Output a table to the command line, one row at a time, using the --stream format. See :meth:`output_table`.
+        
+        :param headers: An iterable of headers, usually from :meth:`iter_headers` and :meth:`~pyobserver.fits.query.Query.filter`.
+        :param keywords: The header keywords for each column, after the file name column.
+        :param bool less: Whether to stream to the unix ``less`` command.
+        :param string verb: The verb to use for end-user output.
+        
+        """
+        if less is None:
+            less = self.config.get("UI.Table.less", False)
+        log = getattr(self.opts,'log',False)
+        output = getattr(self.opts,'output',False)
+        
+        keys = [ "OPENNAME" ]
+        names = [ "file" ]
+        if log:
+            keys += [ key for key in keywords if key != "OPENNAME" ]
+            names += keys[1:]
+        
+        def writer(stream):
+            if self.opts.stream == 'fixed':
+                rows = FixedWidthWriter(stream, names, widths=self.opts.widths, header=log)
+            else:
+                rows = WRITERS[self.opts.stream](stream, names, header=log)
+            write_rows(rows, headers, keys)
+            return rows
+        
+        if output:
+            with io.open(output, 'w', encoding='utf-8') as stream:
+                rows = writer(stream)
+            print("Wrote file {:s} to '{:s}'".format("log" if log else "list", output))
+        elif less:
+            from ..util import stream_less
+            result = []
+            stream_less(lambda stream : result.append(writer(stream)))
+            rows = result[0]
+        else:
+            rows = writer(sys.stdout)
+        print("{size:d} files {verb:s}.".format(size=rows.rows,verb=verb), file=self.status)
+        if rows.latency is not None:
+            print("First row after {:.0f} ms.".format(rows.latency * 1e3), file=self.status)
+        
 
 
 class FITSInfo(FITSCLI):
@@ -191,8 +306,8 @@ class FITSInfo(FITSCLI):
     def do(self):
         """Do the work"""
         files = self.get_files()
-        search = self.get_keywords()
-        data = FITSHeaderTable.fromfiles(files).search(**search)
+        query = self.get_query()
+        data = self.read_headers(files).query(query)
         print("Will get info on %d files." % len(data))
         if self.opts.output is False:
             self.opts.output = None
@@ -210,14 +325,16 @@ class FITSHead(FITSCLI):
     
     options = [ "i", "skw", "s" ]
     
+    required_keywords = None
+    
     def do(self):
         """Do the work!"""
-        from .util import stream_less
+        from ..util import stream_less
         files = self.get_files()
-        search = self.get_keywords()
-        data = FITSHeaderTable.fromfiles(files).search(**search)
+        query = self.get_query()
+        data = self.read_headers(files).query(query)
         print("Will show header for %d files." % len(data))
-        for header in data:
+        for header in data.promoted():
             write = lambda stream : stream.write(repr(header))
             stream_less(write)
         print("Examined {:d} headers.".format(len(data)))
@@ -240,11 +357,36 @@ class FITSGroup(FITSCLI):
         super(FITSGroup, self).after_configure()
         self.opts.log = True
         self.parser.add_argument('--list', help="Collect list names for addition to the grouping.", nargs="+", default=[])
+        self.parser.add_argument('--shard', help="Group the files in each directory in a separate process (using -j processes), and combine the groups.", action='store_true')
+        self.parser.add_argument('--rollup', help="Group by each level of the keyword hierarchy (the first keyword, the first two keywords, ...) and show subtotals for every level.", action='store_true')
+        self.parser.add_argument('--aggregate', help="Aggregate columns to add for each group, e.g. 'EXPTIME=sum' 'DATE-OBS=min,max' 'ITIME*COADDS=sum'.", nargs="+", default=[], metavar="EXPRESSION=op")
+    
+    def get_aggregates(self):
+        """Get the :class:`~pyobserver.fits.aggregate.Aggregates` from the --aggregate arguments, or ``None``."""
+        if not len(self.opts.aggregate):
+            return None
+        return Aggregates.parse(self.opts.aggregate)
+    
+    def get_projection(self):
+        """The grouping keywords, and the keywords used by any aggregates."""
+        keywords = super(FITSGroup, self).get_projection()
+        aggregates = self.get_aggregates()
+        if keywords is None or aggregates is None:
+            return keywords
+        return keywords + aggregates.keywords
+    
+    def get_shards(self, files):
+        """Split `files` into one shard per directory."""
+        shards = collections.OrderedDict()
+        for filename in files:
+            shards.setdefault(os.path.dirname(os.path.abspath(filename)), []).append(filename)
+        return list(shards.values())
     
     def do(self):
         """Make the log table"""
         files = self.get_files()
-        search = self.get_keywords()
+        query = self.get_query()
+        aggregates = self.get_aggregates()
         
         if not isinstance(self.opts.list,list):
             olists = [ self.opts.list ]
@@ -256,11 +398,188 @@ class FITSGroup(FITSCLI):
         
         
         print("Will group %d files." % len(files))
-        data = FITSHeaderTable.fromfiles(files).search(**search).group(search.keys())
+        if self.opts.shard:
+            data = shard_group(self.get_shards(files), query.keywords, query=query, workers=self.opts.jobs,
+                backend=self.opts.backend, projection=self.get_projection(), aggregates=aggregates, rollup=self.opts.rollup, lazy=self.opts.lazy)
+        elif self.opts.rollup:
+            data = FITSDataRollup(query.keywords, [], aggregates=aggregates).update(query.filter(self.iter_headers(files)))
+        else:
+            data = FITSDataGroups(query.keywords, [], aggregates=aggregates).update(query.filter(self.iter_headers(files)))
         [ data.addlist(_list) for _list in lists ]
         table = data.table()
         self.output_table(table, verb="grouped")
 
+class FITSCalib(FITSCLI):
+    """Find the nearest matching calibration frames for each science frame."""
+    
+    command = 'calib'
+    
+    options = [ "i", "skw" ]
+    
+    help = "Find the calibration frames nearest in time to each science frame."
+    
+    description = fill("Pairs each science frame (found with the 'KEYWORD=value' search) with the calibration frames (found with the --calib search) which have the same values for the --match keywords, and which were taken closest in time.")
+    
+    def after_configure(self):
+        """Add the calibration options."""
+        super(FITSCalib, self).after_configure()
+        self.opts.log = True
+        self.parser.add_argument('--calib', help="Search keywords which find the calibration frames, e.g. 'OBJECT=dark'.", nargs="+", required=True, metavar="KWD=value")
+        self.parser.add_argument('--match', help="Keywords which must match between a science frame and its calibrations.", nargs="+",
+            default=self.config.get("Defaults.Calib.Match", ["EXPTIME", "FILTER"]), metavar="KWD")
+        self.parser.add_argument('--time', help="The keyword with the observation time, or the date and time of day keywords.", nargs="+",
+            default=self.config.get("Defaults.Calib.Time", ["DATE-OBS"]), metavar="KWD")
+        self.parser.add_argument('-n', help="The number of calibration frames to find for each science frame.", type=int, default=1, metavar="N", dest="number")
+        self.parser.add_argument('--within', help="Only use calibration frames taken within this many hours of the science frame.", type=float, default=None, metavar="HOURS")
+    
+    def get_calib_query(self):
+        """Get the :class:`~pyobserver.fits.query.Query` for calibration frames from the --calib search keywords."""
+        try:
+            return Query.parse(self.opts.calib, regex=self.opts.re)
+        except ValueError as e:
+            self.parser.error("Malformed Calibration Search: {!s}".format(e))
+    
+    def get_projection(self):
+        """The science and calibration search keywords, the --match keywords and the --time keywords."""
+        keywords = super(FITSCalib, self).get_projection()
+        return keywords + self.get_calib_query().keywords + list(self.opts.match) + list(self.opts.time)
+    
+    def do(self):
+        """Associate calibrations"""
+        files = self.get_files()
+        query = self.get_query()
+        print("Will search {:d} files.".format(len(files)))
+        data = self.read_headers(files)
+        calibrations = data.query(self.get_calib_query())
+        calibration_ids = set(id(header) for header in calibrations)
+        science = [ header for header in data.query(query) if id(header) not in calibration_ids ]
+        
+        index = CalibrationIndex(self.opts.match, time=self.opts.time)
+        index.update(calibrations)
+        print("Indexed {:d} calibration frames in {:d} configurations.".format(len(index), len(index.configurations)))
+        
+        within = None if self.opts.within is None else self.opts.within * 3600.0
+        rows = []
+        unmatched = 0
+        for header, matches in index.associate(science, n=self.opts.number, within=within):
+            if not len(matches):
+                unmatched += 1
+            for rank, (calibration, offset) in enumerate(matches, 1):
+                rows.append((header["OPENNAME"], calibration["OPENNAME"], rank, offset / 3600.0))
+        if unmatched:
+            print("{:d} of {:d} science frames have no matching calibrations.".format(unmatched, len(science)))
+        if not len(rows):
+            return
+        
+        from astropy.table import Table
+        table = Table(rows=rows, names=["file", "calibration", "rank", "hours"],
+            dtype=[six.text_type, six.text_type, int, float])
+        table["hours"].format = "{:.3f}"
+        self.output_table(table, verb="associated")
+
+class FITSCover(FITSCLI):
+    """Find the frames which cover a position on the sky."""
+    
+    command = 'cover'
+    
+    options = [ "i" ]
+    
+    help = "Find the FITS files which cover a position on the sky."
+    
+    description = fill("Finds the FITS files whose sky footprint (from the WCS, or the RA and DEC keywords) is within RADIUS of a position, using the footprints kept in the header index. Only files which are new or have changed since they were indexed are read.")
+    
+    required_keywords = []
+    
+    def after_configure(self):
+        """Add the position arguments."""
+        super(FITSCover, self).after_configure()
+        self.opts.log = True
+        self.parser.add_argument('ra', help="Right ascension, in degrees or with units (e.g. 12h30m00s).", metavar="RA")
+        self.parser.add_argument('dec', help="Declination, in degrees or with units (e.g. -30d00m00s).", metavar="DEC")
+        self.parser.add_argument('radius', help="Search radius, in degrees or with units (e.g. 30arcsec).", metavar="RADIUS")
+    
+    def get_index(self, files):
+        """Open the header index from --index, or the index next to the files by default."""
+        index = super(FITSCover, self).get_index(files)
+        if index is None:
+            return FITSHeaderIndex.sidecar(files)
+        return index
+    
+    def do(self):
+        """Find covering frames"""
+        files = self.get_files()
+        ra, dec, radius = [ Angle(value, unit=u.deg).degree for value in (self.opts.ra, self.opts.dec, self.opts.radius) ]
+        print("Will search {:d} files.".format(len(files)))
+        
+        names = dict((os.path.abspath(filename), filename) for filename in files)
+        with self.get_index(files) as index:
+            index.refresh(files, workers=self.opts.jobs, pool=self.opts.pool, backend=self.opts.backend)
+            matches = [ (names[path], hdu, distance) for path, hdu, distance in index.cone(ra, dec, radius) if path in names ]
+        if not len(matches):
+            print("No files cover this position.")
+            return
+        
+        from astropy.table import Table
+        table = Table(rows=matches, names=["file", "hdu", "distance"],
+            dtype=[six.text_type, int, float])
+        table["distance"] = table["distance"] * 3600.0
+        table["distance"].unit = u.arcsec
+        table["distance"].format = "{:.2f}"
+        self.output_table(table, verb="cover this position")
+    
+
+class FITSObserved(FITSCLI):
+    """Find which starlist targets already have frames."""
+    
+    command = 'observed'
+    
+    options = [ "i", "skw" ]
+    
+    help = "Count the FITS files which were taken at each target in a starlist."
+    
+    description = fill("Matches the targets in a starlist to the RA and DEC pointing of each FITS file (optionally filtered with the 'KEYWORD=value' search), and shows the number of frames, the total exposure time and the filters used for each target.")
+    
+    required_keywords = [ "RA", "DEC" ]
+    
+    def after_configure(self):
+        """Add the starlist options."""
+        super(FITSObserved, self).after_configure()
+        self.opts.log = True
+        self.parser.add_argument('--starlist', help="The starlist file name.", default=self.config.get("Defaults.Starlist", "starlist.txt"), metavar="starlist.txt")
+        self.parser.add_argument('--tolerance', help="The largest separation between a target and a pointing, in degrees or with units (e.g. 20arcsec).",
+            default=self.config.get("Defaults.Crossmatch.Tolerance", "20arcsec"), metavar="ANGLE")
+        self.parser.add_argument('--exposure', help="The exposure time keyword, or a product of keywords like 'ITIME*COADDS'.",
+            default=self.config.get("Defaults.Crossmatch.Exposure", "EXPTIME"), metavar="KWD")
+        self.parser.add_argument('--filter', help="The filter keyword.", default=self.config.get("Defaults.Crossmatch.Filter", "FILTER"), metavar="KWD")
+    
+    def get_projection(self):
+        """The search keywords, the pointing keywords, and the exposure and filter keywords."""
+        keywords = super(FITSObserved, self).get_projection()
+        return keywords + [ keyword.strip() for keyword in self.opts.exposure.split("*") ] + [ self.opts.filter ]
+    
+    def do(self):
+        """Match targets to frames"""
+        files = self.get_files()
+        query = self.get_query()
+        targets = list(parse_starlist(self.opts.starlist))
+        print("Will match {:d} targets to {:d} files.".format(len(targets), len(files)))
+        data = self.read_headers(files).query(query)
+        tolerance = Angle(self.opts.tolerance, unit=u.deg)
+        results = target_frames(targets, data, tolerance=tolerance, exposure=self.opts.exposure, filter=self.opts.filter, log=self.log)
+        print("{:d} of {:d} targets have frames.".format(sum(1 for result in results if result.frames), len(results)))
+        if not len(results):
+            return
+        
+        from astropy.table import Table, MaskedColumn
+        table = Table(masked=True)
+        table["target"] = [ result.name for result in results ]
+        table["frames"] = [ result.frames for result in results ]
+        exposures = [ result.exposure for result in results ]
+        table["exposure"] = MaskedColumn([ 0.0 if value is None else value for value in exposures ], mask=[ value is None for value in exposures ], dtype=float)
+        table["filters"] = [ ",".join("{}:{:d}".format(name, count) for name, count in result.filters.items()) for result in results ]
+        self.output_table(table, verb="matched")
+    
+
 class FITSLog(FITSCLI):
     """Create a log from FITS header attributes."""
     
@@ -276,14 +595,16 @@ class FITSLog(FITSCLI):
         """Make the log table"""
         from pyshell.util import check_exists
         if self.opts.output and check_exists(self.opts.output):
-            print("Log %r already exists. Will overwirte." % self.opts.output)
+            print("Log %r already exists. Will overwirte." % self.opts.output, file=self.status)
         
         files = self.get_files()
-        search = self.get_keywords()
+        query = self.get_query()
         
-        print("Will log %d files." % len(files))
-        data = FITSHeaderTable.fromfiles(files).search(**search).normalize(search.keys())
-        table = data.table(order=search.keys())
+        print("Will log %d files." % len(files), file=self.status)
+        if self.opts.stream:
+            return self.output_stream(query.filter(self.iter_headers(files)), query.keywords)
+        data = self.read_headers(files).query(query).normalize(query.keywords)
+        table = data.table(order=query.keywords)
         self.output_table(table)
         
     
@@ -302,11 +623,13 @@ class FITSList(FITSCLI):
     
     def do(self):
         """Run the search itself"""
-        search = self.get_keywords()
+        query = self.get_query()
         files = self.get_files()
-        print("Searching %d files." % len(files))
-        data = FITSHeaderTable.fromfiles(files).search(**search)
-        table = data.table(order=search.keys())
+        print("Searching %d files." % len(files), file=self.status)
+        if self.opts.stream:
+            return self.output_stream(query.filter(self.iter_headers(files)), query.keywords)
+        data = self.read_headers(files).query(query)
+        table = data.table(order=query.keywords)
         self.output_table(table)
         
 
@@ -323,10 +646,10 @@ class FITSInspect(FITSCLI):
     
     def do(self):
         """Inspect files!"""
-        search = self.get_keywords()
+        query = self.get_query()
         files = self.get_files()
         print("Searching {:d} files".format(len(files)))
-        data = FITSHeaderTable.fromfiles(files).normalize(search.keys()).search(**search)
+        data = self.read_headers(files).normalize(query.keywords).query(query)
         print("Inspecting {:d} files".format(len(data.files)))
         
         self.log.info("Command: {:s} {:s}".format(sys.argv[0],self.command))
@@ -355,9 +678,9 @@ class FITSInspect(FITSCLI):
         print("Kept {:d} files out of {:d} original files".format(kept,kept+discard))
         self.log.info("Kept {:d} files out of {:d} original files".format(kept,kept+discard))
         
-        inspected_data = FITSHeaderTable.fromfiles(use_files)
+        inspected_data = self.read_headers(use_files)
         
-        self.output_table(inspected_data.table(order=search.keys()))
+        self.output_table(inspected_data.table(order=query.keywords))
     
     
     def ds9inspect(self, filename):
@@ -380,59 +703,127 @@ class FITSFixHeader(FITSCLI):
     
     tolerance = 20 * u.arcsec
     
+    required_keywords = [ "OBJECT", "RA", "DEC" ]
+    
     def do(self):
         """Inspect files!"""
-        search = self.get_keywords()
+        query = self.get_query()
         files = self.get_files()
         print("Searching {:d} files".format(len(files)))
-        data = FITSHeaderTable.fromfiles(files).normalize(search.keys()).search(**search)
+        data = self.read_headers(files).normalize(query.keywords).query(query)
         print("Fixing {:d} files".format(len(data.files)))
         
         self.log.info("Command: {:s} {:s}".format(sys.argv[0],self.command))
         self.log.info("Fixing {:d} of {:d} files.".format(len(data.files), len(files)))
         
         self.locations = {}
+        self.index = SkyIndex(self.tolerance)
         self.files = collections.defaultdict(list)
         self.updated = collections.Counter()
         
-        exceptions = 0
+        filenames, names, ra, dec = self.pointings(data)
+        coordinates = ICRS(ra, dec, unit=(u.deg, u.deg))
+        clusters = friends_of_friends(ra, dec, self.tolerance)
+        proposals, ambiguous = self.propose(clusters, names)
+        print("Clustered {:d} pointings into {:d} targets, {:d} need to be checked.".format(len(names), len(proposals), np.count_nonzero(ambiguous)))
         
-        for header in data:
-            
-            try:
-                location = header["OBJECT"]
-                coords = ICRS(header["RA"], header["DEC"], unit=(u.deg, u.deg))
-            except Exception as e:
-                self.log.exception(e)
-                exceptions += 1
-                if exceptions > 10:
-                    raise
-                continue
+        # Clusters with a single target name are resolved without asking.
+        resolved = ~ambiguous[clusters]
+        for row in np.flatnonzero(resolved):
+            self.add_pointing(proposals[clusters[row]] or names[row], coordinates[row], filenames[row])
+        
+        for row in np.flatnonzero(~resolved):
+            location, coords = names[row], coordinates[row]
             
             if len(self.locations):
                 if self.check_for_collision(coords, location):
-                    location = self.handle_collision(header.filename, location, coords)
+                    location = self.handle_collision(filenames[row], location, coords)
             
                 if location in self.locations:
-                    location = self.handle_match(header.filename, location, coords)
+                    location = self.handle_match(filenames[row], location, coords)
             
-            self.locations[location] = coords
-            self.files[location] += [header.filename]
+            self.add_pointing(location, coords, filenames[row])
         
+        # Each file is patched once, with the last target it was assigned to, and only if its primary OBJECT differs.
+        targets = collections.OrderedDict()
         for location in self.files:
             for filename in self.files[location]:
-                with fits.open(filename, mode='update', ignore_missing_end=True) as HDUs:
-                    if HDUs[0].header.get("OBJECT") != location:
-                        old_location = HDUs[0].header.get("OBJECT")
-                        print("Fixing header for '{}'".format(filename))
-                        print("{} -> {}".format(old_location, location))
-                        HDUs[0].header["OBJECT"] = (location, "MODIFIED")
-                        HDUs[0].header["HISTORY"] = "OLD OBJECT {}".format(old_location)
-                        HDUs[0].header["HISTORY"] = "OBJECT changed {} -> {}".format(old_location, location)
-                        HDUs.flush(output_verify='fix')
-                        self.updated[location] += 1
+                targets[filename] = location
+        primary = pool_getheaders(list(targets), workers=self.opts.jobs, pool=self.opts.pool, backend='scan', keywords=["OBJECT"])
+        
+        patches = []
+        for (filename, location), headers in zip(targets.items(), primary):
+            old_location = headers[0][0].get("OBJECT")
+            if old_location != location:
+                print("Fixing header for '{}'".format(filename))
+                print("{} -> {}".format(old_location, location))
+                patches.append(HeaderPatch(filename, {"OBJECT" : (location, "MODIFIED")},
+                    ["OLD OBJECT {}".format(old_location), "OBJECT changed {} -> {}".format(old_location, location)]))
+                self.updated[location] += 1
+        results = patch_headers(patches, workers=self.opts.jobs, pool=self.opts.pool)
         print("Updated {} OBJECT keywords for {} locations.".format(sum(self.updated.values()), len(self.updated)))
+        if len(results):
+            print("Wrote {:d} bytes, {:d} of {:d} files patched in place, {:d} bytes saved.".format(
+                sum(result.written for result in results), sum(result.inplace for result in results), len(results),
+                sum(result.saved for result in results)))
+    
+    
+    def pointings(self, data):
+        """Collect the file name, OBJECT, RA and DEC of each header, skipping (and logging) headers which can't be read.
+        
+        :return: A tuple of the list of file names, the list of OBJECT values, and arrays of RA and DEC in degrees.
+        """
+        filenames, names, ra, dec = [], [], [], []
+        exceptions = 0
+        for header in data:
+            try:
+                location = header["OBJECT"]
+                pointing = [ _degrees(header[key]) for key in ("RA", "DEC") ]
+            except Exception as e:
+                self.log.exception(e)
+                exceptions += 1
+                if exceptions > 10:
+                    raise
+                continue
+            filenames.append(header.filename)
+            names.append(location)
+            ra.append(pointing[0])
+            dec.append(pointing[1])
+        return filenames, names, np.array(ra, dtype=float), np.array(dec, dtype=float)
     
+    @staticmethod
+    def placeholder(location):
+        """Whether `location` is a placeholder target name (starting with ``tt``), rather than a real target."""
+        return location[:2] == "tt"
+    
+    def propose(self, clusters, names):
+        """Propose a target name for each cluster of pointings from :func:`~pyobserver.fits.spatial.friends_of_friends`.
+        
+        :param clusters: The cluster number of each pointing.
+        :param names: The OBJECT value of each pointing.
+        :return: A tuple of the list of proposed names (``None`` for clusters which only have placeholder names, which are kept as they are), and a boolean array of the clusters which must be checked by hand.
+        
+        The proposed name is the most common real target name in the cluster. A cluster must be checked if it has more than one real target name, or if its target name is also used by another cluster.
+        """
+        counters = [ collections.Counter() for cluster in range(len(set(clusters))) ]
+        for cluster, name in zip(clusters, names):
+            counters[cluster][name] += 1
+        proposals, kept = [], []
+        ambiguous = np.zeros(len(counters), dtype=bool)
+        for cluster, counter in enumerate(counters):
+            real = [ name for name, count in counter.most_common() if not self.placeholder(name) ]
+            proposals.append(real[0] if len(real) else None)
+            kept.append(set(real[:1]) if len(real) else set(counter))
+            ambiguous[cluster] = len(real) > 1
+        owners = collections.Counter(name for names in kept for name in names)
+        ambiguous |= np.array([ any(owners[name] > 1 for name in names) for names in kept ], dtype=bool)
+        return proposals, ambiguous
+    
+    def add_pointing(self, location, coords, filename):
+        """Record a file as a pointing at the target `location`."""
+        self.locations[location] = coords
+        self.index.add(location, coords.ra.degree, coords.dec.degree)
+        self.files[location] += [filename]
     
     def handle_match(self, filename, location, coords):
         """Target matches based on object name"""
@@ -450,34 +841,25 @@ class FITSFixHeader(FITSCLI):
         return location
     
     def check_for_collision(self, coords, location):
-        """docstring for check_for_collision"""
-        distances = [ ocoords.separation(coords).arcsec for ocoords in self.locations.values() ]
-        if len(distances) and min(distances) < self.tolerance.value:
-            if self.locations.keys()[distances.index(min(distances))] == location:
-                return False
-            else:
-                return True
-        else:
-            return False
+        """Check whether the nearest known target within the tolerance is a different target, using the :class:`~pyobserver.fits.spatial.SkyIndex` of target locations."""
+        nearest, separation = self.index.nearest(coords.ra.degree, coords.dec.degree, self.tolerance)
+        return nearest is not None and nearest != location
     
     def handle_collision(self, filename, location, coords):
         """Target collision"""
-        distances = np.array([ ocoords.separation(coords).arcsec for ocoords in self.locations.values() ])
-        collisions = distances <= self.tolerance.value
-        locations = np.array(self.locations.keys())
+        options, separations = self.index.within(coords.ra.degree, coords.dec.degree, self.tolerance)
         
-        real_collisions = [ ctarget for ctarget in locations[collisions] if (not ctarget[:2] == "tt") and (ctarget != location) ]
+        real_collisions = [ ctarget for ctarget in options if (not ctarget[:2] == "tt") and (ctarget != location) ]
         if len(real_collisions) == 0:
             return location
         
         print(" Too close to a different potential target:")
-        print("File '{0}' target {1} appears to be the same as [{2}].".format(filename, location, ",".join(locations[collisions])))
-        options = list(locations[collisions])
+        print("File '{0}' target {1} appears to be the same as [{2}].".format(filename, location, ",".join(options)))
         if len(options) == 1:
-            print("Distance ∆{0.value}{0.unit:unicode}".format(self.locations[options[0]].separation(coords).to(u.arcsec)))
+            print("Distance ∆{0.value}{0.unit:unicode}".format(separations[0].to(u.arcsec)))
             if query_yes_no("Normalize {0} to {1}".format(location, options[0]), default="yes"):
                 return options[0]
-        labels = [ "{0} ∆{1.value}{1.unit:unicode}".format(olocation, self.locations[olocation].separation(coords).to(u.arcsec)) for olocation in options ]
+        labels = [ "{0} ∆{1.value}{1.unit:unicode}".format(olocation, separation.to(u.arcsec)) for olocation, separation in zip(options, separations) ]
         if location not in options:
             options += [location]
             labels += [location]
@@ -500,6 +882,9 @@ class POcommand(SCController):
     
     subEngines = [
         FITSGroup,
+        FITSCalib,
+        FITSCover,
+        FITSObserved,
         FITSLog,
         FITSList,
         FITSInfo,
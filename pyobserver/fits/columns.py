@@ -0,0 +1,489 @@
+# -*- coding: utf-8 -*-
+#
+#  columns.py
+#  pyobserver
+#
+#  Created by Alexander Rudy on 2014-06-09.
+#  Copyright 2014 Alexander Rudy. All rights reserved.
+#
+"""
+:mod:`fits.columns` – Columnar FITS header collections
+======================================================
+
+A :class:`~pyobserver.fits.core.FITSHeaderTable` is a list of headers, so every search or grouping has to visit every header in python. For large archives, the headers can be converted into a :class:`FITSHeaderColumns` object, which holds one typed :mod:`numpy` array per keyword along with a mask of missing values. String keywords (like ``OBJECT`` or ``FILTER``) are dictionary-encoded: the column holds integer codes into a small array of distinct values. Searching and grouping then operate on whole columns, and only visit each distinct value once.
+
+.. autoclass:: FITSHeaderColumns
+    :members:
+
+.. autoclass:: HeaderColumn
+    :members:
+
+.. autoclass:: ColumnBuilder
+    :members:
+
+"""
+from __future__ import (absolute_import, unicode_literals, division,
+                        print_function)
+
+import collections
+import warnings
+
+import numpy as np
+import six
+
+try:
+    import astropy.io.fits as pf
+except ImportError as e:
+    try:
+        import pyfits as pf
+    except ImportError:
+        raise e
+
+from .core import FITSHeaderTable, FITSDataGroups, FITSDataGroup
+from .inverted import typed
+
+COMMENTARY = set(["", "COMMENT", "HISTORY"])
+"""Keywords which are never turned into columns."""
+
+def _kind(values):
+    """Choose the column kind for a list of (non-missing) header values."""
+    if all(isinstance(value, bool) for value in values):
+        return 'bool'
+    if all(isinstance(value, six.integer_types) and not isinstance(value, bool) for value in values):
+        return 'int'
+    if all(isinstance(value, float) for value in values):
+        return 'float'
+    return 'str'
+
+def _value_kind(value):
+    """Choose the column kind for a single (non-missing) header value, see :func:`_kind`."""
+    if isinstance(value, bool):
+        return 'bool'
+    if isinstance(value, six.integer_types):
+        return 'int'
+    if isinstance(value, float):
+        return 'float'
+    return 'str'
+
+def _item(value):
+    """Convert a :mod:`numpy` scalar into a python value. Python values are returned unchanged."""
+    return value.item() if isinstance(value, np.generic) else value
+
+def _category(value):
+    """Convert a header value into a distinct value for a dictionary-encoded column."""
+    if isinstance(value, (bool, float) + six.integer_types + six.string_types):
+        return value
+    return six.text_type(value)
+
+class HeaderColumn(object):
+    """A single header keyword, stored as a typed array with a mask of missing values.
+
+    :param string name: The keyword.
+    :param data: The column data. For dictionary-encoded columns, these are integer codes into `categories`.
+    :param mask: A boolean array, ``True`` where the keyword is missing.
+    :param categories: For dictionary-encoded string columns, the array of distinct values.
+
+    """
+
+    def __init__(self, name, data, mask, categories=None):
+        super(HeaderColumn, self).__init__()
+        self.name = name
+        self.data = np.asarray(data)
+        self.mask = np.asarray(mask, dtype=bool)
+        self.categories = categories
+
+    def __repr__(self):
+        """Representation of this object."""
+        return "<{:s} {:s} {:s}[{:d}]>".format(self.__class__.__name__, self.name, self.dtype, len(self))
+
+    def __len__(self):
+        """The number of rows in this column."""
+        return len(self.data)
+
+    def __getitem__(self, row):
+        """Get the python value at a single row, or ``None`` if it is missing."""
+        if self.mask[row]:
+            return None
+        if self.encoded:
+            return self.categories[self.data[row]]
+        return self.data[row].item()
+
+    @property
+    def encoded(self):
+        """Whether this column is dictionary-encoded."""
+        return self.categories is not None
+
+    @property
+    def dtype(self):
+        """The type of values in this column."""
+        if self.encoded:
+            return "str"
+        return self.data.dtype.name
+
+    @classmethod
+    def fromvalues(cls, name, values, mask):
+        """Build a column from a list of python values.
+
+        :param string name: The keyword.
+        :param values: A list of header values. Values at missing rows are ignored.
+        :param mask: A list of booleans, ``True`` where the keyword is missing.
+
+        Columns of only booleans, integers or floats become :mod:`numpy` arrays of that type. Anything else, including a column which mixes integers and floats, is dictionary-encoded. The distinct values keep their python types, so a column which mixes ``30``, ``30.0`` and ``'30'`` still compares and formats them as a header search would. Values which aren't strings, numbers or booleans are converted to strings.
+        """
+        mask = np.asarray(mask, dtype=bool)
+        present = [ value for value, missing in zip(values, mask) if not missing ]
+        kind = _kind(present)
+        if kind == 'str':
+            lookup = {}
+            codes = np.zeros(len(values), dtype=np.int32)
+            for row, (value, missing) in enumerate(zip(values, mask)):
+                if not missing:
+                    value = _category(value)
+                    # Values are keyed with their type, so that 30 and '30' (or True and 1) stay distinct.
+                    codes[row] = lookup.setdefault((type(value), value), len(lookup))
+            categories = np.empty(len(lookup), dtype=object)
+            for (kind, value), code in six.iteritems(lookup):
+                categories[code] = value
+            return cls(name, codes, mask, categories)
+
+        dtype = { 'bool' : bool, 'int' : np.int64, 'float' : np.float64 }[kind]
+        data = np.zeros(len(values), dtype=dtype)
+        data[~mask] = present
+        return cls(name, data, mask)
+
+    def values(self):
+        """The decoded values of this column, as an array. Missing rows hold arbitrary values, see :attr:`mask`."""
+        if self.encoded:
+            if not len(self.categories):
+                return np.empty(len(self), dtype=object)
+            return self.categories[self.data]
+        return self.data
+
+    def take(self, rows):
+        """Return a new column containing only `rows` (an index array or boolean mask)."""
+        return self.__class__(self.name, self.data[rows], self.mask[rows], self.categories)
+
+    def factorize(self):
+        """Factorize this column into distinct values.
+
+        :return: A tuple of an integer array of codes, one per row, and a list of the distinct python values. Missing rows get the code ``len(uniques)``.
+
+        """
+        if self.encoded:
+            codes = self.data.astype(np.intp)
+            uniques = list(self.categories)
+        else:
+            uniques, codes = np.unique(self.data[~self.mask], return_inverse=True)
+            full = np.empty(len(self), dtype=np.intp)
+            full[~self.mask] = codes
+            codes = full
+            uniques = uniques.tolist()
+        codes[self.mask] = len(uniques)
+        return codes, uniques
+
+    def evaluate(self, predicate):
+        """Evaluate a python `predicate` once for each distinct value in this column.
+
+        :param predicate: A function of a single header value, returning a boolean.
+        :return: A boolean array, one per row. Missing rows are ``False``.
+
+        """
+        codes, uniques = self.factorize()
+        results = np.array([ bool(predicate(value)) for value in uniques ] + [False], dtype=bool)
+        return results[codes]
+
+class ColumnBuilder(object):
+    """Build a single typed table column, one row at a time, without collecting the values in a list.
+
+    :param string name: The column name.
+    :param int length: The number of rows.
+
+    Set each row with ``builder[row] = value``. The array for the column is allocated when the first value is set, with the same types as :meth:`HeaderColumn.fromvalues`. If a later value doesn't fit, the array is converted once to a type which holds both: integers and floats are kept as python values in an object array, so that ``30`` stays ``30`` next to ``2.5``, and anything else is converted to strings. String values are dictionary-encoded while building, and are only expanded to a fixed-width unicode array by :meth:`column`. Rows which are never set, or are set to ``None``, are masked.
+    """
+
+    DTYPES = { 'bool' : bool, 'int' : np.int64, 'float' : np.float64, 'object' : object, 'str' : np.int32 }
+    """The array type used while building, for each kind of column."""
+
+    def __init__(self, name, length):
+        super(ColumnBuilder, self).__init__()
+        self.name = name
+        self.kind = None
+        self.data = None
+        self.mask = np.ones(length, dtype=bool)
+        self._lookup = {}
+
+    def __repr__(self):
+        """Representation of this object."""
+        return "<{:s} {:s} {!s}[{:d}]>".format(self.__class__.__name__, self.name, self.kind, len(self))
+
+    def __len__(self):
+        """The number of rows in this column."""
+        return len(self.mask)
+
+    def __setitem__(self, row, value):
+        """Set the value at a single row."""
+        if value is None or isinstance(value, pf.card.Undefined):
+            return
+        kind = _value_kind(value)
+        if kind != self.kind:
+            self._promote(kind)
+        if self.kind == 'str':
+            value = self._lookup.setdefault(six.text_type(value), len(self._lookup))
+        self.data[row] = value
+        self.mask[row] = False
+
+    def _promote(self, kind):
+        """Allocate or convert the column array so that it can hold values of `kind`."""
+        if self.kind is None:
+            self.kind = kind
+            self.data = np.zeros(len(self), dtype=self.DTYPES[kind])
+            return
+        kind = 'object' if set([self.kind, kind]) <= set(['int', 'float', 'object']) else 'str'
+        if kind == self.kind:
+            return
+        rows = np.flatnonzero(~self.mask)
+        if kind == 'str':
+            codes = np.zeros(len(self), dtype=self.DTYPES[kind])
+            for row in rows:
+                codes[row] = self._lookup.setdefault(six.text_type(_item(self.data[row])), len(self._lookup))
+            self.data = codes
+        else:
+            data = np.empty(len(self), dtype=self.DTYPES[kind])
+            for row in rows:
+                data[row] = self.data[row].item()
+            self.data = data
+        self.kind = kind
+
+    def column(self):
+        """The finished :class:`~astropy.table.Column`, or a :class:`~astropy.table.MaskedColumn` if any rows are missing."""
+        from astropy.table import Column, MaskedColumn
+        if self.kind is None:
+            data = np.zeros(len(self), dtype=np.str_)
+        elif self.kind == 'str':
+            categories = [None] * len(self._lookup)
+            for value, code in six.iteritems(self._lookup):
+                categories[code] = value
+            data = np.array(categories, dtype=np.str_)[self.data]
+        else:
+            data = self.data
+        if self.mask.any():
+            return MaskedColumn(name=str(self.name), data=data, mask=self.mask)
+        return Column(name=str(self.name), data=data)
+
+class FITSHeaderColumns(object):
+    """A columnar collection of FITS headers, with one :class:`HeaderColumn` per keyword.
+
+    :param columns: A list of :class:`HeaderColumn` objects, all of the same length.
+    :param filenames: The file name for each row.
+
+    Use :meth:`fromheaders` (or :meth:`FITSHeaderTable.columns`) to create this object from a list of headers, and :meth:`toheaders` to convert back.
+    """
+
+    def __init__(self, columns, filenames):
+        super(FITSHeaderColumns, self).__init__()
+        self._columns = collections.OrderedDict((column.name, column) for column in columns)
+        self.filenames = np.asarray(filenames, dtype=object)
+        for column in self._columns.values():
+            if len(column) != len(self.filenames):
+                raise ValueError("Column '{}' has {:d} rows, expected {:d}".format(column.name, len(column), len(self.filenames)))
+
+    def __repr__(self):
+        """Representation of this object."""
+        return "<{:s} {:d} headers x {:d} keywords>".format(self.__class__.__name__, len(self), len(self._columns))
+
+    def __len__(self):
+        """The number of headers."""
+        return len(self.filenames)
+
+    def __contains__(self, keyword):
+        """Whether `keyword` is a column."""
+        return keyword.upper() in self._columns
+
+    def __getitem__(self, keyword):
+        """Get the :class:`HeaderColumn` for `keyword`."""
+        return self._columns[keyword.upper()]
+
+    @property
+    def keywords(self):
+        """The list of keywords (columns)."""
+        return list(self._columns.keys())
+
+    @property
+    def files(self):
+        """A list of filenames in this collection."""
+        files = []
+        seen = set()
+        for filename in self.filenames:
+            if filename not in seen:
+                seen.add(filename)
+                files.append(filename)
+        return files
+
+    @classmethod
+    def fromheaders(cls, headers, keywords=None):
+        """Build a columnar collection from a list of headers.
+
+        :param headers: A list of headers, usually a :class:`FITSHeaderTable`.
+        :param keywords: The keywords to include. By default, every keyword found in any header (except commentary keywords) is included.
+        :return: A new :class:`FITSHeaderColumns`.
+
+        """
+        headers = list(headers)
+        if keywords is None:
+            keywords = collections.OrderedDict()
+            for header in headers:
+                for key in header.keys():
+                    if key not in COMMENTARY:
+                        keywords[key] = None
+        keywords = [ keyword.upper() for keyword in keywords ]
+        columns = []
+        for key in keywords:
+            values, mask = [], []
+            for header in headers:
+                value = header.get(key, None)
+                missing = value is None or isinstance(value, pf.card.Undefined)
+                values.append(value)
+                mask.append(missing)
+            columns.append(HeaderColumn.fromvalues(key, values, mask))
+        filenames = [ getattr(header, 'filename', None) for header in headers ]
+        return cls(columns, filenames)
+
+    def toheaders(self, cls=FITSHeaderTable):
+        """Convert this collection back to a list of headers.
+
+        :param cls: The class of header list to return.
+        :return: A new :class:`FITSHeaderTable`, with one :class:`~astropy.io.fits.Header` per row.
+
+        """
+        headers = cls()
+        for row in range(len(self)):
+            header = pf.Header()
+            for column in self._columns.values():
+                if not column.mask[row]:
+                    header[column.name] = column[row]
+            header.filename = self.filenames[row]
+            headers.append(header)
+        return headers
+
+    def take(self, rows):
+        """Return a new collection containing only `rows` (an index array or boolean mask)."""
+        return self.__class__([ column.take(rows) for column in self._columns.values() ], self.filenames[rows])
+
+    def mask(self, **keywords):
+        """Compute the boolean row mask for a search. See :meth:`search` for the search syntax."""
+        keep = np.ones(len(self), dtype=bool)
+        for key, search in six.iteritems(keywords):
+            if key not in self:
+                if search is False:
+                    continue
+                warnings.warn("Couldn't find keyword '{}' in any file".format(key))
+                return np.zeros(len(self), dtype=bool)
+            column = self[key]
+            if search is not False and column.mask.any():
+                warnings.warn("Couldn't find keyword '{}' in {:d} files".format(key, len(set(self.filenames[column.mask]))))
+            if hasattr(search, 'match'):
+                keep &= column.evaluate(lambda value : search.match(six.text_type(value)))
+            elif callable(search):
+                keep &= column.evaluate(_safe(search))
+            elif isinstance(search, bool):
+                keep &= column.mask if not search else ~column.mask
+            else:
+                keep &= column.evaluate(lambda value : value == search)
+        return keep
+
+    def search(self, **keywords):
+        """Search for headers that match specific keyword values.
+
+        :param keywords: Arbitrary keyword-style arguments specifying the search criteria.
+        :returns: A new :class:`FITSHeaderColumns` object filtered down.
+
+        The search criteria are the same as for :meth:`FITSHeaderTable.search`. Regular expressions, callables and literal values are only evaluated once for each distinct value of a keyword. Headers which are missing a keyword don't match, and a single warning is raised for each missing keyword.
+
+        """
+        if "OPENNAME" not in keywords:
+            keywords["OPENNAME"] = True
+        return self.take(self.mask(**keywords))
+
+    def query(self, query):
+        """Search for headers which match a :class:`~pyobserver.fits.query.Query`.
+
+        :param query: A :class:`~pyobserver.fits.query.Query`, or a list of query strings.
+        :returns: A new :class:`FITSHeaderColumns` object filtered down.
+
+        """
+        from .query import Query
+        if not isinstance(query, Query):
+            query = Query.parse(query)
+        return self.take(query.mask(self))
+
+    def group_rows(self, keywords):
+        """Find the rows which belong to each group of identical values for `keywords`.
+
+        :param keywords: The keywords to group on.
+        :return: An ordered dictionary mapping group keys to arrays of row indicies. Keys are tuples with a ``(kind, value)`` pair for each keyword, as for :meth:`FITSDataGroups.key`, so that ``30`` and ``30.0`` stay apart. Missing values are ``None``.
+
+        """
+        ids = np.zeros(len(self), dtype=np.intp)
+        for key in keywords:
+            codes, uniques = self[key].factorize()
+            ids = ids * (len(uniques) + 1) + codes
+            _, ids = np.unique(ids, return_inverse=True)
+        order = np.argsort(ids, kind='mergesort')
+        starts = np.concatenate([[0], np.flatnonzero(np.diff(ids[order])) + 1])
+        groups = collections.OrderedDict()
+        for rows in np.split(order, starts[1:]):
+            if not len(rows):
+                continue
+            groups[tuple(_typed(self[key][rows[0]]) for key in keywords)] = rows
+        return groups
+
+    def group(self, keywords, key_fmt=None):
+        """Group headers by the values of `keywords`. See :meth:`FITSHeaderTable.group`. Headers which are missing any of the `keywords` are not grouped.
+
+        :return: A :class:`FITSDataGroups` object.
+
+        """
+        if key_fmt is None:
+            key_fmt = []
+        groups = FITSDataGroups(keywords, key_fmt)
+        for key, rows in six.iteritems(self.group_rows(keywords)):
+            if None in key:
+                warnings.warn("Can't group {:d} headers which are missing keywords {}".format(len(rows),
+                    ", ".join(keyword for keyword, value in zip(keywords, key) if value is None)))
+                continue
+            headers = self.take(rows).toheaders()
+            group = FITSDataGroup(headers[0], groups._make_hash(headers[0]), groups.keywords, groups.formats)
+            group.extend(headers[1:])
+            groups.add(group)
+        return groups
+
+    def table(self, order=None):
+        """Create an :class:`astropy.table.Table` from this collection. See :meth:`FITSHeaderTable.table`.
+
+        Missing values are masked, rather than filled in.
+        """
+        from astropy.table import Table, MaskedColumn
+
+        if order is None:
+            order = sorted(self.keywords)
+        order = [ key for key in order if key != "OPENNAME" ]
+
+        columns = [ MaskedColumn(name=str("file"), data=self["OPENNAME"].values(), mask=self["OPENNAME"].mask) ]
+        for key in order:
+            column = self[key]
+            columns.append(MaskedColumn(name=str(key), data=column.values(), mask=column.mask))
+        return Table(columns, masked=True)
+
+def _typed(value):
+    """The ``(kind, value)`` pair for a value, or ``None`` if it is missing."""
+    return None if value is None else typed(value)
+
+def _safe(search):
+    """Wrap a callable search so that exceptions are reported as warnings, and don't match."""
+    def safe(value):
+        try:
+            return search(value)
+        except Exception as e:
+            warnings.warn("Callable keyword search failed for value '{}': {}".format(value, e))
+            return False
+    return safe
@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+#
+#  compressed.py
+#  pyobserver
+#
+#  Created by Alexander Rudy on 2014-06-18.
+#  Copyright 2014 Alexander Rudy. All rights reserved.
+#
+"""
+:mod:`fits.compressed` – Headers from gzipped FITS files
+========================================================
+
+Reading the headers of a ``.fits.gz`` file through :func:`astropy.io.fits.open` decompresses the whole file. This module inflates gzipped files as a stream instead. Header blocks are kept, data units are inflated and thrown away, and inflation stops as soon as the last requested header has been found.
+
+Gzip streams can't be read from an arbitrary position, so a :class:`GzipIndex` keeps a copy of the decompressor state every :attr:`GzipIndex.SPAN` bytes. Later reads of the same file (e.g. for an extension header, when a header is promoted) start from the nearest copy, rather than from the start of the file. Indexes are kept for the most recently read files.
+
+.. autofunction:: gzip_header_strings
+
+.. autoclass:: GzipStream
+    :members:
+
+.. autoclass:: GzipIndex
+    :members:
+
+"""
+from __future__ import (absolute_import, unicode_literals, division,
+                        print_function)
+
+import os, os.path
+import bisect
+import collections
+import itertools
+import threading
+import zlib
+
+import numpy as np
+
+from .scan import BLOCK, CARD, CARDS_PER_BLOCK, HDUExtent, end_card, padded, _data_size, header_cards
+
+_WBITS = 16 + zlib.MAX_WBITS
+
+class GzipIndex(object):
+    """A seek index for a gzip stream: copies of the decompressor, taken at regular intervals.
+
+    :param int span: The number of uncompressed bytes between copies.
+
+    """
+
+    SPAN = 1 << 22
+    """The default number of uncompressed bytes between copies of the decompressor."""
+
+    def __init__(self, span=None):
+        super(GzipIndex, self).__init__()
+        self.span = self.SPAN if span is None else span
+        self._positions = [0]
+        self._points = [(0, None)]
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        """Representation of this object."""
+        return "<{:s} {:d} points>".format(self.__class__.__name__, len(self))
+
+    def __len__(self):
+        """The number of points in this index."""
+        return len(self._positions)
+
+    def add(self, position, offset, decompressor):
+        """Add a point to this index, if it is far enough past the last point.
+
+        :param int position: The uncompressed position which `decompressor` has reached.
+        :param int offset: The compressed offset of the next byte to feed to `decompressor`.
+        :param decompressor: The :func:`zlib.decompressobj`, which is copied.
+
+        """
+        with self._lock:
+            if position >= self._positions[-1] + self.span:
+                self._points.append((offset, decompressor.copy()))
+                self._positions.append(position)
+
+    def find(self, position):
+        """Find the last point at or before `position`.
+
+        :return: A tuple of the uncompressed position, the compressed offset, and a new decompressor for that point.
+        """
+        with self._lock:
+            i = bisect.bisect_right(self._positions, position) - 1
+            offset, decompressor = self._points[i]
+            decompressor = zlib.decompressobj(_WBITS) if decompressor is None else decompressor.copy()
+            return self._positions[i], offset, decompressor
+
+class GzipStream(object):
+    """Random access reads from a gzipped file, using a :class:`GzipIndex`.
+
+    :param string filename: The gzipped file name.
+    :param index: The :class:`GzipIndex` for this file. A new index is started if it is not given.
+
+    Reading forwards only inflates the file once. Reading backwards restarts from the nearest point in the index.
+    """
+
+    CHUNK = 1 << 16
+    """The number of compressed bytes inflated at a time."""
+
+    def __init__(self, filename, index=None):
+        super(GzipStream, self).__init__()
+        self.filename = filename
+        self.index = GzipIndex() if index is None else index
+        self._file = open(filename, 'rb')
+        self._start(*self.index.find(0))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """Close the underlying file."""
+        self._file.close()
+
+    def _start(self, position, offset, decompressor):
+        """Restart inflation at a point from the index."""
+        self._file.seek(offset)
+        self._position = position
+        self._buffer = b""
+        self._decompressor = decompressor
+
+    def _inflate(self):
+        """Inflate the next chunk of the file into the buffer. Return ``False`` at the end of the file."""
+        data = self._file.read(self.CHUNK)
+        if not data:
+            return False
+        output = [ self._decompressor.decompress(data) ]
+        while self._decompressor.unused_data:
+            # The next member of a multi-member gzip file.
+            unused = self._decompressor.unused_data
+            self._decompressor = zlib.decompressobj(_WBITS)
+            try:
+                output.append(self._decompressor.decompress(unused))
+            except zlib.error:
+                # Trailing garbage after the last member is ignored, as gzip does.
+                self._file.seek(0, os.SEEK_END)
+                break
+        self._buffer += b"".join(output)
+        self.index.add(self._position + len(self._buffer), self._file.tell(), self._decompressor)
+        return True
+
+    def read(self, position, size):
+        """Read `size` uncompressed bytes, starting at the uncompressed `position`.
+
+        :return: The bytes, which are shorter than `size` at the end of the file.
+
+        Anything before `position` is discarded as it is inflated, so skipping over a large data unit doesn't use much memory.
+        """
+        if position < self._position or position >= self._position + len(self._buffer) + self.index.span:
+            point = self.index.find(position)
+            if position < self._position or point[0] > self._position + len(self._buffer):
+                self._start(*point)
+        while True:
+            drop = min(len(self._buffer), position - self._position)
+            if drop > 0:
+                self._buffer = self._buffer[drop:]
+                self._position += drop
+            if self._position + len(self._buffer) >= position + size or not self._inflate():
+                break
+        start = position - self._position
+        return self._buffer[start:start + size]
+
+def iter_stream_extents(stream):
+    """Walk the HDUs in a :class:`GzipStream`, like :func:`~pyobserver.fits.scan.iter_extents`.
+
+    :return: A generator of ``(extent, cards)`` pairs, where `cards` is the ``(n, 80)`` array of header cards for each :class:`~pyobserver.fits.scan.HDUExtent`.
+
+    Data units are only inflated when the next header is requested.
+    """
+    first = stream.read(0, BLOCK)
+    if len(first) < BLOCK or first[:8].rstrip() != b"SIMPLE":
+        raise ValueError("Not a FITS file, first card is {!r}".format(first[:8]))
+    offset = 0
+    while True:
+        blocks = [ stream.read(offset, BLOCK) ]
+        if len(blocks[0]) < BLOCK or blocks[0][:8].rstrip() not in (b"SIMPLE", b"XTENSION"):
+            return
+        while True:
+            end = end_card(np.frombuffer(blocks[-1], dtype=np.uint8).reshape(CARDS_PER_BLOCK, CARD))
+            if end is not None:
+                break
+            block = stream.read(offset + len(blocks) * BLOCK, BLOCK)
+            if len(block) < BLOCK:
+                raise ValueError("No END card found for header at byte {:d}".format(offset))
+            blocks.append(block)
+        ncards = (len(blocks) - 1) * CARDS_PER_BLOCK + end
+        cards = np.frombuffer(b"".join(blocks), dtype=np.uint8, count=ncards * CARD).reshape(ncards, CARD)
+        datasize = _data_size(cards, primary=(offset == 0))
+        data = offset + len(blocks) * BLOCK
+        yield HDUExtent(offset, ncards, data, datasize), cards
+        offset = data + padded(datasize)
+
+_INDEXES = collections.OrderedDict()
+_INDEXES_LOCK = threading.Lock()
+
+MAX_INDEXES = 64
+"""The number of files whose :class:`GzipIndex` is kept."""
+
+def gzip_index(filename):
+    """Get the :class:`GzipIndex` for `filename`, which is shared between reads as long as the file doesn't change."""
+    stat = os.stat(filename)
+    key = (os.path.abspath(filename), stat.st_size, stat.st_mtime)
+    with _INDEXES_LOCK:
+        index = _INDEXES.pop(key, None)
+        if index is None:
+            index = GzipIndex()
+        _INDEXES[key] = index
+        while len(_INDEXES) > MAX_INDEXES:
+            _INDEXES.popitem(last=False)
+    return index
+
+def gzip_header_strings(filename, keywords=None, hdus=None):
+    """Return the raw header of each HDU in a gzipped FITS file, like :func:`~pyobserver.fits.scan.scan_header_strings`.
+
+    :param string filename: The gzipped FITS file name.
+    :param keywords: If given, only return cards for these upper-case keywords.
+    :param int hdus: If given, stop inflating the file after this many headers.
+    :raises ValueError: If the file isn't a gzipped FITS file.
+
+    """
+    try:
+        with GzipStream(filename, gzip_index(filename)) as stream:
+            return [ header_cards(cards, keywords) for extent, cards in itertools.islice(iter_stream_extents(stream), hdus) ]
+    except zlib.error as e:
+        raise ValueError("Can't inflate '{}': {!s}".format(filename, e))
@@ -15,7 +15,7 @@ This module contains pythonic objects to represent FITS files, as well as the co
 Working with collections of headers
 -----------------------------------
 
-This is the primary working class for dealing with collections of FITS headers.
+This is the primary working class for dealing with collections of FITS headers. By default, it holds compact :class:`~pyobserver.fits.record.HeaderRecord` objects rather than full headers.
 
 .. autoclass:: FITSHeaderTable
     :members:
@@ -46,6 +46,13 @@ Groups can also include non-homogenous groups, which are generally lists of file
 .. autoclass:: ListFITSDataGroup
     :members:
     :inherited-members:
+
+Rollups
+*******
+A rollup groups the same headers at each level of a hierarchy of keywords, e.g. by ``OBJECT``, then by ``OBJECT`` and ``FILTER``, then by ``OBJECT``, ``FILTER`` and ``EXPTIME``, in a single pass.
+
+.. autoclass:: FITSDataRollup
+    :members:
     
 
 
@@ -58,6 +65,11 @@ from pyshell.util import query_yes_no, force_dir_path, collapseuser, check_exist
 
 import numpy as np
 
+from .scan import scan_headers, scan_header_strings
+from .record import HeaderRecord, LazyHeaderRecord
+from .aggregate import Aggregates
+from .inverted import typed
+
 try:
     import astropy.io.fits as pf
 except ImportError as e:
@@ -72,6 +84,9 @@ import re, ast
 import warnings, logging
 import datetime
 import collections
+import copy
+import functools
+import threading
 from textwrap import fill
 import six
 
@@ -91,22 +106,301 @@ def silent_getheader(filename):
         header.filename = filename
     return header, filename
 
-def silent_getheaders(filename, close=True):
+def silent_getheaders(filename, close=True, keywords=None):
     """Return a list of all headers. Ignore validation warnings and load warnings along the way.
     
     This is a wrapper function which silences warnings from PyFITS and produces a list of all of the headers in a single HDU List object.
     
     :param bool close: Whether to close the HDUlist
+    :param keywords: If given, only keep these keywords in each header. See :func:`projection`.
     """
     with warnings.catch_warnings():
         warnings.simplefilter("ignore")
-        hdulist = pf.open(filename,ignore_missing_end=True)
+        return _getheaders(filename, close=close, keywords=keywords)
+
+def _getheaders(filename, close=True, keywords=None):
+    """Return a list of all headers without touching the warnings filters.
+    
+    :func:`warnings.catch_warnings` is not thread-safe, so pooled readers call this function directly and silence warnings once, from the thread which owns the pool.
+    """
+    hdulist = pf.open(filename,ignore_missing_end=True)
+    if keywords is None:
         headers = [ hdu.header.copy() for hdu in hdulist ]
-        map(lambda h : setattr(h,'filename',filename), headers)
-        if close:
-            hdulist.close()
+    else:
+        headers = [ project_header(hdu.header, keywords) for hdu in hdulist ]
+    for header in headers:
+        header.filename = filename
+    if close:
+        hdulist.close()
     return [(header, filename) for header in headers]
 
+def _scanheaders(filename, keywords=None):
+    """Return a list of all headers using the block-level scanner in :mod:`~pyobserver.fits.scan`, without touching the warnings filters.
+    
+    Files which can't be scanned are read with :func:`astropy.io.fits.open` instead.
+    """
+    try:
+        return scan_headers(filename, keywords=keywords)
+    except Exception:
+        return _getheaders(filename, keywords=keywords)
+
+def silent_scanheaders(filename, keywords=None):
+    """Return a list of all headers using the block-level scanner, ignoring validation warnings. See :func:`silent_getheaders`."""
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        return _scanheaders(filename, keywords=keywords)
+
+def _rawheaders(filename, keywords=None):
+    """Return the raw cards of each header in `filename`, as ``(cards, filename)`` pairs, without touching the warnings filters.
+    
+    Files which can't be scanned are read with :func:`astropy.io.fits.open` instead, and converted back to cards.
+    """
+    try:
+        return [ (cards, filename) for cards in scan_header_strings(filename, keywords=keywords) ]
+    except Exception:
+        return [ (header.tostring(endcard=False, padding=False), filename) for header, filename in _getheaders(filename, keywords=keywords) ]
+
+def silent_rawheaders(filename, keywords=None):
+    """Return the raw cards of each header in `filename`, ignoring validation warnings. See :func:`silent_getheaders`."""
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        return _rawheaders(filename, keywords=keywords)
+
+def projection(keywords):
+    """Normalize a list of keywords for header projection.
+    
+    :param keywords: The keywords which are needed, or ``None`` for all keywords.
+    :return: A sorted list of upper-case keywords, always including ``FILENAME`` and ``OPENNAME``, or ``None``.
+    
+    """
+    if keywords is None:
+        return None
+    return sorted(set(six.text_type(keyword).upper() for keyword in keywords) | set(["FILENAME", "OPENNAME"]))
+
+def project_header(header, keywords):
+    """Return a new header containing only the cards for `keywords` (which should come from :func:`projection`)."""
+    if isinstance(header, LazyHeaderRecord):
+        return header.project(keywords)
+    keep = set(keywords)
+    projected = pf.Header([ card for card in header.cards if card.keyword.upper() in keep ])
+    if hasattr(header, 'filename'):
+        projected.filename = header.filename
+    return projected
+
+POOLS = ('thread', 'process')
+
+BACKENDS = {
+    'astropy' : (silent_getheaders, _getheaders),
+    'scan' : (silent_scanheaders, _scanheaders),
+}
+"""Header readers, as a pair of functions which do and don't silence warnings."""
+
+_READERS = dict(BACKENDS, raw=(silent_rawheaders, _rawheaders))
+"""All header readers, including the ``'raw'`` reader used for lazy headers, which returns card strings."""
+
+def pool_getheaders(files, workers=None, pool='thread', backend='astropy', keywords=None):
+    """Read all of the headers from each file in `files`, using a pool of workers.
+    
+    :param files: The list of file names to be loaded.
+    :param int workers: The number of workers to use. If ``None`` or ``1``, files are read serially.
+    :param string pool: The kind of pool, either ``'thread'`` (best when reading is I/O bound, e.g. on network filesystems) or ``'process'`` (best when parsing headers is CPU bound).
+    :param string backend: The header reader, either ``'astropy'`` or ``'scan'``. See :data:`BACKENDS`.
+    :param keywords: If given, only keep these keywords in each header. See :func:`projection`.
+    :return: A list, in the same order as `files`, of the lists returned by :func:`silent_getheaders`.
+    
+    """
+    files = list(files)
+    try:
+        silent_reader, reader = _READERS[backend]
+    except KeyError:
+        raise ValueError("Unknown header backend '{}', expected one of {}".format(backend, ", ".join(sorted(BACKENDS))))
+    if keywords is not None:
+        silent_reader = functools.partial(silent_reader, keywords=keywords)
+        reader = functools.partial(reader, keywords=keywords)
+    
+    if workers is None or workers <= 1 or len(files) <= 1:
+        return [ silent_reader(filename) for filename in files ]
+    
+    if pool == 'thread':
+        from multiprocessing.pool import ThreadPool as Pool
+    elif pool == 'process':
+        from multiprocessing.pool import Pool
+        reader = silent_reader
+    else:
+        raise ValueError("Unknown pool type '{}', expected one of {}".format(pool, ", ".join(POOLS)))
+    
+    workers = min(workers, len(files))
+    chunksize = max(1, len(files) // (4 * workers))
+    workpool = Pool(workers)
+    try:
+        # Threads share the warnings filters with this thread, so they are only set here.
+        # Processes each get their own filters, and so use the silent reader directly.
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            results = workpool.map(reader, files, chunksize)
+    finally:
+        workpool.close()
+        workpool.join()
+    return results
+
+def iter_headers(files, workers=None, pool='thread', backend='astropy', keywords=None, records=True, lazy=False):
+    """Iterate over the headers in each file in `files`, without keeping them all in memory.
+    
+    :param files: The file names to be loaded.
+    :param int workers: The number of workers to use. If ``None`` or ``1``, files are read serially, one at a time.
+    :param string pool: The kind of pool, either ``'thread'`` or ``'process'``. See :func:`pool_getheaders`.
+    :param string backend: The header reader, either ``'astropy'`` or ``'scan'``. See :data:`BACKENDS`.
+    :param keywords: If given, only keep these keywords in each header. See :func:`projection`.
+    :param bool records: Whether to produce compact :class:`~pyobserver.fits.record.HeaderRecord` objects, or full headers.
+    :param bool lazy: Whether to produce :class:`~pyobserver.fits.record.LazyHeaderRecord` objects, which only parse cards when they are used.
+    :return: A generator of headers, in the same order as `files`, labeled as by :meth:`FITSHeaderTable.read`.
+    
+    Each header is only held until the consumer discards it, so a pipeline like ``groups.update(query.filter(iter_headers(files)))`` only keeps the headers which match. With a pool of workers, files are read in chunks of four files per worker, and only one chunk of headers is held at a time.
+    """
+    files = list(files)
+    keywords = projection(keywords)
+    if lazy:
+        backend = 'raw'
+    try:
+        silent_reader, reader = _READERS[backend]
+    except KeyError:
+        raise ValueError("Unknown header backend '{}', expected one of {}".format(backend, ", ".join(sorted(BACKENDS))))
+    if keywords is not None:
+        silent_reader = functools.partial(silent_reader, keywords=keywords)
+        reader = functools.partial(reader, keywords=keywords)
+    
+    if workers is None or workers <= 1 or len(files) <= 1:
+        for file in files:
+            for hdu, (header, filename) in enumerate(_lazy(silent_reader(file)) if lazy else silent_reader(file)):
+                yield _label_header(header, file, hdu, records)
+        return
+    
+    if pool == 'thread':
+        from multiprocessing.pool import ThreadPool as Pool
+    elif pool == 'process':
+        from multiprocessing.pool import Pool
+        reader = silent_reader
+    else:
+        raise ValueError("Unknown pool type '{}', expected one of {}".format(pool, ", ".join(POOLS)))
+    
+    workers = min(workers, len(files))
+    chunksize = 4 * workers
+    workpool = Pool(workers)
+    try:
+        for start in range(0, len(files), chunksize):
+            chunk = files[start:start + chunksize]
+            # Workers only run while warnings are silenced, and never while headers are being yielded, see pool_getheaders.
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore")
+                results = workpool.map(reader, chunk)
+            for file, headers in zip(chunk, results):
+                for hdu, (header, filename) in enumerate(_lazy(headers) if lazy else headers):
+                    yield _label_header(header, file, hdu, records)
+    finally:
+        workpool.terminate()
+        workpool.join()
+
+def _lazy(headers):
+    """Convert a list of ``(cards, filename)`` pairs from the ``'raw'`` reader into lazy header records."""
+    return [ (LazyHeaderRecord(cards, filename, hdu), filename) for hdu, (cards, filename) in enumerate(headers) ]
+
+def _group_shard(args):
+    """Group the headers in a single shard of files. See :func:`shard_group`."""
+    files, keywords, formats, query, aggregates, rollup, options = args
+    headers = iter_headers(files, **options)
+    if query is not None:
+        headers = query.filter(headers)
+    groups = FITSDataRollup if rollup else FITSDataGroups
+    return groups(keywords, formats, aggregates=aggregates).update(headers)
+
+def shard_group(shards, keywords, key_fmt=None, query=None, workers=None, projection=None, aggregates=None, rollup=False, **options):
+    """Group several shards of files (e.g. one per night directory) in separate processes, and merge the results.
+    
+    :param shards: A list of lists of file names.
+    :param keywords: The keywords used to group the files.
+    :param key_fmt: An optional list of format strings for each keyword.
+    :param query: An optional :class:`~pyobserver.fits.query.Query`, used to filter headers before they are grouped.
+    :param int workers: The number of processes. If ``None`` or ``1``, shards are grouped serially.
+    :param projection: If given, only read these keywords from each header (the `keywords` argument of :func:`iter_headers`).
+    :param aggregates: Optional aggregates to compute for each group, see :meth:`FITSHeaderTable.group`.
+    :param bool rollup: If set, group by each level of the hierarchy of `keywords`, and return a :class:`FITSDataRollup`.
+    :param options: Other keyword arguments are passed to :func:`iter_headers`.
+    :return: A :class:`FITSDataGroups` object, as if the files had been grouped together.
+    
+    Each process returns its :class:`FITSDataGroups`, which are combined with :meth:`FITSDataGroups.merge` in the order of `shards`.
+    """
+    if key_fmt is None:
+        key_fmt = []
+    options['keywords'] = projection
+    tasks = [ (list(files), keywords, list(key_fmt), query, aggregates, rollup, options) for files in shards ]
+    groups = (FITSDataRollup if rollup else FITSDataGroups)(keywords, list(key_fmt), aggregates=aggregates)
+    if workers is None or workers <= 1 or len(tasks) <= 1:
+        results = map(_group_shard, tasks)
+    else:
+        from multiprocessing.pool import Pool
+        workpool = Pool(min(workers, len(tasks)))
+        try:
+            results = workpool.map(_group_shard, tasks, 1)
+        finally:
+            workpool.close()
+            workpool.join()
+    for result in results:
+        groups.merge(result)
+    return groups
+
+def _label_header(header, file, hdu=0, records=False):
+    """Label `header` with its `file`: either convert it to a :class:`~pyobserver.fits.record.HeaderRecord`, or add the ``FILENAME`` and ``OPENNAME`` cards for `file`, if they are missing."""
+    if isinstance(header, HeaderRecord):
+        return header
+    if records:
+        return HeaderRecord.fromheader(header, file, hdu)
+    if "FILENAME" not in header:
+        header["FILENAME"] = (os.path.basename(file), 'Original File name')
+    if "OPENNAME" not in header:
+        header["OPENNAME"] = (os.path.relpath(file), 'Opened File Name')
+    return header
+
+def _match_value(search, value, filename):
+    """Evaluate a regular expression or callable search against a single header value."""
+    if hasattr(search,'match'):
+        return bool(search.match(str(value)))
+    try:
+        return bool(search(value))
+    except Exception as e:
+        warnings.warn("Callable keyword search failed at file '{}': {}".format(filename, e))
+        return False
+
+def _match_header(header, keywords, memo=None):
+    """Check whether a single header matches :meth:`FITSHeaderTable.search` style `keywords`.
+    
+    :param memo: A dictionary mapping each keyword to a dictionary of results for regular expression and callable searches, by value and its kind (see :func:`~pyobserver.fits.inverted.typed`). Each search is only evaluated once for each distinct value.
+    """
+    for key,search in six.iteritems(keywords):
+        if key not in header and (search is not False):
+            warnings.warn("Couldn't find keyword '%s' in file '%s'" % (key,header.filename))
+            return False
+        elif hasattr(search,'match') or callable(search):
+            value = header[key]
+            results = memo.setdefault(key, {}) if memo is not None else {}
+            try:
+                keep = results[typed(value)]
+            except KeyError:
+                keep = results[typed(value)] = _match_value(search, value, header.filename)
+            except TypeError:
+                keep = _match_value(search, value, header.filename)
+            if not keep:
+                return False
+        elif isinstance(search,bool):
+            if search and key in header:
+                pass
+            elif (not search) and (key not in header):
+                header[key] = ""
+            else:
+                return False
+        elif search != header[key]:
+            return False
+    return True
+
 def readfilelist(filename):
     """Read a file list and provide the list of files."""
     dirname = os.path.dirname(filename)
@@ -136,7 +430,7 @@ class FITSHeaderTable(list):
         
     def __setitem__(self, key, value):
         """Set a list item, ensuring it is a header, and that it understands its own filename."""
-        if not isinstance(value, pf.header):
+        if not isinstance(value, (pf.Header, HeaderRecord)):
             raise TypeError("FITSHeaderTables should contain only FITS Headers. Got '{}' instead".format(type(value)))
         if not hasattr(value, 'filename'):
             if "OPENNAME" in value:
@@ -174,58 +468,142 @@ class FITSHeaderTable(list):
         """Return a copy of this object."""
         return self.__class__([ hdr for hdr in self ])
     
-    def read(self, files):
+    def promoted(self):
+        """Iterate over a full :class:`~astropy.io.fits.Header` for each entry in this table.
+        
+        :class:`~pyobserver.fits.record.HeaderRecord` entries are promoted with :meth:`~pyobserver.fits.record.HeaderRecord.toheader` one at a time, as they are needed, and are not replaced in this table.
+        """
+        for header in self:
+            if isinstance(header, HeaderRecord):
+                header = header.toheader()
+            yield header
+    
+    def read(self, files, workers=None, pool='thread', index=None, backend='astropy', keywords=None, records=True, lazy=False):
         """Get FITS Headers from each file in `files`. This method will load all of the headers for each file (including FITS extension headers).
         
         :param files: The list of file names to be loaded.
+        :param int workers: The number of workers used to read files. By default, files are read serially.
+        :param string pool: The kind of worker pool, ``'thread'`` or ``'process'``. See :func:`pool_getheaders`.
+        :param index: A :class:`~pyobserver.fits.index.FITSHeaderIndex`. Files which haven't changed since they were indexed are loaded from the index, and all other files are read and then added to the index. The projected `keywords` are added to the index postings, and the table gets an inverted index (see :meth:`invert`) from the postings.
+        :param string backend: The header reader. ``'astropy'`` uses :func:`astropy.io.fits.open`, ``'scan'`` uses the faster :mod:`~pyobserver.fits.scan` module, and falls back to astropy for files which can't be scanned.
+        :param keywords: If given, only these keywords (and ``FILENAME`` and ``OPENNAME``) are kept in each header. With the ``'scan'`` backend, other cards are never parsed. Other keywords are missing from every header, so a :meth:`search` on them warns and matches nothing, unless it searches for headers without the keyword.
+        :param bool records: Whether to keep compact :class:`~pyobserver.fits.record.HeaderRecord` objects (the default), or full :class:`~astropy.io.fits.Header` objects with ``FILENAME`` and ``OPENNAME`` cards. See :meth:`promoted`.
+        :param bool lazy: Whether to keep :class:`~pyobserver.fits.record.LazyHeaderRecord` objects, which hold the raw header cards and only parse a card when its keyword is used. Lazy headers are always read with the ``'scan'`` backend.
         :return: `self` - this is an *in-place* operation.
         
+        Headers are appended in the same order as `files`, regardless of the number of workers.
+        
         """
+        files = list(files)
+        keywords = projection(keywords)
+        if index is not None:
+            # The index always holds complete headers, so that it can answer for any keywords later.
+            loaded, stale = index.lookup(files, keywords=keywords, lazy=lazy)
+            fresh = pool_getheaders(stale, workers=workers, pool=pool, backend='raw' if lazy else backend)
+            fresh = list(zip(stale, map(_lazy, fresh) if lazy else fresh))
+            index.update(fresh)
+            if keywords is not None:
+                fresh = [ (file, [ (project_header(header, keywords), filename) for header, filename in headers ]) for file, headers in fresh ]
+        else:
+            loaded = {}
+            fresh = pool_getheaders(files, workers=workers, pool=pool, backend='raw' if lazy else backend, keywords=keywords)
+            fresh = list(zip(files, map(_lazy, fresh) if lazy else fresh))
+        loaded.update(fresh)
+        
+        start = len(self)
+        locations = collections.defaultdict(list)
         for file in files:
-            headers = silent_getheaders(file)
-            for header, filename in headers:
-                if "FILENAME" not in header:
-                    header["FILENAME"] = (os.path.basename(file), 'Original File name')
-                if "OPENNAME" not in header:
-                    header["OPENNAME"] = (os.path.relpath(file), 'Opened File Name')
-                self.append(header)
+            for hdu, (header, filename) in enumerate(loaded[file]):
+                locations[(os.path.abspath(file), hdu)].append(len(self))
+                self.append(_label_header(header, file, hdu, records))
+        
+        if index is not None and start == 0:
+            if keywords is not None:
+                index.post([ keyword for keyword in keywords if keyword not in ("FILENAME", "OPENNAME") ])
+            self._inverted = index.inverted(locations, len(self))
+            self._inverted.bind(self)
         return self
     
     @classmethod
-    def fromfiles(cls, files):
+    def fromfiles(cls, files, workers=None, pool='thread', index=None, backend='astropy', keywords=None, records=True, lazy=False):
         """Create a :class:`FITSHeaderTable` from a list of files using :meth:`read`.
         
         :param files: The list of file names to be loaded.
+        :param int workers: The number of workers used to read files.
+        :param string pool: The kind of worker pool, ``'thread'`` or ``'process'``.
+        :param index: A :class:`~pyobserver.fits.index.FITSHeaderIndex` to consult before reading files.
+        :param string backend: The header reader, ``'astropy'`` or ``'scan'``.
+        :param keywords: If given, only keep these keywords in each header.
+        :param bool records: Whether to keep compact header records, or full headers.
+        :param bool lazy: Whether to keep lazy header records, which only parse the cards which are used.
         :return: A new :class:`FITSHeaderTable` object.
         
         """
         obj = cls()
-        obj.read(files)
+        obj.read(files, workers=workers, pool=pool, index=index, backend=backend, keywords=keywords, records=records, lazy=lazy)
         return obj
     
     
-    def normalize(self,keywords,blank="",warn=True,error=False):
-        """Collect and normalize a set of headers by keyword.
+    def columns(self, keywords=None):
+        """Convert this table into a columnar :class:`~pyobserver.fits.columns.FITSHeaderColumns` object, which can be searched, grouped and tabulated much faster for large collections of headers.
+        
+        :param keywords: The keywords to convert into columns. By default, every keyword is used.
+        :return: A new :class:`~pyobserver.fits.columns.FITSHeaderColumns` object.
+        
+        """
+        from .columns import FITSHeaderColumns
+        return FITSHeaderColumns.fromheaders(self, keywords)
+    
+    @classmethod
+    def fromcolumns(cls, columns):
+        """Create a :class:`FITSHeaderTable` from a columnar :class:`~pyobserver.fits.columns.FITSHeaderColumns` object.
+        
+        :param columns: The :class:`~pyobserver.fits.columns.FITSHeaderColumns` object.
+        :return: A new :class:`FITSHeaderTable` object.
+        
+        """
+        return columns.toheaders(cls)
+    
+    def normalize(self,keywords,blank=None,warn=True,error=False):
+        """Check that every header has a value for each keyword, without changing the headers.
         
         :param keywords: The keywords to search for.
-        :param string blank: The blank value fill missing keywords.
+        :param blank: Ignored. Headers are no longer filled in, missing values are masked in :meth:`table` instead.
         :param bool warn: Whether to raise a warning for missing keywords.
         :param bool error: Whether to raise a :exc:`KeyError` for missing keywords.
         :returns: A reference to this object.
         
-        This function ensures that each collected header contains a minimal value for every requested keyword. The minimum value is by default the empty string. The function will raise a warning if the requested keyword is not present."""
+        Missing keywords are collected with :meth:`missing`, and reported in a single warning (or exception) which gives the number of headers missing each keyword, and a few of the files, rather than one warning for each keyword in each file."""
+        report = self.missing(keywords)
+        if len(report) and (error or warn):
+            message = "Couldn't find " + "; ".join("keyword '{}' in {:d} headers (e.g. {})".format(key, count, ", ".join(samples))
+                for key, (count, samples) in six.iteritems(report))
+            if error:
+                raise KeyError(message)
+            warnings.warn(message)
+        return self
+    
+    def missing(self, keywords, samples=3):
+        """Count the headers which are missing each of `keywords`.
+        
+        :param keywords: The keywords to check.
+        :param int samples: The number of example files to keep for each keyword.
+        :returns: An ordered dictionary mapping each missing keyword to a tuple of the number of headers without it, and a list of up to `samples` distinct file names. Keywords which every header has are left out.
+        
+        """
         keywords = list(keywords)
         if "OPENNAME" not in keywords:
             keywords.append("OPENNAME")
+        counts = collections.Counter()
+        examples = collections.defaultdict(list)
         for header in self:
             for key in keywords:
                 if key not in header:
-                    if error:
-                        raise KeyError("Keyword '%s' not in file '%s'" % (key, header["OPENNAME"]))
-                    if warn:
-                        warnings.warn("Couldn't find keyword '%s' in file '%s'" % (key, header["OPENNAME"]))
-                    header[key] = blank
-        return self
+                    counts[key] += 1
+                    filename = getattr(header, 'filename', None) or "?"
+                    if len(examples[key]) < samples and filename not in examples[key]:
+                        examples[key].append(filename)
+        return collections.OrderedDict((key, (counts[key], examples[key])) for key in keywords if counts[key])
     
     def search(self,**keywords):
         """Search for headers that match specific keyword values.
@@ -239,63 +617,94 @@ class FITSHeaderTable(list):
         - A regular expression object from :func:`re.compile`, where :meth:`match` is used to match the compiled regular expression to the keyword value.
         - A boolean value. ``True`` means that you only want headers which have the specified keyword. ``False`` means you only want headers which **don't** have the specified keyword. For ``False``, the keyword value will be normalized to the empty string (for logging/listing purposes).
         
+        Regular expressions and callables are only evaluated once for each distinct value of a keyword, so they can be expensive without slowing down searches through many headers which share a few values. If this table has an inverted index (see :meth:`invert`), searches on indexed keywords are answered from the index, and only the remaining keywords are checked header-by-header.
+        
         """
         if "OPENNAME" not in keywords:
             keywords["OPENNAME"] = True
+        rows = range(len(self))
+        inverted = self.inverted_index
+        if inverted is not None:
+            from .query import Predicate
+            mask = np.ones(len(self), dtype=bool)
+            for key in [ key for key in keywords if key in inverted and keywords[key] is not False ]:
+                if inverted.missing(key):
+                    warnings.warn("Couldn't find keyword '{}' in {:d} headers".format(key, inverted.missing(key)))
+                mask &= inverted.mask(Predicate.fromsearch(key, keywords.pop(key)))
+            rows = np.flatnonzero(mask)
         results = self.__class__()
-        for header in self:
-            keep = True
-            for key,search in keywords.iteritems():
-                if key not in header and (search is not False):
-                    warnings.warn("Couldn't find keyword '%s' in file '%s'" % (key,header.filename))
-                    keep = False
-                elif hasattr(search,'match'):
-                    if not search.match(str(header[key])):
-                        keep = False
-                elif callable(search):
-                    try:
-                        keep = search(header[key])
-                    except Exception as e:
-                        warnings.warn("Callable keyword search failed at file '{}': {}".format(header.filename, e))
-                        keep = False
-                
-                elif isinstance(search,bool):
-                    if search and key in header:
-                        pass
-                    elif (not search) and (key not in header):
-                        header[key] = ""
-                    else:
-                        keep = False
-                elif search == header[key]:
-                    pass
-                else:
-                    keep = False
-            if keep:
-                results.append(header)
+        memo = {}
+        for row in rows:
+            if _match_header(self[row], keywords, memo):
+                results.append(self[row])
         return results
     
-    def group(self, keywords, key_fmt=None):
+    def query(self, query):
+        """Search for headers which match a :class:`~pyobserver.fits.query.Query`.
+        
+        :param query: A :class:`~pyobserver.fits.query.Query`, or a list of query strings like ``["EXPTIME>=30", "FILTER!=Kbb"]``.
+        :returns: A new :class:`FITSHeaderTable` object filtered down.
+        
+        The query is evaluated as array operations over the columns of the keywords it uses, or with the inverted index (see :meth:`invert`) for indexed keywords. See :mod:`~pyobserver.fits.query` for the query syntax.
+        
+        """
+        from .query import Query
+        if not isinstance(query, Query):
+            query = Query.parse(query)
+        inverted = self.inverted_index
+        mask = query.mask(self.columns(query.unindexed(inverted)), index=inverted)
+        return self.__class__([ header for header, keep in zip(self, mask) if keep ])
+    
+    def invert(self, keywords):
+        """Build an inverted index for `keywords`, which :meth:`search` and :meth:`query` will use automatically.
+        
+        :param keywords: The keywords to index.
+        :return: The :class:`~pyobserver.fits.inverted.InvertedIndex`.
+        
+        The index is discarded if the headers in this table are added, removed or re-ordered. It is not updated if the header values change.
+        
+        """
+        from .inverted import InvertedIndex
+        self._inverted = InvertedIndex.fromheaders(self, keywords)
+        return self._inverted
+    
+    @property
+    def inverted_index(self):
+        """The :class:`~pyobserver.fits.inverted.InvertedIndex` for this table, or ``None`` if there isn't a valid one."""
+        inverted = getattr(self, '_inverted', None)
+        if inverted is not None and not inverted.valid(self):
+            self._inverted = inverted = None
+        return inverted
+    
+    def group(self, keywords, key_fmt=None, aggregates=None, rollup=False):
         """Using a list of keywords, collect groups of headers for which the value of each specified keyword matches among the whole group. This is done using a :class:`FITSDataGroups` object, and such an object is returned. :class:`FITSDataGroups` objects behave like sets, and so can be iterated over. To access individual elements, use the :meth:`FITSDataGroups.get` method.
         
         :param list keywords: This should be a list of keywords which will be used to group the FITS headers.
         :param list key_fmt: This is an optional list of format strings to control the pretty-printing of each header keyword.
+        :param aggregates: Optional aggregates to compute for each group while grouping, e.g. ``{"EXPTIME" : "sum", "DATE-OBS" : ("min", "max")}``. See :class:`~pyobserver.fits.aggregate.Aggregates`.
+        :param bool rollup: If set, group by each level of the hierarchy of `keywords` (the first keyword, the first two keywords, and so on) in the same pass, and return a :class:`FITSDataRollup`.
         :return: A :class:`FITSDataGroups` object.
         
         """
         if key_fmt is None:
             key_fmt = []
-        groups = FITSDataGroups(keywords,key_fmt)
+        if rollup:
+            groups = FITSDataRollup(keywords,key_fmt,aggregates=aggregates)
+        else:
+            groups = FITSDataGroups(keywords,key_fmt,aggregates=aggregates)
         for header in self:
             groups.add(header)
         return groups
     
     def table(self, order=None):
-        """Create a log-file like list of strings from a collection.
+        """Create an :class:`astropy.table.Table` of header values from this collection, with a ``file`` column and a column for each keyword.
         
-        :param collection: The collection to use. If ``None``, use the current internal collection.
+        :param order: The keywords to include, in column order. By default, every keyword in the first header is included, in alphabetical order.
         
+        Each column is built as a typed :mod:`numpy` array in a single pass over the headers (see :class:`~pyobserver.fits.columns.ColumnBuilder`). Headers which are missing a keyword are masked in that column.
         """
         from astropy.table import Table
+        from .columns import ColumnBuilder
         
         if order is None:
             order = self[0].keys()
@@ -308,29 +717,50 @@ class FITSHeaderTable(list):
         header_list = [str("file")] + order
         header_list = map(str, header_list)
         
-        data_list = [ [ header[key] for header in self ] for key in key_list ]
+        builders = [ ColumnBuilder(name, len(self)) for name in header_list ]
+        for row, header in enumerate(self):
+            for builder, key in zip(builders, key_list):
+                builder[row] = header.get(key, None)
         
-        table = Table(data_list, names = header_list)
+        table = Table([ builder.column() for builder in builders ])
         return table
 
+def _masked_column(name, values):
+    """Make a table column from `values`, where ``None`` values are masked."""
+    from astropy.table import MaskedColumn
+    fill = next((value for value in values if value is not None), 0)
+    return MaskedColumn(name=str(name), data=[ fill if value is None else value for value in values ],
+        mask=[ value is None for value in values ])
+
 class FITSDataGroups(collections.MutableSet):
     """A set of FITS data groups, defined by the operable `keywords`. The set of `keywords` will have identical values for each group.
     
     :param list keywords: A list of FITS header keywords to use to group files.
     :param list formats: A list of format strings (new-style), which take a single argument (the keyword value) and convert it to an appropriate string.
+    :param aggregates: Optional aggregates to compute for each group, as an :class:`~pyobserver.fits.aggregate.Aggregates` object or a mapping of expressions to operations.
     
     When `formats` is not provided, ``{!s}`` is used. If `formats` is shorter than `keywords`, any extra values will be filled in by the :attr:`EMPTYFORMAT` attribute.
     
     This object will behave like a mutable set of FITS header objects. New header objects can be added to the set. When they are added, they will either become a member of an existing group, or will create a new group.
     
+    Groups are stored by their *key*, the tuple of keyword values (see :meth:`key`), so adding a header or checking whether a group exists doesn't depend on the number of groups. Groups can also be found by their string hash (see :meth:`hashes`) or by their name. Headers can be added from several threads at once.
+    
+    Aggregates are updated as each header is added, so they don't require a second pass over the headers. They are reported by :meth:`aggregate` and as extra columns by :meth:`table`.
+    
     """
     
     EMPTYFORMAT = "{!s}"
     
-    def __init__(self, keywords, formats="{!s}", md5=False):
+    def __init__(self, keywords, formats="{!s}", md5=False, aggregates=None):
         super(FITSDataGroups, self).__init__()
         self._md5 = md5
+        if aggregates is not None and not isinstance(aggregates, Aggregates):
+            aggregates = Aggregates(aggregates)
+        self._aggregates = aggregates
         self._groups = {}
+        self._hashes = {}
+        self._names = {}
+        self._lock = threading.RLock()
         self._keywords = keywords
         if isinstance(formats, list):
             _formats = formats
@@ -348,7 +778,8 @@ class FITSDataGroups(collections.MutableSet):
     
     def __iter__(self):
         """Iterable"""
-        return self._groups.itervalues()
+        with self._lock:
+            return iter(list(self._groups.values()))
     
     def __len__(self):
         """Length"""
@@ -359,15 +790,15 @@ class FITSDataGroups(collections.MutableSet):
         
         pyfits header
         dictionary of header keywords and values
+        tuple of keyword values
         string keyhash
         string groupname
         string filename
         """
-        hhash = self._make_hash(item)
-        if hhash not in self.hashes:
-            return hhash in [group.name for group in self]
-        else:
-            return hhash in self.hashes
+        try:
+            return self._find(item) is not None
+        except (KeyError, TypeError):
+            return False
     
     @property
     def keywords(self):
@@ -382,8 +813,27 @@ class FITSDataGroups(collections.MutableSet):
     @property
     def hashes(self):
         """The list of hashes of data groups."""
-        return self._groups.keys()
+        return list(self._hashes.keys())
+    
+    @property
+    def aggregates(self):
+        """The :class:`~pyobserver.fits.aggregate.Aggregates` computed for each group, or ``None``."""
+        return self._aggregates
+    
+    def aggregate(self, item):
+        """The aggregate values for a group.
+        
+        :param item: A group, or anything which can be used to look up a group (see :meth:`get`).
+        :return: An ordered dictionary mapping aggregate column names to values, which is empty if there are no aggregates.
         
+        """
+        if self._aggregates is None:
+            return collections.OrderedDict()
+        group = item if isinstance(item, FITSDataGroup) else self.get(item)
+        if group is None:
+            raise KeyError("No group for {!r}".format(item))
+        return self._aggregates.result(group._accumulated)
+    
     @property
     def homogenous(self):
         """Whether this object only contains homogenous groups."""
@@ -392,11 +842,17 @@ class FITSDataGroups(collections.MutableSet):
     def get(self,hhash,value=None):
         """Return a specific data group, by hash.
         
-        :param string hhash: The desired group's hash value.
+        :param hhash: The desired group's hash value, key tuple or name.
         :param value: A default value to return.
         
         """
-        return self._groups.get(hhash,value)
+        try:
+            key = self._find(hhash)
+        except (KeyError, TypeError):
+            key = None
+        if key is None:
+            return value
+        return self._groups[key]
     
     def addlist(self, filename, asgroup=True):
         """Add a list of files as a :class:`ListFITSDataGroup`, where the files don't have to be a true homogenous group.
@@ -423,10 +879,14 @@ class FITSDataGroups(collections.MutableSet):
         """
         headers = list(headers)
         header = headers.pop()
-        masterhash = self._build_hash(header)
-        for header in headers:
-            if self._build_hash(header) != masterhash:
-                return False
+        try:
+            masterkey = self.key(header)
+            for header in headers:
+                if self.key(header) != masterkey:
+                    return False
+        except KeyError:
+            # Headers which are missing a keyword can't be part of a homogenous group.
+            return False
         return True
     
     def hasgroup(self, *headers):
@@ -437,9 +897,9 @@ class FITSDataGroups(collections.MutableSet):
         
         """
         if self.isgroup(*headers):
-            khash = self._build_hash(headers[0])
-            if khash in self:
-                incfiles = self.get(khash).files
+            key = self.key(headers[0])
+            if key in self._groups:
+                incfiles = self._groups[key].files
                 incfiles.sort()
                 hfiles = [ header.filename for header in headers ]
                 hfiles.sort()
@@ -452,8 +912,7 @@ class FITSDataGroups(collections.MutableSet):
         :param item: Any item which can be made into a group hash. (see :meth:`add`)
         
         """
-        khash = self._make_hash(item)
-        return isinstance(self._groups[khash],ListFITSDataGroup)
+        return isinstance(self._groups[self._find(item)],ListFITSDataGroup)
     
     def addmany(self, *items):
         """Add many items simultaneously.
@@ -476,22 +935,101 @@ class FITSDataGroups(collections.MutableSet):
         - A filename to an existing FITS file.
         - A :class:`~astropy.io.fits.hdu.Header` object.
         - A dictionary mapping that looks like a header.
+        - A :class:`FITSDataGroup`, which must not already exist.
         
+        This method is thread-safe.
         """
         
         if isinstance(item, FITSDataGroup):
-            if item.keyhash not in self:
-                self._groups[item.keyhash] = item
-                return item.keyhash
+            key = self._group_key(item)
+            with self._lock:
+                if key in self._groups:
+                    raise KeyError("DataGroup with hash {} already exists.".format(item.keyhash))
+                if self._aggregates is not None:
+                    item._accumulated = self._aggregates.extend(self._aggregates.start(), item)
+                self._insert(key, item)
+            return item.keyhash
+        
+        if isinstance(item, six.string_types):
+            item = self._load(item)
+        key = self.key(item)
+        with self._lock:
+            group = self._groups.get(key)
+            if group is None:
+                group = FITSDataGroup(item, self._build_hash(item), self.keywords, self.formats, key=key)
+                if self._aggregates is not None:
+                    group._accumulated = self._aggregates.start()
+                self._insert(key, group)
             else:
-                raise KeyError("DataGroup with hash {} already exists.".format(item.keyhash))
+                group.append(item)
+            if self._aggregates is not None:
+                self._aggregates.add(group._accumulated, item)
+        return group.keyhash
+    
+    def update(self, headers):
+        """Add each header from an iterable of `headers`, one at a time.
+        
+        :param headers: Any iterable of items which can be added with :meth:`add`, such as a generator from :func:`iter_headers`.
+        :return: A reference to this object.
         
-        hhash = self._make_hash(item)
-        if item not in self:
-            self._groups[hhash] = FITSDataGroup(item, hhash, self.keywords, self.formats)
+        Headers are added as they are produced, so `headers` is never collected into a list.
+        """
+        for header in headers:
+            self.add(header)
+        return self
+    
+    def _insert(self, key, group):
+        """Insert a new group, and index it by hash and by name. The lock must be held."""
+        self._groups[key] = group
+        self._hashes[group.keyhash] = key
+        self._names.setdefault(group.name, key)
+    
+    def key(self, item):
+        """The key of the group for `item`: a tuple of the values of each of the :attr:`keywords`.
+        
+        :param item: A header, or a mapping that looks like a header.
+        :return: The tuple of keyword values, each as a ``(kind, value)`` pair.
+        
+        Values are paired with their kind (see :func:`~pyobserver.fits.inverted.typed`), so values which compare equal but are written differently in a header, like ``30`` and ``30.0``, are in different groups.
+        """
+        return tuple(typed(item[keyword]) for keyword in self._keywords)
+    
+    def _group_key(self, group):
+        """The key for a :class:`FITSDataGroup`."""
+        if isinstance(group, ListFITSDataGroup):
+            return group.keyhash
+        if group.key is None:
+            group._key = self.key(group[0])
+        return group.key
+    
+    def _load(self, filename):
+        """Load the header of a FITS file, to find its group."""
+        if check_exists(filename) and filename.endswith(".fits"):
+            header, filename = silent_getheader(filename)
+            return header
+        raise TypeError("Can't convert {} to Header Hash".format(type(filename)))
+    
+    def _find(self, item):
+        """Find the key of the group for `item`, or ``None`` if there isn't one.
+        
+        :param item: A group, a header, a key tuple (see :meth:`key`) or a plain tuple of keyword values, a string hash, a group name or a FITS file name.
+        
+        """
+        if isinstance(item, FITSDataGroup):
+            key = self._group_key(item)
+        elif isinstance(item, tuple):
+            key = item if item in self._groups else tuple(typed(value) for value in item)
+        elif isinstance(item, six.string_types):
+            if item in self._hashes:
+                return self._hashes[item]
+            if item in self._names:
+                return self._names[item]
+            if item in self._groups:
+                return item
+            key = self.key(self._load(item))
         else:
-            self._groups[hhash].append(item)
-        return hhash
+            key = self.key(item)
+        return key if key in self._groups else None
     
     def _make_hash(self, item):
         """Convert an item into a hash for this object. This method is mostly used internally, but can be used to get the hash of any item as it would be constructed by this grouping.
@@ -511,8 +1049,8 @@ class FITSDataGroups(collections.MutableSet):
             return item.keyhash
         
         if isinstance(item, six.string_types) and check_exists(item) and item.endswith(".fits"):
-            item = silent_getheader(item)
-        if isinstance(item, pf.header.Header) or isinstance(item, collections.Mapping):
+            item = self._load(item)
+        if isinstance(item, (pf.header.Header, HeaderRecord)) or isinstance(item, collections.Mapping):
             hhash = self._build_hash(item)
         elif isinstance(item, six.string_types):
             hhash = six.text_type(item)
@@ -531,18 +1069,73 @@ class FITSDataGroups(collections.MutableSet):
         if self._md5:
             import hashlib
             hashcontainer = hashlib.md5()
-            hashcontainer.update(value)
+            hashcontainer.update(value.encode("utf-8"))
             value = hashcontainer.hexdigest()
         return value
     
+    def merge(self, other):
+        """Merge the groups from `other` into this object.
+        
+        :param other: Another :class:`FITSDataGroups` object, with the same :attr:`keywords`.
+        :return: A reference to this object.
+        
+        Homogenous groups with the same key are combined, and new groups are copied, so `other` is not changed. List groups are only copied if this object doesn't have a list with the same name. This makes it possible to group separate collections of files (e.g. in separate processes) and combine the results, see :func:`shard_group`.
+        
+        Aggregates from `other` are combined with the aggregates in this object if they are the same, otherwise they are recomputed from the headers in each merged group.
+        """
+        if list(other.keywords) != list(self.keywords):
+            raise ValueError("Can't merge groups by {} into groups by {}".format(other.keywords, self.keywords))
+        aggregates = self._aggregates
+        with self._lock:
+            for group in other:
+                key = other._group_key(group)
+                if aggregates is None:
+                    accumulated = None
+                elif aggregates == other.aggregates:
+                    accumulated = copy.deepcopy(group._accumulated)
+                else:
+                    accumulated = aggregates.extend(aggregates.start(), group)
+                if isinstance(group, ListFITSDataGroup):
+                    if key in self._groups:
+                        continue
+                    merged = copy.copy(group)
+                    self._insert(key, merged)
+                elif key in self._groups:
+                    merged = self._groups[key]
+                    merged.extend(group)
+                    if accumulated is not None:
+                        aggregates.combine(merged._accumulated, accumulated)
+                    continue
+                else:
+                    merged = FITSDataGroup(group[0], self._build_hash(group[0]), self.keywords, self.formats, key=key)
+                    merged.extend(group[1:])
+                    self._insert(key, merged)
+                merged._accumulated = accumulated
+        return self
+    
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+    
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.RLock()
+    
     def discard(self, item):
         """Discard a group from this group set.
         
         :param item: Any item which can be used to look up a group.
         
         """
-        hhash = self._make_hash(item)
-        del self._groups[hhash]
+        with self._lock:
+            key = self._find(item)
+            if key is None:
+                raise KeyError("No group for {!r}".format(item))
+            group = self._groups.pop(key)
+            self._hashes.pop(group.keyhash, None)
+            if self._names.get(group.name) == key:
+                del self._names[group.name]
     
     def table(self, filter_homogenous=False):
         """Return a text table for this datagroup. See :meth:`output`.
@@ -561,7 +1154,7 @@ class FITSDataGroups(collections.MutableSet):
             
         groups.sort(key=lambda g : g.name)
         
-        result = Table([ group.keylist for group in groups ], names=map(str, self.keywords))
+        result = Table([ group.keylist for group in groups ], names=map(str, self.keywords), masked=self._aggregates is not None)
         
         name_column = Column(name=str("Name"), data=[ group.name for group in groups ])
         result.add_column(name_column, index=0)
@@ -569,8 +1162,16 @@ class FITSDataGroups(collections.MutableSet):
         number_column = Column(name=str("N"), data=[ len(group) for group in groups ])
         result.add_column(number_column)
         
+        if self._aggregates is not None:
+            aggregates = [ self.aggregate(group) for group in groups + list_groups ]
+            for name in self._aggregates.names:
+                values = [ aggregate[name] for aggregate in aggregates ]
+                result.add_column(_masked_column(name, values[:len(groups)]))
+        
         for lgroup in list_groups:
-            result.add_row({"Name":lgroup.name, "N":len(lgroup)})
+            row = {"Name":lgroup.name, "N":len(lgroup)}
+            row.update((str(name), value) for name, value in self.aggregate(lgroup).items() if value is not None)
+            result.add_row(row)
         
         return result
 
@@ -581,13 +1182,16 @@ class FITSDataGroup(FITSHeaderTable):
     :param keyhash: The full key hash that uniquely identifies this group.
     :param keywords: The keywords used to create the keyhash.
     :param formats: The formatting strings used for each keyword.
+    :param key: The tuple of keyword values for this group.
     
     """
-    def __init__(self,header,keyhash,keywords,formats):
+    def __init__(self,header,keyhash,keywords,formats,key=None):
         super(FITSDataGroup, self).__init__([header])
         self._keyhash = keyhash
         self._keywords = keywords
         self._formats = formats
+        self._key = key
+        self._accumulated = None
     
     @property
     def keywords(self):
@@ -604,6 +1208,11 @@ class FITSDataGroup(FITSHeaderTable):
         """The string hash value for this group."""
         return self._keyhash
     
+    @property
+    def key(self):
+        """The tuple of keyword values for this group, see :meth:`FITSDataGroups.key`."""
+        return self._key
+    
     @property
     def name(self):
         """A pretty-formatted name of this group, suitable as a filename."""
@@ -644,4 +1253,138 @@ class ListFITSDataGroup(FITSDataGroup):
         """The master list of keys. This could be arbitrary for a :class:`ListFITSDataGroup`. Instead, this property will raise a :exc:`ValueError`."""
         raise ValueError("The Master List of Keys can't be retrieved from a ListFITSDataGroup.")
 
-
+class FITSDataRollup(object):
+    """Nested groups for a hierarchy of keywords, built in a single pass over the headers.
+    
+    :param list keywords: The hierarchy of keywords, from the outermost to the innermost, e.g. ``["OBJECT", "FILTER", "EXPTIME"]``.
+    :param list formats: A list of format strings for each keyword, see :class:`FITSDataGroups`.
+    :param aggregates: Optional aggregates to compute for the groups at every level, see :class:`FITSDataGroups`.
+    
+    There is one :class:`FITSDataGroups` object for each level of the hierarchy, grouping by the first one, two, three, etc. keywords. Each header is added to every level as it is read, so the subtotals at every level come from the same scan. Levels are numbered from one, and can be retrieved with :meth:`level`. The innermost level is the same as grouping by every keyword.
+    
+    """
+    
+    def __init__(self, keywords, formats="{!s}", aggregates=None):
+        super(FITSDataRollup, self).__init__()
+        if not len(keywords):
+            raise ValueError("A rollup requires at least one keyword.")
+        if aggregates is not None and not isinstance(aggregates, Aggregates):
+            aggregates = Aggregates(aggregates)
+        if not isinstance(formats, list):
+            formats = [formats]
+        self._keywords = list(keywords)
+        self._levels = [ FITSDataGroups(self._keywords[:n], list(formats[:n]), aggregates=aggregates) for n in range(1, len(self._keywords) + 1) ]
+    
+    def __repr__(self):
+        """Representation of this object."""
+        return "<{:s} {:s}>".format(self.__class__.__name__, " > ".join(self._keywords))
+    
+    def __len__(self):
+        """The number of levels in this rollup."""
+        return len(self._levels)
+    
+    def __iter__(self):
+        """Iterate over the :class:`FITSDataGroups` for each level, from the outermost."""
+        return iter(self._levels)
+    
+    @property
+    def keywords(self):
+        """The hierarchy of keywords."""
+        return self._keywords
+    
+    @property
+    def aggregates(self):
+        """The :class:`~pyobserver.fits.aggregate.Aggregates` computed for each group, or ``None``."""
+        return self._levels[0].aggregates
+    
+    def level(self, level):
+        """The :class:`FITSDataGroups` for a level, where level ``1`` is grouped by the first keyword, and the last level is grouped by every keyword."""
+        if level < 1:
+            raise IndexError("Rollup levels start at 1, not {:d}".format(level))
+        return self._levels[level - 1]
+    
+    def add(self, item):
+        """Add a header to every level. See :meth:`FITSDataGroups.add`.
+        
+        :return: The hash of the innermost group to which this item was added.
+        """
+        if isinstance(item, six.string_types):
+            item = self._levels[0]._load(item)
+        for groups in self._levels:
+            keyhash = groups.add(item)
+        return keyhash
+    
+    def update(self, headers):
+        """Add each header from an iterable of `headers`, one at a time. See :meth:`FITSDataGroups.update`."""
+        for header in headers:
+            self.add(header)
+        return self
+    
+    def addlist(self, filename):
+        """Add a list of files to the innermost level, see :meth:`FITSDataGroups.addlist`."""
+        return self._levels[-1].addlist(filename)
+    
+    def merge(self, other):
+        """Merge each level of another :class:`FITSDataRollup` into this object. See :meth:`FITSDataGroups.merge`."""
+        if list(other.keywords) != list(self.keywords):
+            raise ValueError("Can't merge a rollup by {} into a rollup by {}".format(other.keywords, self.keywords))
+        for groups, ogroups in zip(self._levels, other):
+            groups.merge(ogroups)
+        return self
+    
+    def children(self, group):
+        """The groups at the next level which are part of `group`, sorted by name.
+        
+        :param group: A homogenous group from any level but the innermost.
+        
+        """
+        depth = len(group.keywords)
+        if depth >= len(self._levels):
+            return []
+        key = self._levels[depth - 1]._group_key(group)
+        return sorted([ child for child in self._levels[depth]
+            if not isinstance(child, ListFITSDataGroup) and child.key[:depth] == key ], key=lambda g : g.name)
+    
+    def walk(self):
+        """Walk the homogenous groups in hierarchy order, where each group is followed by the groups within it.
+        
+        :return: A generator of ``(level, group)`` pairs.
+        
+        """
+        children = [ collections.defaultdict(list) for groups in self._levels ]
+        for depth, groups in enumerate(self._levels):
+            for group in groups:
+                if not isinstance(group, ListFITSDataGroup):
+                    children[depth][groups._group_key(group)[:depth]].append(group)
+        stack = [ (1, group) for group in sorted(children[0][()], key=lambda g : g.name, reverse=True) ]
+        while len(stack):
+            level, group = stack.pop()
+            yield level, group
+            if level < len(self._levels):
+                below = children[level][self._levels[level - 1]._group_key(group)]
+                stack += [ (level + 1, child) for child in sorted(below, key=lambda g : g.name, reverse=True) ]
+    
+    def table(self):
+        """Return a table of the groups at every level, with a row for each group directly followed by the rows for the groups within it.
+        
+        The ``Level`` column gives the level of each row, and keywords below that level are masked. Lists added with :meth:`addlist` are added at the end, as in :meth:`FITSDataGroups.table`.
+        """
+        from astropy.table import Table, Column
+        
+        rows = list(self.walk())
+        innermost = self._levels[-1]
+        lists = sorted([ group for group in innermost if isinstance(group, ListFITSDataGroup) ], key=lambda g : g.name)
+        aggregates = [ self.level(level).aggregate(group) for level, group in rows ]
+        aggregates += [ innermost.aggregate(group) for group in lists ]
+        
+        result = Table(masked=True)
+        result.add_column(Column(name=str("Level"), data=[ level for level, group in rows ] + [ len(self._levels) ] * len(lists)))
+        result.add_column(Column(name=str("Name"), data=[ group.name for level, group in rows ] + [ group.name for group in lists ]))
+        for depth, keyword in enumerate(self._keywords):
+            values = [ group.key[depth][1] if depth < level else None for level, group in rows ]
+            result.add_column(_masked_column(keyword, values + [ None ] * len(lists)))
+        result.add_column(Column(name=str("N"), data=[ len(group) for level, group in rows ] + [ len(group) for group in lists ]))
+        if self.aggregates is not None:
+            for name in self.aggregates.names:
+                result.add_column(_masked_column(name, [ aggregate[name] for aggregate in aggregates ]))
+        return result
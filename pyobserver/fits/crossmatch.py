@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+#
+#  crossmatch.py
+#  pyobserver
+#
+#  Created by Alexander Rudy on 2014-06-25.
+#  Copyright 2014 Alexander Rudy. All rights reserved.
+#
+"""
+:mod:`fits.crossmatch` – Starlist targets with existing frames
+==============================================================
+
+Before an observing run, it helps to know which targets on a starlist already have data. :func:`target_frames` matches the targets from :func:`~pyobserver.starlist.parse_starlist` to the ``RA`` and ``DEC`` pointing of each header in a :class:`~pyobserver.fits.core.FITSHeaderTable`, using :func:`~pyobserver.fits.spatial.crossmatch`, and totals the frames, the integration time and the filters for each target.
+
+A frame is counted for every target within the tolerance of its pointing.
+
+.. autofunction:: target_frames
+
+.. autoclass:: TargetFrames
+    :members:
+
+"""
+from __future__ import (absolute_import, unicode_literals, division,
+                        print_function)
+
+import collections
+
+import numpy as np
+import six
+import astropy.units as u
+
+from .aggregate import Aggregates
+from .spatial import crossmatch, _degrees
+
+class TargetFrames(collections.namedtuple("TargetFrames", ["name", "ra", "dec", "frames", "exposure", "filters", "files"])):
+    """The frames which match a single target: the target `name` and position (`ra` and `dec` in degrees), the number of `frames`, the total `exposure` time (``None`` if no frame has one), an ordered dictionary of the number of frames in each of the `filters` (frames without a filter aren't included), and the list of `files`."""
+
+    __slots__ = ()
+
+def _target_position(target):
+    """The ICRS right ascension and declination of a starlist target, in degrees."""
+    position = target["Position"].icrs
+    return position.ra.degree, position.dec.degree
+
+def _pointings(headers, log=None):
+    """The headers which have an ``RA`` and ``DEC`` pointing, and arrays of their right ascensions and declinations in degrees."""
+    kept, ra, dec = [], [], []
+    for header in headers:
+        try:
+            pointing = [ _degrees(header[key]) for key in ("RA", "DEC") ]
+        except (KeyError, ValueError, TypeError) as e:
+            if log is not None:
+                log.debug("Skipping {!r}: {!s}".format(header.get("OPENNAME", header), e))
+            continue
+        kept.append(header)
+        ra.append(pointing[0])
+        dec.append(pointing[1])
+    return kept, np.array(ra, dtype=float), np.array(dec, dtype=float)
+
+def target_frames(targets, headers, tolerance=20 * u.arcsec, exposure="EXPTIME", filter="FILTER", log=None):
+    """Count the frames which were taken at each target.
+
+    :param targets: An iterable of targets, as parsed by :func:`~pyobserver.starlist.parse_starlist`.
+    :param headers: An iterable of headers, such as a :class:`~pyobserver.fits.core.FITSHeaderTable`. Headers without ``RA`` and ``DEC`` keywords are skipped.
+    :param tolerance: The largest separation between a target and a pointing, as an angle. Angles without units are in degrees.
+    :param string exposure: The exposure time keyword, or a product of keywords like ``ITIME*COADDS``. See :class:`~pyobserver.fits.aggregate.Aggregates`.
+    :param string filter: The filter keyword.
+    :param log: An optional logger, for headers which are skipped.
+    :return: A list of :class:`TargetFrames`, one for each target in the same order as `targets`.
+
+    """
+    targets = list(targets)
+    headers, ra, dec = _pointings(headers, log)
+    positions = [ _target_position(target) for target in targets ]
+    target_ra = np.array([ position[0] for position in positions ], dtype=float)
+    target_dec = np.array([ position[1] for position in positions ], dtype=float)
+    rows, frames, separations = crossmatch(target_ra, target_dec, ra, dec, tolerance)
+
+    totals = Aggregates([(exposure, "sum")])
+    results = []
+    bounds = np.searchsorted(rows, np.arange(len(targets) + 1))
+    for row, target in enumerate(targets):
+        matched = [ headers[frame] for frame in frames[bounds[row]:bounds[row + 1]] ]
+        state = totals.extend(totals.start(), matched)
+        filters = collections.Counter(six.text_type(header[filter]) for header in matched if header.get(filter, None) is not None)
+        results.append(TargetFrames(target["Name"], target_ra[row], target_dec[row], len(matched),
+            list(totals.result(state).values())[0], collections.OrderedDict(sorted(filters.items())),
+            [ header.get("OPENNAME", None) for header in matched ]))
+    return results
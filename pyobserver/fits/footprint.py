@@ -0,0 +1,291 @@
+# -*- coding: utf-8 -*-
+#
+#  footprint.py
+#  pyobserver
+#
+#  Created by Alexander Rudy on 2014-06-24.
+#  Copyright 2014 Alexander Rudy. All rights reserved.
+#
+"""
+:mod:`fits.footprint` – Sky footprints of FITS frames
+=====================================================
+
+A :class:`Footprint` is the patch of sky covered by a single frame. Frames with a celestial WCS and image dimensions have a footprint with four corners, from :meth:`astropy.wcs.WCS.calc_footprint`. Frames which only have ``RA`` and ``DEC`` keywords have a footprint which is a single point, the pointing.
+
+Footprints are bucketed into the same grid of cubic cells over the unit sphere as :class:`~pyobserver.fits.spatial.SkyIndex`, with cells about :data:`CELL` degrees across. Each footprint is stored in every cell which its bounding circle touches, and a search only looks at footprints in the cells which the search region touches. The :class:`~pyobserver.fits.index.FITSHeaderIndex` keeps the footprint and cells of every header it stores, so that ``PO cover`` can find frames without reading any files.
+
+.. autoclass:: Footprint
+    :members:
+
+.. autofunction:: cone_cells
+
+.. autofunction:: box_cone
+
+.. autodata:: CELL
+
+.. autodata:: EVERYWHERE
+
+"""
+from __future__ import (absolute_import, unicode_literals, division,
+                        print_function)
+
+import itertools
+import json
+import warnings
+
+import numpy as np
+import astropy.units as u
+
+try:
+    import astropy.io.fits as pf
+except ImportError as e:
+    try:
+        import pyfits as pf
+    except ImportError:
+        raise e
+
+from .spatial import unit_vectors, angular_separation, _chord, _degrees
+
+CELL = 0.25
+"""The size of each grid cell, in degrees."""
+
+EVERYWHERE = -1
+"""The cell number used for circles which are too large to bucket. Every search includes this cell."""
+
+MAX_CELLS = 50000
+"""The largest number of cells which :func:`cone_cells` will consider, before giving up and returning :data:`EVERYWHERE`."""
+
+def _cell_size(cell=CELL):
+    """The size of a grid cell, as a distance between unit vectors."""
+    return _chord(cell)
+
+def _pack(cells, size):
+    """Pack an ``(n, 3)`` array of integer cell coordinates into single integers, for storage."""
+    span = int(np.ceil(1.0 / size)) + 1
+    cells = np.asarray(cells, dtype=np.int64) + span
+    return ((cells[:,0] * (2 * span + 1)) + cells[:,1]) * (2 * span + 1) + cells[:,2]
+
+def cone_cells(ra, dec, radius, cell=CELL):
+    """The grid cells touched by a circle on the sky.
+
+    :param float ra: The right ascension of the center, in degrees.
+    :param float dec: The declination of the center, in degrees.
+    :param radius: The radius of the circle, as an angle. Angles without units are in degrees.
+    :param float cell: The size of each grid cell, in degrees.
+    :return: A sorted array of packed cell numbers, or an array of just :data:`EVERYWHERE` for very large circles.
+
+    Cells are included if any part of the cell is within the straight-line distance of the edge of the circle from its center, so the cells cover the circle, and some cells near it.
+    """
+    size = _cell_size(cell)
+    vector = unit_vectors(ra, dec)[0]
+    center = np.floor(vector / size).astype(np.int64)
+    reach = int(np.ceil(_chord(radius) / size))
+    if (2 * reach + 1) ** 3 > MAX_CELLS:
+        return np.array([EVERYWHERE], dtype=np.int64)
+    offsets = np.array(list(itertools.product(range(-reach, reach + 1), repeat=3)), dtype=np.int64)
+    cells = center + offsets
+    # Only keep cells which the circle could touch: those whose nearest point is within reach of the center.
+    nearest = np.clip(vector, cells * size, (cells + 1) * size)
+    keep = ((nearest - vector) ** 2).sum(axis=-1) <= (_chord(radius) + 1e-12) ** 2
+    return np.unique(_pack(cells[keep], size))
+
+def box_cone(ra_min, ra_max, dec_min, dec_max):
+    """A circle which covers a box in right ascension and declination.
+
+    :return: A tuple of the right ascension and declination of the center, and the radius, in degrees.
+
+    The box wraps through zero right ascension when `ra_min` is larger than `ra_max`.
+    """
+    width = _width(ra_min, ra_max)
+    ra = (ra_min + width / 2.0) % 360.0
+    dec = (dec_min + dec_max) / 2.0
+    steps = np.linspace(0.0, 1.0, 17)
+    edge_ra = np.concatenate((ra_min + steps * width, ra_min + steps * width, np.full(17, ra_min), np.full(17, ra_min + width)))
+    edge_dec = np.concatenate((np.full(17, dec_min), np.full(17, dec_max), dec_min + steps * (dec_max - dec_min), dec_min + steps * (dec_max - dec_min)))
+    separations = angular_separation(unit_vectors(edge_ra, edge_dec), unit_vectors(ra, dec)[0])
+    # The edges are sampled, so allow for the bulge of each edge between samples.
+    return ra, dec, min(np.degrees(separations.max()) * 1.01 + 1e-6, 180.0)
+
+def _width(ra_min, ra_max):
+    """The width of a range of right ascension, which wraps through zero when `ra_min` is larger than `ra_max`."""
+    return ra_max - ra_min if ra_min <= ra_max else ra_max - ra_min + 360.0
+
+def _in_box(ra, dec, ra_min, ra_max, dec_min, dec_max):
+    """Whether each position is inside a box. Right ascensions wrap through zero when `ra_min` is larger than `ra_max`."""
+    ra, dec = np.asarray(ra) % 360.0, np.asarray(dec)
+    if ra_min <= ra_max:
+        inside = (ra >= ra_min) & (ra <= ra_max)
+    else:
+        inside = (ra >= ra_min) | (ra <= ra_max)
+    return inside & (dec >= dec_min) & (dec <= dec_max)
+
+def _in_polygon(x, y, px, py):
+    """Whether each point ``(x, y)`` is inside the planar polygon with vertices ``(px, py)``."""
+    x, y = np.atleast_1d(x), np.atleast_1d(y)
+    inside = np.zeros(x.shape, dtype=bool)
+    for i in range(len(px)):
+        x0, y0, x1, y1 = px[i - 1], py[i - 1], px[i], py[i]
+        crosses = (y0 > y) != (y1 > y)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            inside ^= crosses & (x < (x1 - x0) * (y - y0) / (y1 - y0) + x0)
+    return inside
+
+def _segments_cross(a0, a1, b0, b1):
+    """Whether the planar segments ``a0-a1`` and ``b0-b1`` cross."""
+    def side(p, q, r):
+        return np.sign((q[0] - p[0]) * (r[1] - p[1]) - (q[1] - p[1]) * (r[0] - p[0]))
+    return side(a0, a1, b0) * side(a0, a1, b1) <= 0 and side(b0, b1, a0) * side(b0, b1, a1) <= 0
+
+class Footprint(object):
+    """The sky footprint of a single frame.
+
+    :param float ra: The right ascension of the center, in degrees.
+    :param float dec: The declination of the center, in degrees.
+    :param corners: An ``(n, 2)`` array of the right ascension and declination of each corner, in order around the footprint, or ``None`` for a single point.
+
+    """
+
+    def __init__(self, ra, dec, corners=None):
+        super(Footprint, self).__init__()
+        self.ra = float(ra) % 360.0
+        self.dec = float(dec)
+        self.corners = None if corners is None else np.asarray(corners, dtype=float).reshape(-1, 2)
+
+    def __repr__(self):
+        """Representation of this object."""
+        return "<{:s} ({:.5f}, {:.5f}) r={:.5f}>".format(self.__class__.__name__, self.ra, self.dec, self.radius)
+
+    def __eq__(self, other):
+        """Footprints are equal if they have the same center and corners."""
+        if not isinstance(other, Footprint) or (self.ra, self.dec) != (other.ra, other.dec):
+            return False
+        if self.corners is None or other.corners is None:
+            return self.corners is None and other.corners is None
+        return np.array_equal(self.corners, other.corners)
+
+    def __ne__(self, other):
+        return not self == other
+
+    @classmethod
+    def fromheader(cls, header):
+        """Make the footprint for a FITS header.
+
+        :param header: A FITS header, or any mapping of keywords to values.
+        :return: A new :class:`Footprint`, or ``None`` if the header has neither a celestial WCS nor ``RA`` and ``DEC`` keywords.
+
+        """
+        corners = None
+        if isinstance(header, pf.Header) and "NAXIS1" in header and "NAXIS2" in header:
+            corners = cls._wcs_corners(header)
+        if corners is not None:
+            return cls(corners[0][0], corners[0][1], corners[1])
+        try:
+            return cls(_degrees(header["RA"]), _degrees(header["DEC"]))
+        except (KeyError, ValueError, TypeError):
+            return None
+
+    @staticmethod
+    def _wcs_corners(header):
+        """The center and the corners of a header with a celestial WCS, or ``None``."""
+        from astropy.wcs import WCS
+        try:
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore")
+                wcs = WCS(header, relax=True)
+                if not wcs.has_celestial:
+                    return None
+                wcs = wcs.celestial
+                shape = (header["NAXIS1"], header["NAXIS2"])
+                corners = wcs.calc_footprint(axes=shape, center=False)
+                center = wcs.wcs_pix2world([[ (shape[0] + 1) / 2.0, (shape[1] + 1) / 2.0 ]], 1)[0]
+        except Exception:
+            return None
+        if not (np.isfinite(corners).all() and np.isfinite(center).all()):
+            return None
+        return center, corners
+
+    @property
+    def radius(self):
+        """The radius of the smallest circle around the center which covers the footprint, in degrees."""
+        if self.corners is None:
+            return 0.0
+        return float(np.degrees(angular_separation(unit_vectors(self.corners[:,0], self.corners[:,1]), unit_vectors(self.ra, self.dec)[0]).max()))
+
+    def cells(self, cell=CELL):
+        """The packed grid cells touched by this footprint. See :func:`cone_cells`."""
+        return cone_cells(self.ra, self.dec, self.radius, cell)
+
+    def separation(self, ra, dec):
+        """The angle between the center of this footprint and a position, in degrees."""
+        return float(np.degrees(angular_separation(unit_vectors(ra, dec), unit_vectors(self.ra, self.dec)[0])[0]))
+
+    def contains(self, ra, dec):
+        """Whether a position is inside this footprint. A single point footprint contains nothing."""
+        if self.corners is None:
+            return False
+        vertices = unit_vectors(self.corners[:,0], self.corners[:,1])
+        sides = np.cross(vertices, np.roll(vertices, -1, axis=0)).dot(unit_vectors(ra, dec)[0])
+        return bool((sides >= 0).all() or (sides <= 0).all())
+
+    def distance(self, ra, dec):
+        """The angle between a position and the nearest point of this footprint, in degrees. Positions inside the footprint are zero."""
+        if self.corners is None:
+            return self.separation(ra, dec)
+        if self.contains(ra, dec):
+            return 0.0
+        point = unit_vectors(ra, dec)[0]
+        vertices = unit_vectors(self.corners[:,0], self.corners[:,1])
+        distances = angular_separation(vertices, point)
+        for start, end in zip(vertices, np.roll(vertices, -1, axis=0)):
+            normal = np.cross(start, end)
+            length = np.sqrt(normal.dot(normal))
+            if length == 0.0:
+                continue
+            normal /= length
+            # The nearest point of the great circle is between the ends of the edge.
+            if np.cross(start, point).dot(normal) > 0 and np.cross(point, end).dot(normal) > 0:
+                distances = np.append(distances, np.arcsin(min(abs(point.dot(normal)), 1.0)))
+        return float(np.degrees(distances.min()))
+
+    def intersects_cone(self, ra, dec, radius):
+        """Whether this footprint overlaps a circle on the sky.
+
+        :param float ra: The right ascension of the center, in degrees.
+        :param float dec: The declination of the center, in degrees.
+        :param radius: The radius of the circle, as an angle. Angles without units are in degrees.
+
+        """
+        return self.distance(ra, dec) <= u.Quantity(radius, u.deg).value
+
+    def intersects_box(self, ra_min, ra_max, dec_min, dec_max):
+        """Whether this footprint overlaps a box in right ascension and declination, in degrees.
+
+        The box wraps through zero right ascension when `ra_min` is larger than `ra_max`. Footprints are compared to the box in right ascension and declination, so the edges of the footprint are treated as straight lines in those coordinates.
+        """
+        if self.corners is None:
+            return bool(_in_box(self.ra, self.dec, ra_min, ra_max, dec_min, dec_max))
+        if _in_box(self.corners[:,0], self.corners[:,1], ra_min, ra_max, dec_min, dec_max).any():
+            return True
+        # Unwrap right ascensions around the middle of the box, so that both shapes are continuous.
+        width = _width(ra_min, ra_max)
+        middle = ra_min + width / 2.0
+        px = middle + (self.corners[:,0] - middle + 180.0) % 360.0 - 180.0
+        py = self.corners[:,1]
+        bx = middle + np.array([-0.5, 0.5, 0.5, -0.5]) * width
+        by = np.array([dec_min, dec_min, dec_max, dec_max])
+        if _in_polygon(bx, by, px, py).any():
+            return True
+        for i, j in itertools.product(range(len(px)), range(4)):
+            if _segments_cross((px[i - 1], py[i - 1]), (px[i], py[i]), (bx[j - 1], by[j - 1]), (bx[j], by[j])):
+                return True
+        return False
+
+    def tostring(self):
+        """Serialize this footprint as a JSON string."""
+        return json.dumps({"ra" : self.ra, "dec" : self.dec, "corners" : None if self.corners is None else self.corners.tolist()})
+
+    @classmethod
+    def fromstring(cls, text):
+        """Load a footprint serialized with :meth:`tostring`."""
+        data = json.loads(text)
+        return cls(data["ra"], data["dec"], data["corners"])
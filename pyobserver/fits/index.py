@@ -0,0 +1,405 @@
+# -*- coding: utf-8 -*-
+#
+#  index.py
+#  pyobserver
+#
+#  Created by Alexander Rudy on 2014-06-02.
+#  Copyright 2014 Alexander Rudy. All rights reserved.
+#
+"""
+:mod:`fits.index` – Persistent FITS header index
+================================================
+
+FITS frames from previous nights don't change, so there is no reason to re-open every file each time a ``PO`` command runs. The :class:`FITSHeaderIndex` is a small SQLite database, usually kept next to the data, which remembers the headers of every file it has seen along with the size and modification time of the file. :meth:`FITSHeaderTable.read` consults the index first, and only reads files which are new or have changed.
+
+The header index also keeps the sky :class:`~pyobserver.fits.footprint.Footprint` of each header, bucketed by grid cell, so that :meth:`FITSHeaderIndex.cone` and :meth:`FITSHeaderIndex.box` can find the frames which cover a region of sky without opening any files.
+
+The header index also keeps postings for an :class:`~pyobserver.fits.inverted.InvertedIndex`, which map ``(keyword, value)`` pairs to headers. Keywords are added to the postings the first time they are read with a projection (see :meth:`post`), and tables read through the index come with an inverted index for every posted keyword.
+
+.. autoclass:: FITSHeaderIndex
+    :members:
+
+"""
+from __future__ import (absolute_import, unicode_literals, division,
+                        print_function)
+
+import os, os.path
+import sqlite3
+
+try:
+    import astropy.io.fits as pf
+except ImportError as e:
+    try:
+        import pyfits as pf
+    except ImportError:
+        raise e
+
+import six
+
+from .scan import project_header_string
+from .record import LazyHeaderRecord, _native
+from .inverted import InvertedIndex, indexable, typed
+from .footprint import Footprint, cone_cells, box_cone, EVERYWHERE
+
+def _sqlvalue(value):
+    """Convert a header value into a ``(kind, value)`` pair which can be stored in SQLite, or ``None``. See :func:`~pyobserver.fits.inverted.typed`."""
+    value = indexable(value)
+    if value is None:
+        return None
+    kind, value = typed(value)
+    if kind == 'int' and abs(value) >= 2**63:
+        return kind, six.text_type(value)
+    return kind, value
+
+_KINDS = {
+    'bool' : bool,
+    'int' : int,
+    'float' : float,
+    'str' : six.text_type,
+}
+"""Functions which restore a value from SQLite, by its kind. SQLite stores booleans as integers, and very large integers are stored as text."""
+
+def _pyvalue(kind, value):
+    """Restore a value stored by :func:`_sqlvalue`."""
+    return _KINDS[kind](value)
+
+def _fingerprint(filename):
+    """Return the (size, mtime) pair used to decide whether a file has changed."""
+    stat = os.stat(filename)
+    return stat.st_size, stat.st_mtime
+
+class FITSHeaderIndex(object):
+    """A persistent index of FITS headers, keyed by absolute path, file size and modification time.
+
+    :param string filename: The SQLite database file name. Use ``":memory:"`` for a temporary index.
+
+    Headers are stored as raw header card strings, exactly as read from the file. The ``FILENAME`` and ``OPENNAME`` cards are added by :meth:`FITSHeaderTable.read` after lookup, as ``OPENNAME`` depends on the current working directory.
+
+    """
+
+    SIDECAR = ".pyobserver-headers.sqlite"
+    """The default file name for an index stored next to the data."""
+
+    VERSION = 4
+    """The schema version. Indexes with a different version are rebuilt."""
+
+    def __init__(self, filename):
+        super(FITSHeaderIndex, self).__init__()
+        self.filename = filename
+        self.connection = sqlite3.connect(filename)
+        self.connection.text_factory = six.text_type
+        self._create()
+
+    def __repr__(self):
+        """Representation of this object."""
+        return "<{:s} {!r}>".format(self.__class__.__name__, self.filename)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        """The number of files in this index."""
+        return self.connection.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+
+    def __contains__(self, filename):
+        """Whether this index has an up-to-date copy of the headers of `filename`."""
+        return self.fresh(filename)
+
+    @classmethod
+    def sidecar(cls, files):
+        """Open the index which sits next to `files`, in the deepest directory which contains all of them.
+
+        :param files: The list of FITS file names which will be indexed.
+        :return: A new :class:`FITSHeaderIndex`.
+
+        """
+        directories = [ os.path.dirname(os.path.abspath(filename)) for filename in files ]
+        if not len(directories):
+            directories = [ os.getcwd() ]
+        directory = os.path.commonprefix([ directory + os.sep for directory in directories ])
+        directory = directory[:directory.rfind(os.sep)+1]
+        return cls(os.path.join(directory, cls.SIDECAR))
+
+    def _create(self):
+        """Create (or rebuild) the index tables."""
+        version = self.connection.execute("PRAGMA user_version").fetchone()[0]
+        with self.connection:
+            if version != self.VERSION:
+                self.connection.execute("DROP TABLE IF EXISTS files")
+                self.connection.execute("DROP TABLE IF EXISTS headers")
+                self.connection.execute("DROP TABLE IF EXISTS posted")
+                self.connection.execute("DROP TABLE IF EXISTS postings")
+                self.connection.execute("DROP TABLE IF EXISTS footprints")
+                self.connection.execute("DROP TABLE IF EXISTS coverage")
+                self.connection.execute("PRAGMA user_version = {:d}".format(self.VERSION))
+            self.connection.execute("CREATE TABLE IF NOT EXISTS files "
+                "(path TEXT PRIMARY KEY, size INTEGER, mtime REAL)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS headers "
+                "(path TEXT, hdu INTEGER, header TEXT, PRIMARY KEY (path, hdu))")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS posted (keyword TEXT PRIMARY KEY)")
+            # Values are stored with their kind, as SQLite can't tell True from 1, or 30 from 30.0.
+            self.connection.execute("CREATE TABLE IF NOT EXISTS postings "
+                "(keyword TEXT, kind TEXT, value, path TEXT, hdu INTEGER)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS postings_value ON postings (keyword, value)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS postings_path ON postings (path)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS footprints "
+                "(path TEXT, hdu INTEGER, footprint TEXT, PRIMARY KEY (path, hdu))")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS coverage (cell INTEGER, path TEXT, hdu INTEGER)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS coverage_cell ON coverage (cell)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS coverage_path ON coverage (path)")
+
+    def close(self):
+        """Close the underlying database connection."""
+        self.connection.close()
+
+    def fresh(self, filename):
+        """Check whether the index holds the current headers for `filename`."""
+        path = os.path.abspath(filename)
+        row = self.connection.execute("SELECT size, mtime FROM files WHERE path = ?", (path,)).fetchone()
+        return row is not None and tuple(row) == _fingerprint(path)
+
+    def get(self, filename, keywords=None):
+        """Get the list of ``(header, filename)`` pairs for `filename`, as returned by :func:`silent_getheaders`.
+
+        :param string filename: The FITS file name.
+        :param keywords: If given, only parse these upper-case keywords from each stored header.
+        :return: The list of headers, or ``None`` if the file is not in the index or has changed.
+
+        """
+        if not self.fresh(filename):
+            return None
+        return self._headers(filename, keywords)
+
+    def _headers(self, filename, keywords=None, lazy=False):
+        """Load the stored headers for `filename`."""
+        cursor = self.connection.execute("SELECT header FROM headers WHERE path = ? ORDER BY hdu",
+            (os.path.abspath(filename),))
+        headers = []
+        for hdu, (cards,) in enumerate(cursor):
+            if keywords is not None:
+                cards = project_header_string(cards, keywords)
+            if lazy:
+                header = LazyHeaderRecord(cards, filename, hdu)
+            else:
+                header = pf.Header.fromstring(_native(cards))
+                header.filename = filename
+            headers.append((header, filename))
+        return headers
+
+    def lookup(self, files, keywords=None, lazy=False):
+        """Split `files` into those which are up to date in the index, and those which must be read.
+
+        :param files: The list of FITS file names.
+        :param keywords: If given, only parse these upper-case keywords from each stored header.
+        :param bool lazy: If set, return :class:`~pyobserver.fits.record.LazyHeaderRecord` objects, which only parse the stored cards that are used.
+        :return: A tuple of a dictionary mapping file names to lists of ``(header, filename)`` pairs, and a list of the stale file names.
+
+        """
+        known = self._known()
+        cached, stale = {}, []
+        for filename in files:
+            if filename in cached:
+                continue
+            path = os.path.abspath(filename)
+            if path in known and known[path] == _fingerprint(path):
+                cached[filename] = self._headers(filename, keywords, lazy)
+            else:
+                stale.append(filename)
+        return cached, stale
+
+    def _known(self):
+        """A dictionary mapping the path of every stored file to its stored (size, mtime) pair."""
+        return dict((path, (size, mtime)) for path, size, mtime
+            in self.connection.execute("SELECT path, size, mtime FROM files"))
+
+    def stale(self, files):
+        """The files in `files` which are new or have changed since they were stored. No headers are loaded."""
+        known = self._known()
+        stale = []
+        for filename in files:
+            path = os.path.abspath(filename)
+            if not (path in known and known[path] == _fingerprint(path)) and filename not in stale:
+                stale.append(filename)
+        return stale
+
+    def refresh(self, files, workers=None, pool='thread', backend='astropy'):
+        """Read and store the headers of each file in `files` which is new or has changed, without loading the headers of the other files.
+
+        :param files: The list of FITS file names.
+        :param int workers: The number of workers used to read files. See :func:`~pyobserver.fits.core.pool_getheaders`.
+        :param string pool: The kind of worker pool, ``'thread'`` or ``'process'``.
+        :param string backend: The header reader, ``'astropy'`` or ``'scan'``.
+        :return: The list of files which were read.
+
+        Use this when only the index is needed, e.g. for :meth:`cone` or :meth:`box`, rather than building a :class:`~pyobserver.fits.core.FITSHeaderTable`.
+        """
+        from .core import pool_getheaders
+        stale = self.stale(files)
+        self.update(zip(stale, pool_getheaders(stale, workers=workers, pool=pool, backend=backend)))
+        return stale
+
+    def update(self, items):
+        """Store headers in the index.
+
+        :param items: An iterable of ``(filename, headers)`` pairs, where `headers` is a list of ``(header, filename)`` pairs as returned by :func:`silent_getheaders`.
+
+        The size and modification time recorded for each file are taken when it is stored, along with the sky footprint of each header (see :meth:`cone`).
+
+        """
+        with self.connection:
+            for filename, headers in items:
+                path = os.path.abspath(filename)
+                size, mtime = _fingerprint(path)
+                self.connection.execute("DELETE FROM headers WHERE path = ?", (path,))
+                self.connection.execute("INSERT OR REPLACE INTO files (path, size, mtime) VALUES (?, ?, ?)",
+                    (path, size, mtime))
+                cards = [ header.tostring() for header, _ in headers ]
+                self.connection.executemany("INSERT INTO headers (path, hdu, header) VALUES (?, ?, ?)",
+                    [ (path, hdu, header) for hdu, header in enumerate(cards) ])
+                self._footprints(path, [ header for header, _ in headers ], cards)
+                self.connection.execute("DELETE FROM postings WHERE path = ?", (path,))
+                self.connection.executemany("INSERT INTO postings (keyword, kind, value, path, hdu) VALUES (?, ?, ?, ?, ?)",
+                    self._postings(path, enumerate(header for header, _ in headers), self.posted))
+
+    def discard(self, filename):
+        """Remove `filename` from the index."""
+        path = os.path.abspath(filename)
+        with self.connection:
+            self.connection.execute("DELETE FROM headers WHERE path = ?", (path,))
+            self.connection.execute("DELETE FROM postings WHERE path = ?", (path,))
+            self.connection.execute("DELETE FROM footprints WHERE path = ?", (path,))
+            self.connection.execute("DELETE FROM coverage WHERE path = ?", (path,))
+            self.connection.execute("DELETE FROM files WHERE path = ?", (path,))
+
+    def prune(self):
+        """Remove every file which no longer exists from the index.
+
+        :return: The number of files removed.
+
+        """
+        missing = [ path for (path,) in self.connection.execute("SELECT path FROM files")
+            if not os.path.exists(path) ]
+        for path in missing:
+            self.discard(path)
+        return len(missing)
+
+    def _footprints(self, path, headers, cards):
+        """Store the footprint and grid cells of each header of `path`. Header records are parsed from their raw `cards`, as the WCS needs a full header."""
+        self.connection.execute("DELETE FROM footprints WHERE path = ?", (path,))
+        self.connection.execute("DELETE FROM coverage WHERE path = ?", (path,))
+        for hdu, (header, raw) in enumerate(zip(headers, cards)):
+            if not isinstance(header, pf.Header):
+                header = pf.Header.fromstring(_native(raw))
+            footprint = Footprint.fromheader(header)
+            if footprint is None:
+                continue
+            self.connection.execute("INSERT INTO footprints (path, hdu, footprint) VALUES (?, ?, ?)",
+                (path, hdu, footprint.tostring()))
+            self.connection.executemany("INSERT INTO coverage (cell, path, hdu) VALUES (?, ?, ?)",
+                [ (int(cell), path, hdu) for cell in footprint.cells() ])
+
+    def _candidates(self, cells):
+        """Load the footprints stored in any of `cells`, or in the :data:`~pyobserver.fits.footprint.EVERYWHERE` cell, as a dictionary mapping ``(path, hdu)`` pairs to footprints."""
+        candidates = {}
+        if EVERYWHERE in cells:
+            queries = [ ("SELECT path, hdu, footprint FROM footprints", ()) ]
+        else:
+            cells = [ EVERYWHERE ] + [ int(cell) for cell in cells ]
+            # SQLite limits the number of parameters in a single statement.
+            queries = []
+            for start in range(0, len(cells), 500):
+                chunk = cells[start:start+500]
+                queries.append(("SELECT DISTINCT f.path, f.hdu, f.footprint FROM coverage c JOIN footprints f "
+                    "ON c.path = f.path AND c.hdu = f.hdu WHERE c.cell IN ({})".format(", ".join("?" * len(chunk))), chunk))
+        for query, parameters in queries:
+            for path, hdu, footprint in self.connection.execute(query, parameters):
+                if (path, hdu) not in candidates:
+                    candidates[(path, hdu)] = Footprint.fromstring(footprint)
+        return candidates
+
+    def footprint(self, filename, hdu=0):
+        """The stored :class:`~pyobserver.fits.footprint.Footprint` of a header, or ``None``."""
+        row = self.connection.execute("SELECT footprint FROM footprints WHERE path = ? AND hdu = ?",
+            (os.path.abspath(filename), hdu)).fetchone()
+        return None if row is None else Footprint.fromstring(row[0])
+
+    def cone(self, ra, dec, radius):
+        """Find the headers whose footprints overlap a circle on the sky.
+
+        :param float ra: The right ascension of the center, in degrees.
+        :param float dec: The declination of the center, in degrees.
+        :param radius: The radius of the circle, as an angle. Angles without units are in degrees.
+        :return: A list of ``(path, hdu, distance)`` tuples, where `distance` is the angle in degrees from the center of the circle to the nearest point of the footprint, sorted from the nearest.
+
+        """
+        matches = []
+        for (path, hdu), footprint in six.iteritems(self._candidates(cone_cells(ra, dec, radius))):
+            if footprint.intersects_cone(ra, dec, radius):
+                matches.append((path, hdu, footprint.distance(ra, dec)))
+        return sorted(matches, key=lambda match : (match[2], match[0], match[1]))
+
+    def box(self, ra_min, ra_max, dec_min, dec_max):
+        """Find the headers whose footprints overlap a box in right ascension and declination, in degrees.
+
+        The box wraps through zero right ascension when `ra_min` is larger than `ra_max`.
+
+        :return: A sorted list of ``(path, hdu)`` pairs.
+        """
+        candidates = self._candidates(cone_cells(*box_cone(ra_min, ra_max, dec_min, dec_max)))
+        return sorted(key for key, footprint in six.iteritems(candidates)
+            if footprint.intersects_box(ra_min, ra_max, dec_min, dec_max))
+
+    @property
+    def posted(self):
+        """The list of keywords which have postings in this index."""
+        return [ keyword for (keyword,) in self.connection.execute("SELECT keyword FROM posted ORDER BY keyword") ]
+
+    @staticmethod
+    def _postings(path, headers, keywords):
+        """Generate posting rows for an iterable of ``(hdu, header)`` pairs."""
+        for hdu, header in headers:
+            for keyword in keywords:
+                value = _sqlvalue(header.get(keyword, None))
+                if value is not None:
+                    yield (keyword, value[0], value[1], path, hdu)
+
+    def post(self, keywords):
+        """Add postings for `keywords` to this index.
+
+        :param keywords: The keywords to post. Keywords which are already posted are ignored.
+
+        New keywords are posted for every stored header, by parsing only those keywords from the stored header cards.
+        """
+        keywords = sorted(set(keyword.upper() for keyword in keywords) - set(self.posted))
+        if not len(keywords):
+            return
+        with self.connection:
+            cursor = self.connection.execute("SELECT path, hdu, header FROM headers")
+            for path, hdu, cards in cursor.fetchall():
+                header = pf.Header.fromstring(_native(project_header_string(cards, keywords)))
+                self.connection.executemany("INSERT INTO postings (keyword, kind, value, path, hdu) VALUES (?, ?, ?, ?, ?)",
+                    self._postings(path, [(hdu, header)], keywords))
+            self.connection.executemany("INSERT INTO posted (keyword) VALUES (?)", [ (keyword,) for keyword in keywords ])
+
+    def inverted(self, locations, length):
+        """Build an :class:`~pyobserver.fits.inverted.InvertedIndex` from the postings in this index.
+
+        :param locations: A dictionary mapping ``(absolute path, hdu)`` pairs to the list of rows where that header appears in a table.
+        :param int length: The number of rows in the table.
+        :return: A new :class:`~pyobserver.fits.inverted.InvertedIndex` for every posted keyword. It must be bound to the table with :meth:`~pyobserver.fits.inverted.InvertedIndex.bind`.
+
+        """
+        inverted = InvertedIndex(length, self.posted)
+        paths = sorted(set(path for path, hdu in locations))
+        # Only the postings for the table's own files are loaded. SQLite limits the number of parameters in a single statement.
+        for start in range(0, len(paths), 500):
+            chunk = paths[start:start+500]
+            for keyword, kind, value, path, hdu in self.connection.execute("SELECT keyword, kind, value, path, hdu FROM postings "
+                "WHERE path IN ({})".format(", ".join("?" * len(chunk))), chunk):
+                value = _pyvalue(kind, value)
+                for row in locations.get((path, hdu), []):
+                    inverted.add(keyword, value, row)
+        return inverted
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+#
+#  inverted.py
+#  pyobserver
+#
+#  Created by Alexander Rudy on 2014-06-13.
+#  Copyright 2014 Alexander Rudy. All rights reserved.
+#
+"""
+:mod:`fits.inverted` – Inverted keyword index
+=============================================
+
+The most common searches are equality searches on a few keywords, like ``PO list OBJECT=galaxy FILTER=Kbb``. An :class:`InvertedIndex` maps each value of a keyword to the rows of a :class:`~pyobserver.fits.core.FITSHeaderTable` which have that value, so that equality and presence searches are answered with set operations instead of a scan over every header. Other predicates are evaluated once for each distinct value in the index.
+
+:meth:`FITSHeaderTable.invert` builds an inverted index for a table, and :meth:`FITSHeaderTable.search` and :meth:`FITSHeaderTable.query` use it automatically. When headers are read through a :class:`~pyobserver.fits.index.FITSHeaderIndex`, the inverted index is loaded from the header index, and not rebuilt.
+
+.. autoclass:: InvertedIndex
+    :members:
+
+.. autofunction:: typed
+
+"""
+from __future__ import (absolute_import, unicode_literals, division,
+                        print_function)
+
+import collections
+
+import numpy as np
+import six
+
+try:
+    import astropy.io.fits as pf
+except ImportError as e:
+    try:
+        import pyfits as pf
+    except ImportError:
+        raise e
+
+def indexable(value):
+    """Convert a header value into a hashable index key, or ``None`` if it can't be indexed."""
+    if value is None or isinstance(value, pf.card.Undefined):
+        return None
+    if isinstance(value, (bool, float) + six.integer_types + six.string_types):
+        return value
+    return six.text_type(value)
+
+def typed(value):
+    """Pair a header value with its kind (``'bool'``, ``'int'``, ``'float'``, ``'str'`` or the name of its type), so that values which compare equal but are written differently in a header, like ``30`` and ``30.0`` or ``True`` and ``1``, have different keys."""
+    if isinstance(value, (bool, np.bool_)):
+        return ('bool', value)
+    if isinstance(value, six.integer_types + (np.integer,)):
+        return ('int', value)
+    if isinstance(value, (float, np.floating)):
+        return ('float', value)
+    if isinstance(value, six.string_types):
+        return ('str', value)
+    return (type(value).__name__, value)
+
+class InvertedIndex(object):
+    """An index from ``(keyword, value)`` pairs to header rows.
+
+    :param int length: The number of rows in the indexed table.
+    :param keywords: The indexed keywords.
+
+    A row which has no entry for an indexed keyword is missing that keyword. The index is only valid for the exact list of headers it was built for, see :meth:`bind` and :meth:`valid`.
+
+    Postings are kept by value and kind (see :func:`typed`), so that predicates see each value with the type it has in the header, e.g. ``True`` rather than ``1``. Equality searches match equal values of every kind, as :meth:`~pyobserver.fits.core.FITSHeaderTable.search` does.
+    """
+
+    def __init__(self, length, keywords):
+        super(InvertedIndex, self).__init__()
+        self._length = length
+        self._postings = collections.OrderedDict((keyword.upper(), {}) for keyword in keywords)
+        self._equal = dict((keyword.upper(), {}) for keyword in keywords)
+        self._arrays = {}
+        self._headers = None
+
+    def __repr__(self):
+        """Representation of this object."""
+        return "<{:s} {:d} rows, keywords={:s}>".format(self.__class__.__name__, len(self), ",".join(self.keywords))
+
+    def __len__(self):
+        """The number of rows in the indexed table."""
+        return self._length
+
+    def __contains__(self, keyword):
+        """Whether `keyword` is indexed."""
+        return keyword.upper() in self._postings
+
+    @property
+    def keywords(self):
+        """The indexed keywords."""
+        return list(self._postings.keys())
+
+    @classmethod
+    def fromheaders(cls, headers, keywords):
+        """Build an inverted index for a list of headers.
+
+        :param headers: The list of headers, usually a :class:`FITSHeaderTable`.
+        :param keywords: The keywords to index.
+        :return: A new :class:`InvertedIndex`, bound to `headers`.
+
+        """
+        headers = list(headers)
+        index = cls(len(headers), keywords)
+        for keyword in index.keywords:
+            for row, header in enumerate(headers):
+                index.add(keyword, header.get(keyword, None), row)
+        index.bind(headers)
+        return index
+
+    def add(self, keyword, value, row):
+        """Add a single ``(keyword, value)`` posting for `row`."""
+        keyword, value = keyword.upper(), indexable(value)
+        if value is None:
+            return
+        key = typed(value)
+        postings = self._postings[keyword]
+        if key not in postings:
+            postings[key] = []
+            self._equal[keyword].setdefault(value, []).append(key)
+        postings[key].append(row)
+        self._arrays.pop(keyword, None)
+
+    def bind(self, headers):
+        """Bind this index to the list of `headers` it describes."""
+        self._headers = tuple(headers)
+        self._length = len(self._headers)
+
+    def valid(self, headers):
+        """Check that this index still describes `headers`, i.e. that the list holds exactly the same header objects in the same order."""
+        if self._headers is None or len(headers) != len(self._headers):
+            return False
+        return all(a is b for a, b in zip(headers, self._headers))
+
+    def values(self, keyword):
+        """The distinct values of `keyword`. Values which are equal but of different kinds, like ``30`` and ``30.0``, are listed separately."""
+        return [ value for kind, value in self._postings[keyword.upper()] ]
+
+    def _rows(self, keyword, name, keys):
+        """The sorted array of rows for the postings `keys` of `keyword`, cached by `name`."""
+        arrays = self._arrays.setdefault(keyword, {})
+        if name not in arrays:
+            postings = self._postings[keyword]
+            arrays[name] = np.array(sorted(row for key in keys for row in postings[key]), dtype=np.intp)
+        return arrays[name]
+
+    def rows(self, keyword, value):
+        """The sorted array of rows where `keyword` is equal to `value`, including values of other kinds which are equal, like ``30`` and ``30.0``."""
+        keyword = keyword.upper()
+        value = indexable(value)
+        return self._rows(keyword, typed(value), self._equal[keyword].get(value, []))
+
+    def present(self, keyword):
+        """The sorted array of rows which have `keyword`."""
+        keyword = keyword.upper()
+        return self._rows(keyword, None, list(self._postings[keyword]))
+
+    def missing(self, keyword):
+        """The number of rows which are missing `keyword`."""
+        return len(self) - len(self.present(keyword))
+
+    def mask(self, predicate):
+        """Evaluate a :class:`~pyobserver.fits.query.Predicate` using this index.
+
+        :param predicate: The predicate.
+        :return: A boolean array, one per row, or ``None`` if the predicate's keyword isn't indexed.
+
+        Equality, ``in``, presence and absence predicates are answered directly from the postings. Any other predicate is evaluated once for each distinct value of the keyword.
+        """
+        if predicate.keyword not in self:
+            return None
+        result = np.zeros(len(self), dtype=bool)
+        if predicate.op in ('present', 'absent'):
+            result[self.present(predicate.keyword)] = True
+            return result if predicate.op == 'present' else ~result
+        if predicate.op in ('=', '=='):
+            values = [ predicate.value ]
+        elif predicate.op == 'in':
+            values = predicate.value
+        else:
+            postings = self._postings[predicate.keyword.upper()]
+            for key in postings:
+                if predicate(key[1]):
+                    result[postings[key]] = True
+            return result
+        for value in values:
+            result[self.rows(predicate.keyword, value)] = True
+        return result
@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+#
+#  patch.py
+#  pyobserver
+#
+#  Created by Alexander Rudy on 2014-06-22.
+#  Copyright 2014 Alexander Rudy. All rights reserved.
+#
+"""
+:mod:`fits.patch` – In-place FITS header patches
+================================================
+
+Changing a header keyword with :func:`astropy.io.fits.open` in ``update`` mode can rewrite the whole file, even though only a few cards have changed. Most headers end with some unused space, as headers are padded out to a whole number of 2880-byte blocks. When the patched header still fits in the blocks used by the original header, :func:`apply_patch` writes only the bytes which have changed, directly into the file. Only when the header needs more blocks is the file rewritten, by copying it into a temporary file next to the original, which then replaces the original.
+
+Patches to many files are applied by a pool of workers with :func:`patch_headers`. Each file is locked while it is patched, so that two patches to the same file are applied one at a time, and each patch reports the number of bytes it wrote.
+
+Gzipped and other files which the :mod:`~pyobserver.fits.scan` module can't read are patched with astropy instead.
+
+.. autoclass:: HeaderPatch
+    :members:
+
+.. autofunction:: apply_patch
+
+.. autofunction:: patch_headers
+
+.. autoclass:: PatchResult
+    :members:
+
+"""
+from __future__ import (absolute_import, unicode_literals, division,
+                        print_function)
+
+import os, os.path
+import collections
+import contextlib
+import itertools
+import mmap
+import shutil
+import tempfile
+import threading
+import warnings
+
+import numpy as np
+import six
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import astropy.io.fits as pf
+except ImportError as e:
+    try:
+        import pyfits as pf
+    except ImportError:
+        raise e
+
+from .scan import CARD, iter_extents, padded
+from .record import _native
+
+class HeaderPatch(object):
+    """A set of changes to a single header of a FITS file.
+
+    :param string filename: The FITS file name.
+    :param cards: A mapping of keywords to new values, or to ``(value, comment)`` tuples.
+    :param history: A list of ``HISTORY`` lines to add.
+    :param int extension: The HDU to patch.
+
+    """
+
+    def __init__(self, filename, cards=None, history=None, extension=0):
+        super(HeaderPatch, self).__init__()
+        self.filename = filename
+        self.cards = collections.OrderedDict() if cards is None else collections.OrderedDict(cards)
+        self.history = [] if history is None else list(history)
+        self.extension = extension
+
+    def __repr__(self):
+        """Representation of this object."""
+        return "<{:s} {!r}[{:d}] {:s}>".format(self.__class__.__name__, self.filename, self.extension, ", ".join(self.cards))
+
+    def apply(self, header):
+        """Apply this patch to a :class:`~astropy.io.fits.Header`, in place."""
+        for keyword, value in six.iteritems(self.cards):
+            header[keyword] = value
+        for line in self.history:
+            header.add_history(line)
+        return header
+
+class PatchResult(collections.namedtuple("PatchResult", ["filename", "written", "size", "inplace"])):
+    """The result of applying a :class:`HeaderPatch`: the number of bytes `written`, the `size` of the file, and whether the header was patched `inplace`."""
+
+    __slots__ = ()
+
+    @property
+    def saved(self):
+        """The number of bytes which didn't have to be written, compared to rewriting the whole file."""
+        return max(self.size - self.written, 0)
+
+_LOCKS = collections.defaultdict(threading.Lock)
+_LOCKS_LOCK = threading.Lock()
+
+@contextlib.contextmanager
+def _locked(filename, mode='r+b'):
+    """Open `filename` while holding its lock, and an exclusive advisory lock on the open file where the platform supports it.
+
+    A file which is replaced (by another patch which rewrote it) while waiting for the advisory lock is opened again.
+    """
+    with _LOCKS_LOCK:
+        lock = _LOCKS[os.path.abspath(filename)]
+    with lock:
+        while True:
+            stream = open(filename, mode)
+            if fcntl is None:
+                break
+            fcntl.flock(stream.fileno(), fcntl.LOCK_EX)
+            if os.path.samestat(os.fstat(stream.fileno()), os.stat(filename)):
+                break
+            stream.close()
+        try:
+            yield stream
+        finally:
+            stream.close()
+
+def _read(stream, extension):
+    """Read the extent and the raw header bytes, including padding, of an HDU from an open file."""
+    buf = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        extent = next(itertools.islice(iter_extents(buf), extension, None), None)
+        if extent is None:
+            raise IndexError("No HDU {:d} in '{}'".format(extension, stream.name))
+        return extent, bytes(buf[extent.header:extent.data])
+    finally:
+        buf.close()
+
+def _rewrite(stream, extent, header):
+    """Rewrite the file open as `stream` with a new, larger `header`, and return the number of bytes written."""
+    directory, name = os.path.split(os.path.abspath(stream.name))
+    descriptor, temporary = tempfile.mkstemp(prefix="." + name, suffix=".patch", dir=directory)
+    try:
+        with os.fdopen(descriptor, 'wb') as output:
+            stream.seek(0)
+            _copy(stream, output, extent.header)
+            output.write(header)
+            stream.seek(extent.data)
+            shutil.copyfileobj(stream, output)
+            written = output.tell()
+        shutil.copymode(stream.name, temporary)
+        os.rename(temporary, stream.name)
+    except:
+        os.remove(temporary)
+        raise
+    return written
+
+def _copy(source, destination, size, chunk=1 << 20):
+    """Copy `size` bytes from `source` to `destination`."""
+    while size > 0:
+        data = source.read(min(chunk, size))
+        if not data:
+            break
+        destination.write(data)
+        size -= len(data)
+
+def _fallback(patch):
+    """Apply `patch` with astropy, for files which can't be scanned."""
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        with pf.open(patch.filename, mode='update', ignore_missing_end=True) as HDUs:
+            patch.apply(HDUs[patch.extension].header)
+            HDUs.flush(output_verify='fix')
+    size = os.path.getsize(patch.filename)
+    return PatchResult(patch.filename, size, size, False)
+
+def apply_patch(patch):
+    """Apply a :class:`HeaderPatch` to its file.
+
+    :return: A :class:`PatchResult`.
+
+    The header cards are read with the :mod:`~pyobserver.fits.scan` module, patched with astropy, and written back. If the new header fits in the space used by the old header, only the span of bytes which changed is written. Otherwise, the file is rewritten.
+    """
+    with _locked(patch.filename) as stream:
+        try:
+            extent, old = _read(stream, patch.extension)
+        except ValueError:
+            extent = None
+        if extent is not None:
+            return _patch(stream, patch, extent, old)
+    with _locked(patch.filename, 'rb'):
+        return _fallback(patch)
+
+def _patch(stream, patch, extent, old):
+    """Patch a header which has been read with the :mod:`~pyobserver.fits.scan` module."""
+    header = pf.Header.fromstring(_native(old[:extent.ncards * CARD]))
+    new = patch.apply(header).tostring(endcard=True, padding=False).encode("ascii")
+    size = os.fstat(stream.fileno()).st_size
+    if len(new) > len(old):
+        new += b" " * (padded(len(new)) - len(new))
+        return PatchResult(patch.filename, _rewrite(stream, extent, new), size, False)
+    new += b" " * (len(old) - len(new))
+    changed = np.flatnonzero(np.frombuffer(new, dtype=np.uint8) != np.frombuffer(old, dtype=np.uint8))
+    if not len(changed):
+        return PatchResult(patch.filename, 0, size, True)
+    start, stop = int(changed[0]), int(changed[-1]) + 1
+    stream.seek(extent.header + start)
+    stream.write(new[start:stop])
+    stream.flush()
+    return PatchResult(patch.filename, stop - start, size, True)
+
+def patch_headers(patches, workers=None, pool='thread'):
+    """Apply many :class:`HeaderPatch` objects, using a pool of workers.
+
+    :param patches: The list of patches.
+    :param int workers: The number of workers to use. If ``None`` or ``1``, patches are applied serially.
+    :param string pool: The kind of pool, either ``'thread'`` or ``'process'``.
+    :return: A list of :class:`PatchResult`, in the same order as `patches`.
+
+    Patches to the same file are never applied at the same time, but may be applied in any order.
+    """
+    patches = list(patches)
+    if workers is None or workers <= 1 or len(patches) <= 1:
+        return [ apply_patch(patch) for patch in patches ]
+    if pool == 'thread':
+        from multiprocessing.pool import ThreadPool as Pool
+    elif pool == 'process':
+        from multiprocessing.pool import Pool
+    else:
+        raise ValueError("Unknown pool type '{}', expected one of thread, process".format(pool))
+    workpool = Pool(min(workers, len(patches)))
+    try:
+        return workpool.map(apply_patch, patches, 1)
+    finally:
+        workpool.close()
+        workpool.join()
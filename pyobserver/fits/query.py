@@ -0,0 +1,395 @@
+# -*- coding: utf-8 -*-
+#
+#  query.py
+#  pyobserver
+#
+#  Created by Alexander Rudy on 2014-06-11.
+#  Copyright 2014 Alexander Rudy. All rights reserved.
+#
+"""
+:mod:`fits.query` – FITS header queries
+=======================================
+
+Queries are a small predicate language for FITS header keywords, used by the ``PO`` command line. Each predicate compares a keyword to a value::
+
+    OBJECT=galaxy EXPTIME>=30 FILTER!=Kbb "DATE-OBS in [2014-03-01, 2014-03-02]"
+
+Predicates are combined with "AND", and groups of predicates can be combined with "OR" by separating them with ``OR``::
+
+    OBJECT=galaxy EXPTIME>=30 OR OBJECT=star
+
+A :class:`Query` is evaluated against the typed columns of a :class:`~pyobserver.fits.columns.FITSHeaderColumns` collection. Comparisons between numeric columns and numeric values are evaluated as :mod:`numpy` array operations. All other comparisons are evaluated once for each distinct value of the keyword, and the result is broadcast back to every header.
+
+.. autoclass:: Query
+    :members:
+
+.. autoclass:: Predicate
+    :members:
+
+"""
+from __future__ import (absolute_import, unicode_literals, division,
+                        print_function)
+
+import ast
+import collections
+import operator
+import re
+import warnings
+
+import numpy as np
+import six
+
+from .inverted import typed
+
+OPERATORS = {
+    '=' : operator.eq,
+    '==' : operator.eq,
+    '!=' : operator.ne,
+    '<' : operator.lt,
+    '<=' : operator.le,
+    '>' : operator.gt,
+    '>=' : operator.ge,
+}
+"""Comparison operators, by their query syntax."""
+
+ORDERED = set(['<', '<=', '>', '>='])
+
+OR = set(['OR', 'or', '|'])
+"""Tokens which separate groups of predicates."""
+
+_predicate_re = re.compile(r"""
+    ^\s*(?P<keyword>[A-Za-z0-9_\-\.]+) # The FITS keyword.
+    (?:\s*(?P<op>==|!=|<=|>=|=|<|>|\s+not\s+in\s+|\s+in\s+)\s* # The comparison operator.
+    (?P<value>.*?))?\s*$ # The value, which may be empty.
+    """, re.VERBOSE)
+
+def literal(value):
+    """Interpret a query value as a python literal, or as a string if it isn't one."""
+    try:
+        return ast.literal_eval(value)
+    except Exception:
+        return value
+
+def literal_list(value):
+    """Interpret a query value as a list of python literals, e.g. ``[30, 60]`` or ``[Kbb, Hbb]``."""
+    try:
+        values = ast.literal_eval(value)
+    except Exception:
+        values = [ literal(item.strip()) for item in value.strip().lstrip("[(").rstrip("])").split(",") if item.strip() ]
+    if isinstance(values, (list, tuple, set)):
+        return list(values)
+    return [values]
+
+def _number(value):
+    """Whether `value` is a python number."""
+    return isinstance(value, six.integer_types + (float,))
+
+def _comparable(a, b):
+    """Whether `a` and `b` can be meaningfully ordered."""
+    return (_number(a) and _number(b)) or (isinstance(a, six.string_types) and isinstance(b, six.string_types))
+
+class Predicate(object):
+    """A single comparison between a header keyword and a value.
+
+    :param string keyword: The FITS keyword.
+    :param string op: The comparison. One of the :data:`OPERATORS`, ``'in'``, ``'not in'``, ``'match'`` (a regular expression), ``'present'`` or ``'absent'``.
+    :param value: The value to compare against.
+
+    Predicates are callable with a single header value, so they can also be used with :meth:`FITSHeaderTable.search`.
+    """
+
+    def __init__(self, keyword, op, value=None):
+        super(Predicate, self).__init__()
+        self.keyword = keyword.upper()
+        self.op = op
+        if op in ('in', 'not in'):
+            value = list(value)
+        elif op == 'match' and not hasattr(value, 'match'):
+            value = re.compile(value)
+        self.value = value
+
+    def __repr__(self):
+        """Representation of this object."""
+        if self.op in ('present', 'absent'):
+            return "<{:s} {:s} {:s}>".format(self.__class__.__name__, self.keyword, self.op)
+        return "<{:s} {:s} {:s} {!r}>".format(self.__class__.__name__, self.keyword, self.op, getattr(self.value, 'pattern', self.value))
+
+    @classmethod
+    def parse(cls, text, regex=False):
+        """Parse a single predicate, like ``EXPTIME>=30``.
+
+        :param string text: The predicate text.
+        :param bool regex: If set, ``=`` compares values with regular expressions.
+        :return: A new :class:`Predicate`.
+
+        A bare keyword (``KWD``) matches headers which have that keyword, and ``KWD=False`` matches headers which don't.
+        """
+        match = _predicate_re.match(text)
+        if not match:
+            raise ValueError("Can't parse query predicate '{}'".format(text))
+        keyword, op, value = match.group('keyword', 'op', 'value')
+        if op is None:
+            return cls(keyword, 'present')
+        op = " ".join(op.split())
+        if op in ('in', 'not in'):
+            return cls(keyword, op, literal_list(value))
+        if op in ('=', '==') and regex:
+            return cls(keyword, 'match', value)
+        value = literal(value)
+        if op in ('=', '==') and isinstance(value, bool):
+            return cls(keyword, 'present' if value else 'absent')
+        return cls(keyword, op, value)
+
+    @classmethod
+    def fromsearch(cls, keyword, search):
+        """Create a predicate from a single :meth:`FITSHeaderTable.search` style keyword argument.
+
+        :param string keyword: The FITS keyword.
+        :param search: The search value: a literal, a regular expression, a callable, or a boolean.
+        :return: A new :class:`Predicate`.
+
+        """
+        if isinstance(search, Predicate):
+            return search
+        if isinstance(search, bool):
+            return cls(keyword, 'present' if search else 'absent')
+        if hasattr(search, 'match'):
+            return cls(keyword, 'match', search)
+        if callable(search):
+            return _CallablePredicate(keyword, search)
+        return cls(keyword, '=', search)
+
+    def __call__(self, value):
+        """Evaluate this predicate for a single header value."""
+        if self.op == 'present':
+            return True
+        if self.op == 'absent':
+            return False
+        if self.op == 'match':
+            return self.value.match(six.text_type(value)) is not None
+        if self.op == 'in':
+            return value in self.value
+        if self.op == 'not in':
+            return value not in self.value
+        if self.op in ORDERED and not _comparable(value, self.value):
+            return False
+        return OPERATORS[self.op](value, self.value)
+
+    def mask(self, column):
+        """Evaluate this predicate for a whole column.
+
+        :param column: A :class:`~pyobserver.fits.columns.HeaderColumn`.
+        :return: A boolean array, one per row. Headers which are missing the keyword only match ``'absent'``.
+
+        """
+        if self.op == 'present':
+            return ~column.mask
+        if self.op == 'absent':
+            return column.mask.copy()
+        if not column.encoded and column.data.dtype.kind in 'iuf':
+            if self.op in OPERATORS and _number(self.value) and not isinstance(self.value, bool):
+                return OPERATORS[self.op](column.data, self.value) & ~column.mask
+            if self.op in ('in', 'not in') and all(_number(value) for value in self.value):
+                found = np.isin(column.data, self.value)
+                return (found if self.op == 'in' else ~found) & ~column.mask
+        # Everything else is evaluated once per distinct value.
+        return column.evaluate(self)
+
+class Query(object):
+    """A query, made up of groups of :class:`Predicate` objects.
+
+    :param groups: A list of lists of predicates. Predicates in each group are combined with "AND", and the groups are combined with "OR".
+
+    """
+
+    def __init__(self, groups):
+        super(Query, self).__init__()
+        self.groups = [ list(group) for group in groups if len(group) ]
+
+    def __repr__(self):
+        """Representation of this object."""
+        return "<{:s} {:s}>".format(self.__class__.__name__, " OR ".join(
+            "(" + " AND ".join(repr(predicate) for predicate in group) + ")" for group in self.groups))
+
+    def __len__(self):
+        """The number of predicates in this query."""
+        return sum(len(group) for group in self.groups)
+
+    @classmethod
+    def parse(cls, args, regex=False):
+        """Parse a query from a list of command line arguments.
+
+        :param args: The command line arguments, one predicate per argument. ``OR`` separates groups of predicates.
+        :param bool regex: If set, ``=`` compares values with regular expressions.
+        :return: A new :class:`Query`.
+
+        """
+        groups = [[]]
+        for token in _join_lists(args):
+            if token.strip() in OR:
+                groups.append([])
+            else:
+                groups[-1].append(Predicate.parse(token, regex=regex))
+        return cls(groups)
+
+    @classmethod
+    def fromkeywords(cls, **keywords):
+        """Create a query from :meth:`FITSHeaderTable.search` style keyword arguments."""
+        return cls([[ Predicate.fromsearch(keyword, search) for keyword, search in six.iteritems(keywords) ]])
+
+    @property
+    def keywords(self):
+        """The keywords used by this query, in the order they first appear."""
+        keywords = []
+        for group in self.groups:
+            for predicate in group:
+                if predicate.keyword not in keywords:
+                    keywords.append(predicate.keyword)
+        return keywords
+
+    def todict(self):
+        """Convert this query into :meth:`FITSHeaderTable.search` style keyword arguments.
+
+        Equality predicates become plain values, and all other predicates are used as callables. Queries with more than one "OR" group can't be converted, and raise :exc:`ValueError`.
+        """
+        if len(self.groups) > 1:
+            raise ValueError("Can't convert a query with OR groups into search keywords.")
+        search = collections.OrderedDict()
+        for predicate in (self.groups[0] if len(self.groups) else []):
+            if predicate.op in ('=', '=='):
+                search[predicate.keyword] = predicate.value
+            elif predicate.op in ('present', 'absent'):
+                search[predicate.keyword] = (predicate.op == 'present')
+            elif predicate.op == 'match':
+                search[predicate.keyword] = predicate.value
+            else:
+                search[predicate.keyword] = predicate
+        return search
+
+    def unindexed(self, index=None):
+        """The keywords used by this query which can't be answered by an :class:`~pyobserver.fits.inverted.InvertedIndex`."""
+        if index is None:
+            return self.keywords
+        return [ keyword for keyword in self.keywords if keyword not in index ]
+
+    def mask(self, columns, index=None):
+        """Evaluate this query against a columnar header collection.
+
+        :param columns: A :class:`~pyobserver.fits.columns.FITSHeaderColumns` object, which must have a column for each of the :meth:`unindexed` keywords.
+        :param index: An optional :class:`~pyobserver.fits.inverted.InvertedIndex` for the same headers, used for the keywords it holds.
+        :return: A boolean array, ``True`` for each header which matches the query.
+
+        """
+        if not len(self.groups):
+            return np.ones(len(columns), dtype=bool)
+        missing = {}
+        result = np.zeros(len(columns), dtype=bool)
+        for group in self.groups:
+            keep = np.ones(len(columns), dtype=bool)
+            for predicate in group:
+                if index is not None and predicate.keyword in index:
+                    if predicate.op != 'absent' and index.missing(predicate.keyword):
+                        missing[predicate.keyword] = index.missing(predicate.keyword)
+                    keep &= index.mask(predicate)
+                    continue
+                if predicate.keyword not in columns:
+                    if predicate.op != 'absent':
+                        keep[:] = False
+                        missing[predicate.keyword] = len(columns)
+                    continue
+                column = columns[predicate.keyword]
+                if predicate.op != 'absent' and column.mask.any():
+                    missing[predicate.keyword] = int(column.mask.sum())
+                keep &= predicate.mask(column)
+            result |= keep
+        for keyword, count in sorted(missing.items()):
+            warnings.warn("Couldn't find keyword '{}' in {:d} headers".format(keyword, count))
+        return result
+
+    def match(self, header, memo=None, missing=None):
+        """Check whether a single header matches this query.
+        
+        :param header: A FITS header, or any mapping of keywords to values.
+        :param dict memo: A dictionary used to remember the result of each predicate for each distinct value and its kind (see :func:`~pyobserver.fits.inverted.typed`), shared between calls.
+        :param missing: A :class:`collections.Counter` which counts the keywords this header is missing.
+        :return: Whether the header matches.
+        
+        """
+        if not len(self.groups):
+            return True
+        if memo is None:
+            memo = {}
+        for group in self.groups:
+            for predicate in group:
+                if predicate.keyword not in header:
+                    if predicate.op == 'absent':
+                        continue
+                    if missing is not None:
+                        missing[predicate.keyword] += 1
+                    break
+                value = header[predicate.keyword]
+                results = memo.setdefault(id(predicate), {})
+                try:
+                    keep = results[typed(value)]
+                except KeyError:
+                    keep = results[typed(value)] = bool(predicate(value))
+                except TypeError:
+                    keep = bool(predicate(value))
+                if not keep:
+                    break
+            else:
+                return True
+        return False
+    
+    def filter(self, headers):
+        """Lazily filter an iterable of headers.
+        
+        :param headers: Any iterable of headers, such as a generator from :func:`~pyobserver.fits.core.iter_headers`.
+        :return: A generator of the headers which match this query.
+        
+        Headers which don't match are dropped as soon as they are checked. Each predicate is only evaluated once for each distinct value, and a single warning is raised for each missing keyword once `headers` is exhausted.
+        """
+        memo = {}
+        missing = collections.Counter()
+        for header in headers:
+            if self.match(header, memo, missing):
+                yield header
+        for keyword, count in sorted(missing.items()):
+            warnings.warn("Couldn't find keyword '{}' in {:d} headers".format(keyword, count))
+
+class _CallablePredicate(Predicate):
+    """A predicate which wraps an arbitrary callable."""
+
+    def __init__(self, keyword, function):
+        super(_CallablePredicate, self).__init__(keyword, 'call', function)
+
+    def __call__(self, value):
+        try:
+            return self.value(value)
+        except Exception as e:
+            warnings.warn("Callable keyword search failed for value '{}': {}".format(value, e))
+            return False
+
+    def mask(self, column):
+        return column.evaluate(self)
+
+def _join_lists(args):
+    """Re-join ``KWD in [a, b]`` predicates which the shell has split into several arguments."""
+    args = list(args)
+    i = 0
+    while i < len(args):
+        if i + 1 < len(args) and args[i + 1] in ('in', 'not'):
+            parts = [args[i]]
+            opened = False
+            i += 1
+            while i < len(args):
+                part = args[i]
+                parts.append(part)
+                i += 1
+                opened = opened or part.startswith("[")
+                if part.rstrip().endswith("]") or (part not in ('in', 'not') and not opened):
+                    break
+            yield " ".join(parts)
+        else:
+            yield args[i]
+            i += 1
@@ -0,0 +1,399 @@
+# -*- coding: utf-8 -*-
+#
+#  record.py
+#  pyobserver
+#
+#  Created by Alexander Rudy on 2014-06-16.
+#  Copyright 2014 Alexander Rudy. All rights reserved.
+#
+"""
+:mod:`fits.record` – Compact FITS header records
+================================================
+
+A copied :class:`~astropy.io.fits.Header` keeps a :class:`~astropy.io.fits.Card` object for every card, along with its comment and the original card image. Searching, grouping and logging only need the keyword values, so :class:`FITSHeaderTable` holds :class:`HeaderRecord` objects by default. A record keeps only the values of each keyword, the file name and the extension number. Records which have the same keywords (which is most of them, for data from a single instrument) share a single tuple of keyword names. Only the :data:`MAX_LAYOUTS` tuples and :data:`MAX_KEYWORDS` keyword names which were added most recently are kept for sharing, so reading many different kinds of headers doesn't hold on to memory after the records are gone.
+
+Records behave like simple headers: they support ``record[KEYWORD]``, ``record[KEYWORD] = value``, ``KEYWORD in record``, :meth:`~HeaderRecord.get`, :meth:`~HeaderRecord.keys` and so on. ``FILENAME`` and ``OPENNAME`` are computed from the file name, unless the header had its own cards for them. Commentary cards (``COMMENT``, ``HISTORY`` and blank keywords) are dropped. When a full header is needed, e.g. for ``PO head``, :meth:`HeaderRecord.toheader` reads it from the file again.
+
+A :class:`LazyHeaderRecord` goes further, and keeps the raw header cards instead of the values. Each card is only parsed the first time its keyword is used, and the value is remembered. Reading headers lazily (see :meth:`FITSHeaderTable.read`) costs little more than reading the header bytes from the file, no matter how wide the headers are.
+
+.. autoclass:: HeaderRecord
+    :members:
+
+.. autoclass:: LazyHeaderRecord
+    :members:
+
+"""
+from __future__ import (absolute_import, unicode_literals, division,
+                        print_function)
+
+import os, os.path
+import collections
+import threading
+import warnings
+
+import numpy as np
+import six
+
+try:
+    import astropy.io.fits as pf
+except ImportError as e:
+    try:
+        import pyfits as pf
+    except ImportError:
+        raise e
+
+COMMENTARY = set(["", "COMMENT", "HISTORY"])
+"""Keywords which are not kept in records."""
+
+_KEYWORDS = collections.OrderedDict()
+_LAYOUTS = collections.OrderedDict()
+_SHARED_LOCK = threading.Lock()
+
+MAX_KEYWORDS = 4096
+"""The number of distinct keywords which are shared between records."""
+
+MAX_LAYOUTS = 256
+"""The number of distinct layouts which are shared between records."""
+
+MAX_EXTENSIONS = 16
+"""The number of extended layouts remembered by each layout, see :meth:`_Layout.extend`."""
+
+def _share(shared, limit, key, value):
+    """Add `value` to a `shared` cache, unless another thread got there first, and forget the oldest entries beyond `limit`. Forgotten entries stay valid for records which already use them, they just aren't shared with new records."""
+    with _SHARED_LOCK:
+        value = shared.setdefault(key, value)
+        while len(shared) > limit:
+            shared.popitem(last=False)
+    return value
+
+def _intern(keyword):
+    """Return the shared copy of an upper-case `keyword`."""
+    keyword = six.text_type(keyword).upper()
+    try:
+        return _KEYWORDS[keyword]
+    except KeyError:
+        return _share(_KEYWORDS, MAX_KEYWORDS, keyword, keyword)
+
+def _native(cards):
+    """Convert raw cards to the native string type, which :class:`~astropy.io.fits.Card` parses most reliably."""
+    if six.PY2 and isinstance(cards, six.text_type):
+        return cards.encode("latin-1")
+    if not six.PY2 and isinstance(cards, bytes):
+        return cards.decode("latin-1")
+    return cards
+
+def _readheader(filename, extension):
+    """Read the full header of a single `extension` of `filename`, scanning only as far as that header."""
+    from .scan import scan_header_strings
+    try:
+        return pf.Header.fromstring(_native(scan_header_strings(filename, hdus=extension + 1)[extension]))
+    except (ValueError, IndexError, IOError):
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            return pf.getheader(filename, extension, ignore_missing_end=True)
+
+class _Layout(object):
+    """The keywords of a record, and the position of each keyword's value. Layouts are shared between records."""
+
+    __slots__ = ('keys', 'positions', 'extensions')
+
+    def __init__(self, keys, positions=None):
+        self.keys = keys
+        if positions is None:
+            positions = {}
+            for i, key in enumerate(keys):
+                positions.setdefault(key, i)
+        self.positions = positions
+        self.extensions = {}
+
+    def extend(self, key):
+        """Return the layout with a new `key` appended.
+
+        Extended layouts are remembered, so records which gain the same keywords in the same order (e.g. when a table is normalized, or lazy records are searched) share them, and adding a keyword costs a single lookup. Only the first record pays for copying the keywords.
+        """
+        try:
+            return self.extensions[key]
+        except KeyError:
+            pass
+        positions = self.positions.copy()
+        positions[key] = len(self.keys)
+        layout = _Layout(self.keys + (key,), positions)
+        if len(self.extensions) < MAX_EXTENSIONS:
+            layout = self.extensions.setdefault(key, layout)
+        return layout
+
+def _layout(keys):
+    """Return the shared :class:`_Layout` for a tuple of interned `keys`."""
+    try:
+        return _LAYOUTS[keys]
+    except KeyError:
+        return _share(_LAYOUTS, MAX_LAYOUTS, keys, _Layout(keys))
+
+class HeaderRecord(object):
+    """A compact, header-like record of keyword values.
+
+    :param items: An iterable of ``(keyword, value)`` pairs. Only the first value of each keyword is kept.
+    :param string filename: The file this header was read from.
+    :param int extension: The HDU number of this header in `filename`.
+
+    """
+
+    __slots__ = ('_layout', '_values', 'filename', 'extension')
+
+    def __init__(self, items=(), filename=None, extension=0):
+        super(HeaderRecord, self).__init__()
+        keys, values, seen = [], [], set()
+        for key, value in items:
+            key = _intern(key)
+            if key not in seen:
+                seen.add(key)
+                keys.append(key)
+                values.append(value)
+        self._layout = _layout(tuple(keys))
+        self._values = values
+        self.filename = filename
+        self.extension = extension
+
+    @classmethod
+    def fromheader(cls, header, filename=None, extension=0):
+        """Create a record from an :class:`~astropy.io.fits.Header`.
+
+        :param header: The header.
+        :param string filename: The file name. By default, the ``filename`` attribute of `header` is used.
+        :param int extension: The HDU number of `header`.
+        :return: A new :class:`HeaderRecord`.
+
+        """
+        if filename is None:
+            filename = getattr(header, 'filename', None)
+        items = ( (card.keyword, card.value) for card in header.cards if card.keyword.upper() not in COMMENTARY )
+        return cls(items, filename, extension)
+
+    def toheader(self):
+        """Promote this record to a full :class:`~astropy.io.fits.Header`.
+
+        The header is read again from :attr:`filename`, with all of its cards and comments, using the block scanner in :mod:`~pyobserver.fits.scan` where possible. Values which have been set on this record are applied to the header, as are the ``FILENAME`` and ``OPENNAME`` cards. Records without a file name are converted directly.
+        """
+        if self.filename is None:
+            header = pf.Header()
+        else:
+            header = _readheader(self.filename, self.extension or 0)
+        for key, value in self.items():
+            if key not in header or header[key] != value:
+                header[key] = value
+        header.filename = self.filename
+        return header
+
+    def __repr__(self):
+        """Representation of this object."""
+        return "<{:s} {!r}[{:d}] {:d} keywords>".format(self.__class__.__name__, self.filename, self.extension or 0, len(self))
+
+    def __getstate__(self):
+        return (self._layout.keys, self._values, self.filename, self.extension)
+
+    def __setstate__(self, state):
+        keys, self._values, self.filename, self.extension = state
+        self._layout = _layout(tuple(_intern(key) for key in keys))
+
+    def _derived(self):
+        """The ``FILENAME`` and ``OPENNAME`` values which come from the file name, rather than from cards."""
+        if self.filename is None:
+            return []
+        derived = []
+        if "FILENAME" not in self._layout.positions:
+            derived.append(("FILENAME", os.path.basename(self.filename)))
+        if "OPENNAME" not in self._layout.positions:
+            derived.append(("OPENNAME", os.path.relpath(self.filename)))
+        return derived
+
+    def __getitem__(self, key):
+        key = key.upper()
+        try:
+            return self._values[self._layout.positions[key]]
+        except KeyError:
+            if self.filename is not None:
+                if key == "FILENAME":
+                    return os.path.basename(self.filename)
+                if key == "OPENNAME":
+                    return os.path.relpath(self.filename)
+            raise KeyError("Keyword '{}' not found.".format(key))
+
+    def __setitem__(self, key, value):
+        if isinstance(value, tuple):
+            # Header-style (value, comment) pairs. Comments are not kept.
+            value = value[0]
+        key = _intern(key)
+        position = self._layout.positions.get(key)
+        if position is None:
+            self._layout = self._layout.extend(key)
+            self._values.append(value)
+        else:
+            self._values[position] = value
+
+    def __contains__(self, key):
+        key = key.upper()
+        return key in self._layout.positions or (self.filename is not None and key in ("FILENAME", "OPENNAME"))
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self._values) + len(self._derived())
+
+    def get(self, key, default=None):
+        """Get the value of `key`, or `default` if it is missing."""
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        """The list of keywords in this record."""
+        return list(self._layout.keys) + [ key for key, value in self._derived() ]
+
+    def values(self):
+        """The list of values in this record."""
+        return list(self._values) + [ value for key, value in self._derived() ]
+
+    def items(self):
+        """The list of ``(keyword, value)`` pairs in this record."""
+        return list(zip(self._layout.keys, self._values)) + self._derived()
+
+    def copy(self):
+        """Return a copy of this record."""
+        return self.__class__(zip(self._layout.keys, self._values), self.filename, self.extension)
+
+
+class LazyHeaderRecord(HeaderRecord):
+    """A header record which keeps the raw header cards, and only parses a card when its keyword is used.
+
+    :param bytes cards: The raw header, as a string of 80-character cards.
+    :param string filename: The file this header was read from.
+    :param int extension: The HDU number of this header in `filename`.
+
+    Parsed values, and any values which are set on the record, are kept just like the values of a :class:`HeaderRecord`.
+    """
+
+    __slots__ = ('_cards', '_names', '_hierarch')
+
+    def __init__(self, cards, filename=None, extension=0):
+        super(LazyHeaderRecord, self).__init__((), filename, extension)
+        if isinstance(cards, six.text_type):
+            cards = cards.encode("latin-1")
+        self._cards = cards
+        self._names = None
+        self._hierarch = False
+
+    @property
+    def _card_layout(self):
+        """The shared :class:`_Layout` of the keyword of each card, found when it is first needed."""
+        if self._names is None:
+            from .scan import CARD, card_keywords
+            raw = np.frombuffer(self._cards, dtype=np.uint8, count=(len(self._cards) // CARD) * CARD).reshape(-1, CARD)
+            self._names = _layout(tuple(_intern(name.decode("ascii", "replace")) for name in card_keywords(raw)))
+        return self._names
+
+    def _parse(self, key):
+        """Parse the value of `key` from the raw cards, and remember it. Return ``True`` if the keyword was found."""
+        from .scan import CARD
+        names = self._card_layout
+        if key in names.positions and key not in _UNPARSED:
+            start = stop = names.positions[key]
+            stop += 1
+            while stop < len(names.keys) and names.keys[stop] == "CONTINUE":
+                stop += 1
+            card = pf.Card.fromstring(_native(self._cards[start * CARD:stop * CARD]))
+            HeaderRecord.__setitem__(self, key, card.value)
+            return True
+        if "HIERARCH" in names.positions and not self._hierarch:
+            # HIERARCH keywords are only known once their cards are parsed.
+            self._hierarch = True
+            for i, name in enumerate(names.keys):
+                if name == "HIERARCH":
+                    card = pf.Card.fromstring(_native(self._cards[i * CARD:(i + 1) * CARD]))
+                    if card.keyword.upper() not in self._layout.positions:
+                        HeaderRecord.__setitem__(self, card.keyword, card.value)
+            return key in self._layout.positions
+        return False
+
+    def project(self, keywords):
+        """Return a new lazy record with only the cards for `keywords`. See :func:`~pyobserver.fits.scan.project_header_string`."""
+        from .scan import project_header_string
+        return self.__class__(project_header_string(self._cards, keywords), self.filename, self.extension)
+
+    def tostring(self):
+        """The raw header cards, as a string."""
+        return self._cards.decode("latin-1")
+
+    def toheader(self):
+        """Promote this record to a full :class:`~astropy.io.fits.Header`, parsed from the raw cards.
+
+        Values which have been set on this record are applied to the header, as are the ``FILENAME`` and ``OPENNAME`` cards.
+        """
+        header = pf.Header.fromstring(_native(self._cards))
+        for key, value in HeaderRecord.items(self):
+            if key not in header or header[key] != value:
+                header[key] = value
+        header.filename = self.filename
+        return header
+
+    def __getstate__(self):
+        return (self._cards, HeaderRecord.__getstate__(self))
+
+    def __setstate__(self, state):
+        self._cards, state = state
+        self._names = None
+        self._hierarch = False
+        HeaderRecord.__setstate__(self, state)
+
+    def _derived(self):
+        if self.filename is None:
+            return []
+        return [ (key, value) for key, value in HeaderRecord._derived(self) if key not in self._card_layout.positions ]
+
+    def __getitem__(self, key):
+        key = key.upper()
+        if key not in self._layout.positions:
+            self._parse(key)
+        return HeaderRecord.__getitem__(self, key)
+
+    def __contains__(self, key):
+        key = key.upper()
+        if key in self._card_layout.positions and key not in _UNPARSED:
+            return True
+        if key not in self._layout.positions and not self._hierarch:
+            self._parse(key)
+        return HeaderRecord.__contains__(self, key)
+
+    def keys(self):
+        """The list of keywords in this record."""
+        if "HIERARCH" in self._card_layout.positions and not self._hierarch:
+            self._parse("HIERARCH")
+        keys = [ key for key in self._card_layout.keys if key not in _UNPARSED ]
+        keys += [ key for key in self._layout.keys if key not in self._card_layout.positions ]
+        keys += [ key for key, value in self._derived() ]
+        seen = set()
+        return [ key for key in keys if not (key in seen or seen.add(key)) ]
+
+    def values(self):
+        """The list of values in this record. Every card is parsed."""
+        return [ self[key] for key in self.keys() ]
+
+    def items(self):
+        """The list of ``(keyword, value)`` pairs in this record. Every card is parsed."""
+        return [ (key, self[key]) for key in self.keys() ]
+
+    def __len__(self):
+        return len(self.keys())
+
+    def copy(self):
+        """Return a copy of this record, which shares the raw cards."""
+        copy = self.__class__(self._cards, self.filename, self.extension)
+        for key, value in zip(self._layout.keys, self._values):
+            HeaderRecord.__setitem__(copy, key, value)
+        return copy
+
+_UNPARSED = COMMENTARY | set(["CONTINUE", "HIERARCH", "END"])
+"""Card keywords which are never parsed as values by a :class:`LazyHeaderRecord`."""
+
+collections.Mapping.register(HeaderRecord)
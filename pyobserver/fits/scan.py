@@ -0,0 +1,290 @@
+# -*- coding: utf-8 -*-
+#
+#  scan.py
+#  pyobserver
+#
+#  Created by Alexander Rudy on 2014-06-04.
+#  Copyright 2014 Alexander Rudy. All rights reserved.
+#
+"""
+:mod:`fits.scan` – Block-level FITS header scanner
+==================================================
+
+Opening a FITS file with :func:`astropy.io.fits.open` builds a full :class:`~astropy.io.fits.HDUList`, which is much more work than is required to read a few header keywords. This module scans FITS files directly. The file is memory mapped, and each 2880-byte block is viewed as a ``(36, 80)`` array of bytes, one row per card. Headers end at the ``END`` card, and data units are skipped using the ``BITPIX``, ``NAXISn``, ``PCOUNT`` and ``GCOUNT`` keywords, so the scanner never touches data.
+
+Gzipped files are inflated as a stream, see :mod:`~pyobserver.fits.compressed`. Tile-compressed images (``.fz`` files) are stored as binary tables, and their headers are translated back into image headers with :func:`image_cards`, without touching the compressed tiles.
+
+The scanner is used as the ``'scan'`` backend of :meth:`FITSHeaderTable.read`. Files which can't be scanned raise :exc:`ValueError`, and are read with astropy instead.
+
+.. autofunction:: scan_headers
+
+.. autofunction:: scan_header_strings
+
+.. autofunction:: iter_extents
+
+.. autofunction:: project_header_string
+
+.. autofunction:: image_cards
+
+"""
+from __future__ import (absolute_import, unicode_literals, division,
+                        print_function)
+
+import collections
+import itertools
+import mmap
+import re
+
+import numpy as np
+
+try:
+    import astropy.io.fits as pf
+except ImportError as e:
+    try:
+        import pyfits as pf
+    except ImportError:
+        raise e
+
+BLOCK = 2880
+"""The size of a FITS block, in bytes."""
+
+CARD = 80
+"""The size of a FITS header card, in bytes."""
+
+CARDS_PER_BLOCK = BLOCK // CARD
+
+GZIP_MAGIC = b"\x1f\x8b"
+"""The first two bytes of a gzip file."""
+
+_END = np.frombuffer(b"END     ", dtype=np.uint8)
+
+_STRUCTURAL = set([b"SIMPLE", b"XTENSION", b"BITPIX", b"NAXIS", b"PCOUNT", b"GCOUNT", b"GROUPS"])
+
+HDUExtent = collections.namedtuple("HDUExtent", ["header", "ncards", "data", "size"])
+"""The position of a single HDU in a FITS file: the byte offset of the `header`, the number of header cards before ``END`` (`ncards`), the byte offset of the `data` unit and the unpadded `size` of the data unit in bytes."""
+
+def padded(size):
+    """Round `size` up to a whole number of FITS blocks."""
+    return ((size + BLOCK - 1) // BLOCK) * BLOCK
+
+def card_keywords(cards):
+    """Return the keyword for each row of a ``(n, 80)`` byte array of cards, as an array of byte strings."""
+    return np.char.rstrip(np.ascontiguousarray(cards[:,:8]).view(str("S8")).ravel())
+
+def card_value(card):
+    """Return the raw value of a simple, un-quoted card as a stripped byte string."""
+    return card[10:].tobytes().split(b"/", 1)[0].strip()
+
+def project_cards(cards, keywords):
+    """Select the cards whose keywords are in `keywords`, from a ``(n, 80)`` byte array of cards.
+
+    :param cards: The ``(n, 80)`` array of header cards.
+    :param keywords: A collection of upper-case FITS keywords to keep.
+    :return: The ``(m, 80)`` array of selected cards.
+
+    ``CONTINUE`` cards are kept along with the card they continue. Keywords which are longer than 8 characters can only be written as ``HIERARCH`` cards, and so if any are requested, all ``HIERARCH`` cards are kept.
+    """
+    keywords = [ keyword.encode("ascii") if isinstance(keyword, type("")) else keyword for keyword in keywords ]
+    names = card_keywords(cards)
+    keep = np.isin(names, keywords)
+    if any(len(keyword) > 8 for keyword in keywords):
+        keep |= (names == b"HIERARCH")
+    for row in np.flatnonzero(names == b"CONTINUE"):
+        keep[row] = row > 0 and keep[row - 1]
+    return cards[keep]
+
+def project_header_string(raw, keywords):
+    """Select the cards whose keywords are in `keywords` from a raw header string. See :func:`project_cards`."""
+    if isinstance(raw, type("")):
+        raw = raw.encode("latin-1")
+    cards = np.frombuffer(raw, dtype=np.uint8, count=(len(raw) // CARD) * CARD).reshape(-1, CARD)
+    return project_cards(cards, keywords).tobytes()
+
+def end_card(block):
+    """Return the row of the ``END`` card in a ``(36, 80)`` byte array `block`, or ``None`` if it isn't there."""
+    end = np.flatnonzero((block[:,:8] == _END).all(axis=1))
+    return int(end[0]) if len(end) else None
+
+def _find_end(buf, offset):
+    """Find the ``END`` card of the header starting at `offset`, one block at a time.
+
+    :return: The number of cards before ``END`` and the number of blocks in the header.
+    """
+    size = len(buf)
+    nblocks = 0
+    while offset + (nblocks + 1) * BLOCK <= size:
+        block = np.frombuffer(buf, dtype=np.uint8, count=BLOCK, offset=offset + nblocks * BLOCK).reshape(CARDS_PER_BLOCK, CARD)
+        end = end_card(block)
+        nblocks += 1
+        if end is not None:
+            return (nblocks - 1) * CARDS_PER_BLOCK + end, nblocks
+    raise ValueError("No END card found for header at byte {:d}".format(offset))
+
+def _data_size(cards, primary):
+    """Compute the size of the data unit described by the structural keywords in `cards`."""
+    keywords = card_keywords(cards)
+    values = {}
+    structural = np.isin(keywords, list(_STRUCTURAL)) | np.char.startswith(keywords, b"NAXIS")
+    for row in np.flatnonzero(structural):
+        values.setdefault(keywords[row], card_value(cards[row]))
+
+    try:
+        bitpix = abs(int(values[b"BITPIX"]))
+        naxis = int(values.get(b"NAXIS", 0))
+        axes = [ int(values[b"NAXIS" + str(n).encode("ascii")]) for n in range(1, naxis + 1) ]
+        pcount = int(values.get(b"PCOUNT", 0))
+        gcount = int(values.get(b"GCOUNT", 1))
+    except (KeyError, ValueError) as e:
+        raise ValueError("Malformed structural keywords: {!s}".format(e))
+
+    if naxis == 0:
+        return 0
+    if primary and values.get(b"GROUPS") == b"T" and axes[0] == 0:
+        # Random groups: NAXIS1 = 0 is not a real axis.
+        axes = axes[1:]
+    return (bitpix // 8) * gcount * (pcount + int(np.prod(axes)))
+
+_ZRENAME = {
+    b"ZTENSION" : b"XTENSION",
+    b"ZBITPIX" : b"BITPIX",
+    b"ZNAXIS" : b"NAXIS",
+    b"ZPCOUNT" : b"PCOUNT",
+    b"ZGCOUNT" : b"GCOUNT",
+    b"ZEXTEND" : b"EXTEND",
+    b"ZBLOCKED" : b"BLOCKED",
+    b"ZHECKSUM" : b"CHECKSUM",
+    b"ZDATASUM" : b"DATASUM",
+}
+
+_ZDROP = re.compile(br"^(XTENSION|BITPIX|NAXIS\d*|PCOUNT|GCOUNT|TFIELDS|THEAP|T(TYPE|FORM|UNIT|NULL|SCAL|ZERO|DISP|DIM)\d+|CHECKSUM|DATASUM"
+    br"|ZIMAGE|ZSIMPLE|ZCMPTYPE|ZTILE\d+|ZNAME\d+|ZVAL\d+|ZMASKCMP|ZQUANTIZ|ZDITHER0)$")
+
+def _card(keyword, value):
+    """Format a simple card from a `keyword` and a raw `value`, as a row of bytes."""
+    image = keyword.ljust(8) + b"= " + value.rjust(20)
+    return np.frombuffer(image.ljust(CARD), dtype=np.uint8)
+
+def image_cards(cards):
+    """Convert the cards of a tile-compressed image (a ``BINTABLE`` with ``ZIMAGE = T``) into the cards of the image it holds.
+
+    :param cards: The ``(n, 80)`` array of the compressed header's cards.
+    :return: The ``(m, 80)`` array of image header cards, or `cards` if they don't describe a compressed image.
+
+    This is the same translation which :class:`~astropy.io.fits.CompImageHDU` makes, but it is done on the raw cards: the table structure and compression keywords are dropped, and ``ZBITPIX``, ``ZNAXISn`` and so on are renamed to ``BITPIX``, ``NAXISn``. No tile data is read.
+    """
+    names = card_keywords(cards)
+    zimage = np.flatnonzero(names == b"ZIMAGE")
+    if not len(zimage) or card_value(cards[zimage[0]]) != b"T":
+        return cards
+    structural, rest = {}, []
+    for row, name in enumerate(names):
+        name = bytes(name)
+        if name in _ZRENAME or (name.startswith(b"ZNAXIS") and name[6:].isdigit()):
+            structural.setdefault(_ZRENAME.get(name, name[1:]), row)
+        elif name == b"EXTNAME" and card_value(cards[row]).strip(b"'").strip() == b"COMPRESSED_IMAGE":
+            continue
+        elif not _ZDROP.match(name):
+            rest.append(row)
+
+    def renamed(keyword):
+        card = cards[structural[keyword]].copy()
+        card[:8] = np.frombuffer(keyword.ljust(8), dtype=np.uint8)
+        return card
+
+    header = [ renamed(b"XTENSION") if b"XTENSION" in structural else _card(b"XTENSION", b"'IMAGE   '") ]
+    naxis = int(card_value(cards[structural[b"NAXIS"]])) if b"NAXIS" in structural else 0
+    for keyword in [b"BITPIX", b"NAXIS"] + [ b"NAXIS" + str(n).encode("ascii") for n in range(1, naxis + 1) ]:
+        if keyword in structural:
+            header.append(renamed(keyword))
+    header.append(renamed(b"PCOUNT") if b"PCOUNT" in structural else _card(b"PCOUNT", b"0"))
+    header.append(renamed(b"GCOUNT") if b"GCOUNT" in structural else _card(b"GCOUNT", b"1"))
+    done = set([b"XTENSION", b"BITPIX", b"NAXIS", b"PCOUNT", b"GCOUNT"])
+    for row in sorted(rest + [ row for keyword, row in structural.items() if not (keyword in done or keyword.startswith(b"NAXIS")) ]):
+        name = bytes(names[row])
+        if name in _ZRENAME:
+            header.append(renamed(_ZRENAME[name]))
+        else:
+            header.append(cards[row])
+    return np.array(header, dtype=np.uint8).reshape(-1, CARD)
+
+def header_cards(cards, keywords=None):
+    """Prepare the raw cards of a single header: translate compressed images with :func:`image_cards`, then select `keywords` with :func:`project_cards`.
+
+    :return: The header cards as a byte string.
+    """
+    cards = image_cards(cards)
+    if keywords is not None:
+        cards = project_cards(cards, keywords)
+    return cards.tobytes()
+
+def iter_extents(buf):
+    """Walk the HDUs in a FITS file buffer.
+
+    :param buf: A buffer (usually a :class:`mmap.mmap`) containing a whole FITS file.
+    :return: A generator of :class:`HDUExtent` tuples, one for each HDU.
+
+    Scanning stops at the end of the buffer, or at the first header which doesn't begin with an ``XTENSION`` card. :exc:`ValueError` is raised if the buffer doesn't begin with a ``SIMPLE`` card, or if a header can't be scanned.
+    """
+    offset = 0
+    size = len(buf)
+    if size < BLOCK or bytes(buf[:8]).rstrip() != b"SIMPLE":
+        raise ValueError("Not a FITS file, first card is {!r}".format(bytes(buf[:8])))
+    while offset + BLOCK <= size:
+        if bytes(buf[offset:offset+8]).rstrip() not in (b"SIMPLE", b"XTENSION"):
+            return
+        ncards, nblocks = _find_end(buf, offset)
+        cards = np.frombuffer(buf, dtype=np.uint8, count=ncards * CARD, offset=offset).reshape(ncards, CARD)
+        datasize = _data_size(cards, primary=(offset == 0))
+        del cards
+        data = offset + nblocks * BLOCK
+        yield HDUExtent(offset, ncards, data, datasize)
+        offset = data + padded(datasize)
+
+def _mapfile(filename):
+    """Memory-map `filename` for reading."""
+    with open(filename, 'rb') as stream:
+        return mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+
+def scan_header_strings(filename, keywords=None, hdus=None):
+    """Return the raw header of each HDU in `filename` as a byte string of 80-character cards (without the ``END`` card).
+
+    :param string filename: The FITS file name.
+    :param keywords: If given, only return cards for these upper-case keywords. See :func:`project_cards`.
+    :param int hdus: If given, stop after this many headers.
+    :raises ValueError: If the file isn't a FITS file which can be scanned.
+
+    Gzipped files are read with :func:`~pyobserver.fits.compressed.gzip_header_strings`. The headers of tile-compressed images are translated with :func:`image_cards`.
+    """
+    with open(filename, 'rb') as stream:
+        magic = stream.read(2)
+    if magic == GZIP_MAGIC:
+        from .compressed import gzip_header_strings
+        return gzip_header_strings(filename, keywords=keywords, hdus=hdus)
+    try:
+        buf = _mapfile(filename)
+    except (mmap.error, ValueError) as e:
+        raise ValueError("Can't map '{}': {!s}".format(filename, e))
+    try:
+        return [ header_cards(np.frombuffer(buf, dtype=np.uint8, count=extent.ncards * CARD, offset=extent.header).reshape(-1, CARD), keywords)
+            for extent in itertools.islice(iter_extents(buf), hdus) ]
+    finally:
+        try:
+            buf.close()
+        except BufferError:
+            # A traceback still holds an array view of the map, which will be closed when it is collected.
+            pass
+
+def scan_headers(filename, keywords=None, hdus=None):
+    """Return a list of all headers in `filename`, scanned without building an :class:`~astropy.io.fits.HDUList`.
+
+    This function returns the same ``(header, filename)`` pairs as :func:`~pyobserver.fits.core.silent_getheaders`, and does not touch the warnings filters.
+
+    :param string filename: The FITS file name.
+    :param keywords: If given, only parse cards for these upper-case keywords. Other cards are dropped before they are parsed.
+    :param int hdus: If given, stop after this many headers.
+    :raises ValueError: If the file isn't a FITS file which can be scanned.
+    """
+    headers = [ pf.Header.fromstring(raw) for raw in scan_header_strings(filename, keywords, hdus) ]
+    for header in headers:
+        header.filename = filename
+    return [(header, filename) for header in headers]
@@ -0,0 +1,300 @@
+# -*- coding: utf-8 -*-
+#
+#  spatial.py
+#  pyobserver
+#
+#  Created by Alexander Rudy on 2014-06-21.
+#  Copyright 2014 Alexander Rudy. All rights reserved.
+#
+"""
+:mod:`fits.spatial` – Sky position index
+========================================
+
+``PO fix`` compares the pointing of each frame to every target it has seen so far. A :class:`SkyIndex` holds labelled sky positions as unit vectors, bucketed into a grid of cubic cells whose size is set by the usual search radius. A search only looks at the cells near the search position, and computes the separations to the positions in those cells as a single :mod:`numpy` operation, so searches don't slow down as more targets are added.
+
+Positions are given as right ascension and declination in degrees, and radii and separations are :class:`~astropy.units.Quantity` angles.
+
+.. autoclass:: SkyIndex
+    :members:
+
+Pointings can also be clustered all at once with :func:`friends_of_friends`, which links every pair of positions closer than a linking length, using the same grid of cells.
+
+.. autofunction:: friends_of_friends
+
+Two catalogs, such as a starlist and the pointings of a set of frames, are matched with :func:`crossmatch`, which uses the same grid of cells.
+
+.. autofunction:: crossmatch
+
+Both compare the positions in a cell to its neighbours in blocks of rows:
+
+.. autodata:: BLOCK
+
+"""
+from __future__ import (absolute_import, unicode_literals, division,
+                        print_function)
+
+import itertools
+
+import numpy as np
+import astropy.units as u
+from astropy.coordinates import Angle
+
+def _degrees(value):
+    """Convert a header angle (a number, or a sexagesimal string) to degrees."""
+    try:
+        return float(value)
+    except ValueError:
+        return Angle(value, unit=u.deg).degree
+
+def unit_vectors(ra, dec):
+    """Convert right ascension and declination (in degrees) to an ``(n, 3)`` array of unit vectors."""
+    ra = np.radians(np.atleast_1d(np.asarray(ra, dtype=float)))
+    dec = np.radians(np.atleast_1d(np.asarray(dec, dtype=float)))
+    cos_dec = np.cos(dec)
+    return np.column_stack((cos_dec * np.cos(ra), cos_dec * np.sin(ra), np.sin(dec)))
+
+def angular_separation(vectors, vector):
+    """The angle (in radians) between each of an ``(n, 3)`` array of unit `vectors` and a single unit `vector`, accurate at small angles."""
+    cross = np.cross(vectors, vector)
+    return np.arctan2(np.sqrt((cross ** 2).sum(axis=-1)), vectors.dot(vector))
+
+def _chord(angle):
+    """The straight-line distance between two unit vectors separated by `angle`."""
+    return 2.0 * np.sin(min(u.Quantity(angle, u.deg).to(u.radian).value, np.pi) / 2.0)
+
+class SkyIndex(object):
+    """An index of labelled sky positions, for searches within a radius.
+
+    :param cell: The size of each grid cell, as an angle. Searches within about this radius look at no more than 27 cells. Angles without units are in degrees.
+
+    Each label has a single position. Adding a label again moves it to the new position.
+    """
+
+    def __init__(self, cell):
+        super(SkyIndex, self).__init__()
+        self._size = _chord(cell)
+        self._vectors = np.empty((16, 3), dtype=float)
+        self._labels = []
+        self._rows = {}
+        self._cells = {}
+
+    def __repr__(self):
+        """Representation of this object."""
+        return "<{:s} {:d} positions in {:d} cells>".format(self.__class__.__name__, len(self), len(self._cells))
+
+    def __len__(self):
+        """The number of labelled positions."""
+        return len(self._labels)
+
+    def __contains__(self, label):
+        """Whether `label` has a position in this index."""
+        return label in self._rows
+
+    def __iter__(self):
+        """Iterate over the labels."""
+        return iter(self._labels)
+
+    def _cell(self, vector):
+        """The grid cell for a unit vector."""
+        return tuple(np.floor(vector / self._size).astype(int))
+
+    def add(self, label, ra, dec):
+        """Add (or move) a labelled position.
+
+        :param label: Any hashable label, e.g. a target name.
+        :param float ra: The right ascension, in degrees.
+        :param float dec: The declination, in degrees.
+
+        """
+        vector = unit_vectors(ra, dec)[0]
+        row = self._rows.get(label)
+        if row is None:
+            row = len(self._labels)
+            if row >= len(self._vectors):
+                self._vectors = np.concatenate((self._vectors, np.empty_like(self._vectors)))
+            self._labels.append(label)
+            self._rows[label] = row
+        else:
+            self._discard(row)
+        self._vectors[row] = vector
+        self._cells.setdefault(self._cell(vector), set()).add(row)
+
+    def _discard(self, row):
+        """Remove a row from its grid cell."""
+        cell = self._cell(self._vectors[row])
+        rows = self._cells[cell]
+        rows.discard(row)
+        if not rows:
+            del self._cells[cell]
+
+    def position(self, label):
+        """The position of `label`, as a tuple of right ascension and declination in degrees."""
+        x, y, z = self._vectors[self._rows[label]]
+        return np.degrees(np.arctan2(y, x)) % 360.0, np.degrees(np.arcsin(np.clip(z, -1.0, 1.0)))
+
+    def within(self, ra, dec, radius):
+        """Find the positions within `radius` of a position.
+
+        :param float ra: The right ascension, in degrees.
+        :param float dec: The declination, in degrees.
+        :param radius: The search radius, as an angle.
+        :return: A tuple of the list of labels, and a :class:`~astropy.units.Quantity` array of their separations, sorted from the nearest.
+
+        """
+        vector = unit_vectors(ra, dec)[0]
+        reach = int(np.ceil(_chord(radius) / self._size))
+        if (2 * reach + 1) ** 3 >= len(self._cells):
+            rows = np.arange(len(self._labels))
+        else:
+            center = self._cell(vector)
+            rows = []
+            for offset in itertools.product(range(-reach, reach + 1), repeat=3):
+                rows.extend(self._cells.get(tuple(c + o for c, o in zip(center, offset)), ()))
+            rows = np.array(rows, dtype=int)
+        separations = angular_separation(self._vectors[rows], vector)
+        keep = separations <= u.Quantity(radius, u.deg).to(u.radian).value
+        rows, separations = rows[keep], separations[keep]
+        order = np.argsort(separations, kind='mergesort')
+        return [ self._labels[row] for row in rows[order] ], (separations[order] * u.radian).to(u.deg)
+
+    def nearest(self, ra, dec, radius):
+        """Find the nearest position within `radius` of a position.
+
+        :return: A tuple of the label and its separation, or ``(None, None)`` if there isn't a position within `radius`.
+
+        """
+        labels, separations = self.within(ra, dec, radius)
+        if not len(labels):
+            return None, None
+        return labels[0], separations[0]
+
+BLOCK = 512
+"""The number of rows which are compared to a cell at once, so that memory use doesn't grow with the square of the number of positions in a cell."""
+
+def _within(vectors, others, size):
+    """A boolean array of which pairs of `vectors` and `others` are closer than the chord `size`, summed one coordinate at a time."""
+    distance = np.zeros((len(vectors), len(others)))
+    for axis in range(3):
+        distance += np.subtract.outer(vectors[:, axis], others[:, axis]) ** 2
+    return distance <= size ** 2
+
+def _roots(labels, nodes):
+    """Follow the parent pointers in `labels` from each of `nodes` to the root of its component."""
+    roots = labels[nodes]
+    while True:
+        parents = labels[roots]
+        if (parents == roots).all():
+            return roots
+        roots = parents
+
+def _link(labels, first, second):
+    """Join the components of the `first` and `second` node of each edge, in place. Each root points to the smallest root it has been joined to."""
+    while len(first):
+        a, b = _roots(labels, first), _roots(labels, second)
+        keep = a != b
+        first, second, a, b = first[keep], second[keep], a[keep], b[keep]
+        # Where a root is given several parents at once, one write wins, and the other edges are joined on the next pass.
+        labels[np.maximum(a, b)] = np.minimum(a, b)
+
+def _join(labels, rows, columns, close):
+    """Join the components of `rows` and `columns` wherever `close` (a boolean array with a row for each of `rows` and a column for each of `columns`) is true, in place.
+
+    Rather than listing every close pair, each row is joined to its close column with the smallest root, and each column to its close row with the smallest root, until every close pair shares a root.
+    """
+    while True:
+        row_roots, column_roots = _roots(labels, rows), _roots(labels, columns)
+        apart = close & (row_roots[:, None] != column_roots[None, :])
+        if not apart.any():
+            return
+        i, j = np.flatnonzero(apart.any(axis=1)), np.flatnonzero(apart.any(axis=0))
+        _link(labels, rows[i], columns[np.where(apart[i], column_roots[None, :], len(labels)).argmin(axis=1)])
+        _link(labels, columns[j], rows[np.where(apart[:, j], row_roots[:, None], len(labels)).argmin(axis=0)])
+
+def _ranked(labels):
+    """Number the components in `labels` from zero, in order of the first node in each component."""
+    roots, start, inverse = np.unique(_roots(labels, np.arange(len(labels))), return_index=True, return_inverse=True)
+    rank = np.empty(len(roots), dtype=int)
+    rank[np.argsort(start, kind='mergesort')] = np.arange(len(roots))
+    return rank[inverse.ravel()]
+
+def _buckets(vectors, size):
+    """Bucket unit vectors into grid cells of `size`.
+
+    :return: A tuple of the list of cell keys, the list of arrays of the rows in each cell, and a dictionary mapping keys to cell numbers.
+    """
+    cells = np.floor(vectors / size).astype(np.int64)
+    keys, inverse = np.unique(np.ascontiguousarray(cells).view([(str('x'), np.int64), (str('y'), np.int64), (str('z'), np.int64)]).ravel(), return_inverse=True)
+    inverse = inverse.ravel()
+    order = np.argsort(inverse, kind='mergesort')
+    bounds = np.searchsorted(inverse[order], np.arange(len(keys) + 1))
+    members = [ order[bounds[cell]:bounds[cell + 1]] for cell in range(len(keys)) ]
+    keys = [ tuple(key) for key in keys.tolist() ]
+    lookup = dict((key, cell) for cell, key in enumerate(keys))
+    return keys, members, lookup
+
+def friends_of_friends(ra, dec, linking_length):
+    """Cluster positions, where any two positions closer than `linking_length` are in the same cluster.
+
+    :param ra: An array of right ascensions, in degrees.
+    :param dec: An array of declinations, in degrees.
+    :param linking_length: The linking length, as an angle.
+    :return: An array of cluster numbers, one per position, numbered from zero in order of the first position in each cluster.
+
+    Positions are bucketed into grid cells as large as the linking length, and only positions in the same or neighbouring cells are compared. Rows of each cell are compared to the same and neighbouring cells in blocks of :data:`BLOCK` rows, with a single :mod:`numpy` operation per block, and the links found in each block are merged into a union-find array of cluster labels straight away, so memory use grows with the number of positions rather than the number of linked pairs.
+    """
+    vectors = unit_vectors(ra, dec)
+    if not len(vectors):
+        return np.zeros(0, dtype=int)
+    size = _chord(linking_length)
+    keys, members, lookup = _buckets(vectors, size)
+    offsets = [ offset for offset in itertools.product((-1, 0, 1), repeat=3) if offset > (0, 0, 0) ]
+    
+    labels = np.arange(len(vectors))
+    for cell, key in enumerate(keys):
+        rows = members[cell]
+        neighbours = [ members[lookup[neighbour]] for neighbour in (tuple(k + o for k, o in zip(key, offset)) for offset in offsets) if neighbour in lookup ]
+        for start in range(0, len(rows), BLOCK):
+            block = rows[start:start + BLOCK]
+            # Rows are compared to the rest of their own cell, and to the following neighbouring cells.
+            orows = np.concatenate([rows[start:]] + neighbours)
+            _join(labels, block, orows, _within(vectors[block], vectors[orows], size))
+    return _ranked(labels)
+
+def crossmatch(ra, dec, other_ra, other_dec, radius):
+    """Find every pair of positions from two catalogs which are within `radius` of each other.
+
+    :param ra: An array of right ascensions for the first catalog, in degrees.
+    :param dec: An array of declinations for the first catalog, in degrees.
+    :param other_ra: An array of right ascensions for the second catalog, in degrees.
+    :param other_dec: An array of declinations for the second catalog, in degrees.
+    :param radius: The matching radius, as an angle.
+    :return: A tuple of the array of rows in the first catalog, the array of rows in the second catalog, and a :class:`~astropy.units.Quantity` array of the separation of each pair in degrees, sorted by the first row and then by separation.
+
+    Both catalogs are bucketed into grid cells as large as `radius`, and each cell of the first catalog is compared to the same and neighbouring cells of the second catalog in blocks of :data:`BLOCK` rows, with a single :mod:`numpy` operation per block. Only the matched pairs are kept from each block.
+    """
+    vectors, others = unit_vectors(ra, dec), unit_vectors(other_ra, other_dec)
+    if not len(vectors) or not len(others):
+        return np.zeros(0, dtype=int), np.zeros(0, dtype=int), np.zeros(0, dtype=float) * u.deg
+    size = _chord(radius)
+    keys, members, lookup = _buckets(vectors, size)
+    okeys, omembers, olookup = _buckets(others, size)
+    offsets = list(itertools.product((-1, 0, 1), repeat=3))
+    
+    first, second = [np.zeros(0, dtype=int)], [np.zeros(0, dtype=int)]
+    for cell, key in enumerate(keys):
+        rows = members[cell]
+        orows = [ omembers[olookup[neighbour]] for neighbour in (tuple(k + o for k, o in zip(key, offset)) for offset in offsets) if neighbour in olookup ]
+        if not len(orows):
+            continue
+        orows = np.concatenate(orows)
+        ovectors = others[orows]
+        for start in range(0, len(rows), BLOCK):
+            block = rows[start:start + BLOCK]
+            i, j = np.nonzero(_within(vectors[block], ovectors, size))
+            first.append(block[i])
+            second.append(orows[j])
+    first, second = np.concatenate(first), np.concatenate(second)
+    cross = np.cross(vectors[first], others[second]).reshape(-1, 3)
+    separations = np.arctan2(np.sqrt((cross ** 2).sum(axis=-1)), (vectors[first] * others[second]).sum(axis=-1))
+    order = np.lexsort((separations, first))
+    return first[order], second[order], (separations[order] * u.radian).to(u.deg)
@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+#
+#  stream.py
+#  pyobserver
+#
+#  Created by Alexander Rudy on 2014-06-20.
+#  Copyright 2014 Alexander Rudy. All rights reserved.
+#
+"""
+:mod:`fits.stream` – Streaming table output
+===========================================
+
+:meth:`~pyobserver.fits.core.FITSHeaderTable.table` and :mod:`astropy.io.ascii` need every row before they can write anything, because the width of each column depends on every value. The writers in this module write one row at a time, as each header passes the search, so the first rows of ``PO list`` or ``PO log`` appear while the rest of the files are still being read.
+
+Three formats are available, by name in :data:`WRITERS`:
+
+- ``ndjson``: One JSON object per line, mapping column names to values. Missing values are ``null``.
+- ``tsv``: Tab separated values, with a header line. Missing values are empty.
+- ``fixed``: Fixed width columns, like ``ascii.fixed_width``. Column widths are either given up front, or sampled from the first :attr:`FixedWidthWriter.SAMPLE` rows. Later values which are wider than their column are not truncated.
+
+Each writer records the time between its creation and the first row, in :attr:`RowWriter.latency`.
+
+.. autofunction:: write_rows
+
+.. autoclass:: RowWriter
+    :members:
+
+.. autoclass:: NDJSONWriter
+
+.. autoclass:: TSVWriter
+
+.. autoclass:: FixedWidthWriter
+
+"""
+from __future__ import (absolute_import, unicode_literals, division,
+                        print_function)
+
+import io
+import json
+import time
+
+import six
+
+try:
+    import astropy.io.fits as pf
+except ImportError as e:
+    try:
+        import pyfits as pf
+    except ImportError:
+        raise e
+
+def _value(value):
+    """Convert a header value into a plain python value, or ``None`` if it is missing."""
+    if value is None or isinstance(value, pf.card.Undefined):
+        return None
+    if isinstance(value, (bool, float) + six.integer_types + six.string_types):
+        return value
+    return six.text_type(value)
+
+def _text(value):
+    """Format a header value as text. Missing values are empty."""
+    value = _value(value)
+    if value is None:
+        return ""
+    return six.text_type(value)
+
+class RowWriter(object):
+    """Write a table to a stream, one row at a time.
+
+    :param stream: The file-like object to write to. Text is encoded as UTF-8 for streams which aren't text streams (e.g. a pipe to ``less``).
+    :param names: The list of column names.
+    :param bool header: Whether to write a header line of column names, for formats which have one.
+
+    Subclasses implement :meth:`format`, and can override :meth:`begin` to write a header. Call :meth:`write` for each row, and :meth:`close` at the end.
+    """
+
+    FLUSH = 0.1
+    """The number of seconds between flushes of the stream, so that rows appear promptly without a flush for every row."""
+
+    def __init__(self, stream, names, header=True):
+        super(RowWriter, self).__init__()
+        self.stream = stream
+        self.names = list(names)
+        self.header = header
+        self.rows = 0
+        self.latency = None
+        self._binary = not isinstance(stream, io.TextIOBase)
+        self._start = self._flushed = time.time()
+
+    def __repr__(self):
+        """Representation of this object."""
+        return "<{:s} {:d} rows>".format(self.__class__.__name__, self.rows)
+
+    def _write(self, text):
+        """Write `text` to the stream."""
+        self.stream.write(text.encode("utf-8") if self._binary else text)
+
+    def begin(self):
+        """Write anything which comes before the first row."""
+        pass
+
+    def format(self, values):
+        """Format a single row of values as a line of text, including the trailing newline."""
+        raise NotImplementedError
+
+    def write(self, values):
+        """Write a single row.
+
+        :param values: The list of values for the row, in the same order as :attr:`names`.
+
+        """
+        if not self.rows:
+            self.begin()
+        self._write(self.format(values))
+        self.rows += 1
+        now = time.time()
+        if self.latency is None:
+            self.latency = now - self._start
+        if self.rows == 1 or now - self._flushed > self.FLUSH:
+            self.stream.flush()
+            self._flushed = now
+
+    def close(self):
+        """Finish the table, and flush the stream. The stream is not closed.
+
+        :return: The number of rows written.
+        """
+        if not self.rows:
+            self.begin()
+        self.stream.flush()
+        return self.rows
+
+class NDJSONWriter(RowWriter):
+    """Write one JSON object per row."""
+
+    def format(self, values):
+        """Format a row as a JSON object."""
+        return json.dumps(dict(zip(self.names, [ _value(value) for value in values ])), sort_keys=True) + "\n"
+
+class TSVWriter(RowWriter):
+    """Write tab separated values, with a header line of column names. Tabs and newlines in values are replaced by spaces."""
+
+    def begin(self):
+        """Write the column names."""
+        if self.header:
+            self._write("\t".join(self.names) + "\n")
+
+    def format(self, values):
+        """Format a row as tab separated values."""
+        return "\t".join(_text(value).replace("\t", " ").replace("\n", " ") for value in values) + "\n"
+
+class FixedWidthWriter(RowWriter):
+    """Write fixed width columns, separated by spaces, with a header line of column names.
+
+    :param widths: The width of each column. If not given, the widths are set from the column names and the first :attr:`SAMPLE` rows, which are held back until the widths are known.
+
+    """
+
+    SAMPLE = 100
+    """The number of rows used to set column widths."""
+
+    def __init__(self, stream, names, widths=None, header=True):
+        super(FixedWidthWriter, self).__init__(stream, names, header)
+        self.widths = None if widths is None else list(widths)
+        if self.widths is not None and len(self.widths) != len(self.names):
+            raise ValueError("Expected {:d} column widths, got {:d}".format(len(self.names), len(self.widths)))
+        self._sample = []
+
+    def begin(self):
+        """Write the column names."""
+        if self.header:
+            self._write(self.format(self.names))
+
+    def format(self, values):
+        """Format a row as fixed width columns."""
+        return " ".join(_text(value).ljust(width) for value, width in zip(values, self.widths)).rstrip() + "\n"
+
+    def write(self, values):
+        """Write a single row. While the column widths are being sampled, rows are held back."""
+        if self.widths is not None:
+            return super(FixedWidthWriter, self).write(values)
+        self._sample.append([ _text(value) for value in values ])
+        if len(self._sample) >= self.SAMPLE:
+            self._release()
+
+    def _release(self):
+        """Set the column widths from the sampled rows, and write them."""
+        rows = self._sample
+        self._sample = []
+        self.widths = [ len(name) if self.header else 0 for name in self.names ]
+        for row in rows:
+            self.widths = [ max(width, len(value)) for width, value in zip(self.widths, row) ]
+        for row in rows:
+            super(FixedWidthWriter, self).write(row)
+
+    def close(self):
+        """Write any rows held back for sampling, and finish the table."""
+        if self.widths is None:
+            self._release()
+        return super(FixedWidthWriter, self).close()
+
+WRITERS = {
+    'ndjson' : NDJSONWriter,
+    'tsv' : TSVWriter,
+    'fixed' : FixedWidthWriter,
+}
+"""The streaming writers, by format name."""
+
+def write_rows(writer, headers, keys):
+    """Write a row for each header, as it is produced.
+
+    :param writer: A :class:`RowWriter`.
+    :param headers: An iterable of headers, such as a generator from :func:`~pyobserver.fits.core.iter_headers`.
+    :param keys: The header keyword for each column of `writer`.
+    :return: The number of rows written.
+
+    """
+    for header in headers:
+        writer.write([ header.get(key, None) for key in keys ])
+    return writer.close()
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+#
+#  helpers.py
+#  pyobserver
+#
+#  Headers and FITS files shared between tests.
+#
+from __future__ import (absolute_import, unicode_literals, division,
+                        print_function)
+
+import numpy as np
+
+from astropy.io import fits
+
+def make_header(name, **cards):
+    """A header like those read from the file `name`, with an OPENNAME card and the given cards. Cards which are ``None`` are left out."""
+    header = fits.Header()
+    header["OPENNAME"] = name
+    for keyword, value in sorted(cards.items()):
+        if value is not None:
+            header[keyword] = value
+    header.filename = name
+    return header
+
+def write_fits(filename, extensions=0, **cards):
+    """Write a small FITS file with the given primary header cards, and some image extensions."""
+    primary = fits.PrimaryHDU(np.zeros((4, 4), dtype=np.float32))
+    for keyword, value in sorted(cards.items()):
+        primary.header[keyword] = value
+    HDUs = [primary] + [ fits.ImageHDU(np.zeros((2, 2), dtype=np.float32), name="EXT{:d}".format(i)) for i in range(extensions) ]
+    fits.HDUList(HDUs).writeto(str(filename), overwrite=True)
+    return str(filename)
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+#
+#  test_fits_aggregate.py
+#  pyobserver
+#
+#  Tests for aggregates computed while grouping headers.
+#
+from __future__ import (absolute_import, unicode_literals, division,
+                        print_function)
+
+import pickle
+
+import pytest
+
+from astropy.io import fits
+
+from pyobserver.fits.aggregate import Aggregates
+from pyobserver.fits.core import FITSDataGroups
+
+from .helpers import make_header
+
+HEADERS = [
+    make_header("a.fits", OBJECT="M31", EXPTIME=30, COADDS=2, DATE="2014-06-01"),
+    make_header("b.fits", OBJECT="M31", EXPTIME=2.5, COADDS=4, DATE="2014-06-03"),
+    make_header("c.fits", OBJECT="M31", EXPTIME="long", DATE="2014-06-02"),
+    make_header("d.fits", OBJECT="M31", EXPTIME=True),
+    make_header("e.fits", OBJECT="M33", COADDS=1),
+]
+
+def _result(aggregates, headers):
+    """The aggregate values for `headers`."""
+    return aggregates.result(aggregates.extend(aggregates.start(), headers))
+
+def test_values():
+    """Sums and means only use numbers, and other operations use any value."""
+    aggregates = Aggregates([("EXPTIME", "sum"), ("EXPTIME", "mean"), ("EXPTIME", "count"), ("COADDS", "max"), ("DATE", "min"), ("DATE", "max")])
+    assert _result(aggregates, HEADERS[:4]) == {
+        "sum(EXPTIME)" : 32.5,
+        "mean(EXPTIME)" : 16.25,
+        "count(EXPTIME)" : 4,
+        "max(COADDS)" : 4,
+        "min(DATE)" : "2014-06-01",
+        "max(DATE)" : "2014-06-03",
+    }
+    assert aggregates.names == ["sum(EXPTIME)", "mean(EXPTIME)", "count(EXPTIME)", "max(COADDS)", "min(DATE)", "max(DATE)"]
+
+def test_product():
+    """Products of keywords skip headers which are missing any of them."""
+    aggregates = Aggregates({"EXPTIME*COADDS" : ("sum", "count")})
+    assert _result(aggregates, HEADERS) == {"sum(EXPTIME*COADDS)" : 70.0, "count(EXPTIME*COADDS)" : 2}
+    assert aggregates.keywords == ["EXPTIME", "COADDS"]
+
+def test_missing():
+    """Columns without any values are ``None``, except for counts, which are zero."""
+    aggregates = Aggregates({"EXPTIME" : ("sum", "mean", "min", "count")})
+    assert _result(aggregates, HEADERS[4:]) == {"sum(EXPTIME)" : None, "mean(EXPTIME)" : None, "min(EXPTIME)" : None, "count(EXPTIME)" : 0}
+    assert _result(aggregates, []) == _result(aggregates, HEADERS[4:])
+
+def test_undefined():
+    """Undefined values are skipped, like missing keywords."""
+    header = make_header("f.fits", EXPTIME=10)
+    header["EXPTIME"] = fits.card.Undefined()
+    aggregates = Aggregates({"EXPTIME" : ("sum", "count")})
+    assert _result(aggregates, [header, HEADERS[0]]) == {"sum(EXPTIME)" : 30, "count(EXPTIME)" : 1}
+
+def test_combine():
+    """Combining the states of separate headers gives the same result as adding them together, even when one state is empty."""
+    aggregates = Aggregates({"EXPTIME" : ("sum", "mean", "max", "count")})
+    first = aggregates.extend(aggregates.start(), HEADERS[:2])
+    second = pickle.loads(pickle.dumps(aggregates.extend(aggregates.start(), HEADERS[2:]), protocol=2))
+    empty = aggregates.start()
+    assert aggregates.result(aggregates.combine(first, second)) == _result(aggregates, HEADERS)
+    assert aggregates.result(aggregates.combine(empty, first)) == _result(aggregates, HEADERS)
+
+def test_parse():
+    """Aggregates are parsed from the command line, and unknown operations are errors."""
+    aggregates = Aggregates.parse(["exptime=sum,MAX", "ITIME*COADDS=sum"])
+    assert aggregates.names == ["sum(EXPTIME)", "max(EXPTIME)", "sum(ITIME*COADDS)"]
+    assert aggregates == Aggregates([("EXPTIME", "sum"), ("EXPTIME", "max"), ("ITIME*COADDS", "sum")])
+    assert aggregates != Aggregates({"EXPTIME" : "sum"})
+    with pytest.raises(ValueError):
+        Aggregates.parse(["EXPTIME"])
+    with pytest.raises(ValueError):
+        Aggregates({"EXPTIME" : "median"})
+
+def test_groups():
+    """Each group has its own aggregates, and groups without values are masked in the table."""
+    groups = FITSDataGroups(["OBJECT"], aggregates={"EXPTIME" : ("sum", "count"), "COADDS" : "max"}).update(HEADERS)
+    assert [ groups.aggregate(group) for group in sorted(groups, key=lambda group : group.name) ] == [
+        {"sum(EXPTIME)" : 32.5, "count(EXPTIME)" : 4, "max(COADDS)" : 4},
+        {"sum(EXPTIME)" : None, "count(EXPTIME)" : 0, "max(COADDS)" : 1},
+    ]
+    table = groups.table()
+    assert list(table["Name"]) == ["M31", "M33"]
+    assert list(table["sum(EXPTIME)"].mask) == [False, True]
+    assert list(table["count(EXPTIME)"]) == [4, 0]
+    assert list(table["max(COADDS)"]) == [4, 1]
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+#
+#  test_fits_calib.py
+#  pyobserver
+#
+#  Tests for the calibration association index.
+#
+from __future__ import (absolute_import, unicode_literals, division,
+                        print_function)
+
+import numpy as np
+import pytest
+
+from pyobserver.fits.calib import CalibrationIndex
+
+from .helpers import make_header
+
+def _header(name, time, exptime=30, filter="Kbb", **cards):
+    """A header with an observation time and a configuration."""
+    cards.update({"DATE-OBS" : time, "EXPTIME" : exptime, "FILTER" : filter})
+    return make_header(name, **cards)
+
+@pytest.fixture
+def darks():
+    """Darks in two configurations, added out of order."""
+    return [
+        _header("d3", "2014-06-20T03:00:00"),
+        _header("d1", "2014-06-20T01:00:00"),
+        _header("d2", "2014-06-20T02:00:00"),
+        _header("d4", "2014-06-20T02:30:00", exptime=60),
+        _header("dx", None),
+        _header("dy", "2014-06-20T02:00:00", exptime=None),
+        _header("dz", "not a time"),
+    ]
+
+@pytest.fixture
+def index(darks):
+    """An index of darks, matched on exposure time and filter."""
+    index = CalibrationIndex(["EXPTIME", "FILTER"])
+    assert index.update(darks) == 5
+    return index
+
+def _brute(darks, header, n, within=None):
+    """The nearest darks to `header` by brute force."""
+    keys = ("EXPTIME", "FILTER")
+    time = np.datetime64(header["DATE-OBS"], "ms").astype(np.int64) / 1e3
+    matches = []
+    for dark in darks:
+        if any(dark.get(key) != header.get(key) or key not in dark for key in keys) or "DATE-OBS" not in dark:
+            continue
+        try:
+            offset = np.datetime64(dark["DATE-OBS"], "ms").astype(np.int64) / 1e3 - time
+        except ValueError:
+            continue
+        if within is None or abs(offset) <= within:
+            matches.append((abs(offset), dark["OPENNAME"], offset))
+    return [ (name, offset) for distance, name, offset in sorted(matches)[:n] ]
+
+def test_nearest(index):
+    """The nearest calibration in the same configuration."""
+    (dark, offset), = index.nearest(_header("s", "2014-06-20T02:20:00"))
+    assert dark["OPENNAME"] == "d2"
+    assert offset == -1200.0
+    assert index.nearest(_header("s", "2014-06-20T02:20:00", exptime=60))[0][0]["OPENNAME"] == "d4"
+    assert index.nearest(_header("s", "2014-06-20T02:20:00", exptime=10)) == []
+    assert index.nearest(_header("s", None)) == []
+
+def test_nearest_n(index):
+    """Several calibrations, from the nearest, limited by time."""
+    science = _header("s", "2014-06-20T02:50:00")
+    assert [ (dark["OPENNAME"], offset) for dark, offset in index.nearest(science, n=5) ] == [("d3", 600.0), ("d2", -3000.0), ("d1", -6600.0)]
+    assert [ dark["OPENNAME"] for dark, offset in index.nearest(science, n=5, within=3600) ] == ["d3", "d2"]
+
+def test_associate(index, darks):
+    """Associations for many frames match a brute force search."""
+    random = np.random.RandomState(7)
+    science = [ _header("s{:d}".format(i), "2014-06-20T{:02d}:{:02d}:{:02d}".format(*random.randint(0, 60, 3) % [5, 60, 60]),
+        exptime=random.choice([30, 60, 10])) for i in range(40) ]
+    results = index.associate(science, n=2, within=5400)
+    assert [ header for header, matches in results ] == science
+    for header, matches in results:
+        assert [ (dark["OPENNAME"], offset) for dark, offset in matches ] == _brute(darks, header, 2, 5400)
+
+def test_split_time():
+    """Dates and times of day in separate keywords are joined."""
+    index = CalibrationIndex(["FILTER"], time=("DATE-OBS", "UTC"))
+    index.add(_header("d1", "2014-06-20", UTC="01:00:00"))
+    index.add(_header("d2", "2014-06-20", UTC="03:00:00"))
+    science = _header("s", "2014-06-20", UTC="02:45:00")
+    assert index.timestamp(science) == "2014-06-20T02:45:00"
+    assert index.nearest(science)[0][0]["OPENNAME"] == "d2"
+
+def test_add_after_search(index):
+    """Calibrations added after a search are found by the next search."""
+    science = _header("s", "2014-06-20T02:20:00")
+    assert index.nearest(science)[0][0]["OPENNAME"] == "d2"
+    index.add(_header("d5", "2014-06-20T02:21:00"))
+    assert index.nearest(science)[0][0]["OPENNAME"] == "d5"
+    # The dark with an unreadable time is dropped when its configuration is sorted.
+    assert len(index) == 5
+    assert index.configurations == set([(30, "Kbb"), (60, "Kbb")])
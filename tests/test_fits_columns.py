@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+#
+#  test_fits_columns.py
+#  pyobserver
+#
+#  Tests for columnar FITS header collections.
+#
+from __future__ import (absolute_import, unicode_literals, division,
+                        print_function)
+
+import re
+
+import numpy as np
+import pytest
+
+from pyobserver.fits.core import FITSHeaderTable
+from pyobserver.fits.columns import FITSHeaderColumns, HeaderColumn, ColumnBuilder
+from pyobserver.fits.query import Query
+
+from .helpers import make_header
+
+def _headers():
+    """Headers with a mixed numeric column, a boolean column and a missing string value. Searches for ``False`` change headers, so each test gets new ones."""
+    return [
+        make_header("a.fits", OBJECT="M31", EXPTIME=30, AIRMASS=1.1, FLAG=True),
+        make_header("b.fits", OBJECT="M31", EXPTIME=2.5, AIRMASS=1.2, FLAG=False),
+        make_header("c.fits", OBJECT="M33", EXPTIME=30, AIRMASS=1.1),
+        make_header("d.fits", EXPTIME=30.0, AIRMASS=1.3, FLAG=True),
+    ]
+
+def _names(columns):
+    """The file names in a columnar collection."""
+    return list(columns.filenames)
+
+def test_kinds():
+    """Columns of one type are typed arrays, and everything else is dictionary-encoded."""
+    columns = FITSHeaderColumns.fromheaders(_headers())
+    assert len(columns) == 4
+    assert columns.keywords == ["OPENNAME", "AIRMASS", "EXPTIME", "FLAG", "OBJECT"]
+    assert columns["airmass"].dtype == "float64"
+    assert columns["FLAG"].dtype == "bool"
+    assert columns["OBJECT"].encoded
+    assert columns["EXPTIME"].encoded
+    assert "NOTHERE" not in columns
+
+def test_mixed_numbers():
+    """Columns which mix integers and floats keep the type of each value."""
+    column = FITSHeaderColumns.fromheaders(_headers())["EXPTIME"]
+    values = [ column[row] for row in range(len(column)) ]
+    assert values == [30, 2.5, 30, 30.0]
+    assert [ type(value) for value in values ] == [int, float, int, float]
+    codes, uniques = column.factorize()
+    assert len(uniques) == 3
+    assert codes[0] == codes[2] != codes[3]
+
+def test_missing():
+    """Missing values are masked, and are ``None``."""
+    column = FITSHeaderColumns.fromheaders(_headers())["OBJECT"]
+    assert list(column.mask) == [False, False, False, True]
+    assert column[3] is None
+    assert not column.evaluate(lambda value : True)[3]
+
+@pytest.mark.parametrize("search", [
+    dict(EXPTIME=30),
+    dict(EXPTIME=30.0),
+    dict(EXPTIME=re.compile(r"30$")),
+    dict(EXPTIME=lambda value : str(value) == "30"),
+    dict(FLAG=True),
+    dict(FLAG=False),
+    dict(OBJECT="M31", AIRMASS=1.1),
+])
+def test_search(search):
+    """Searches find the same headers as a header-by-header search."""
+    expected = [ header.filename for header in FITSHeaderTable(_headers()).search(**dict(search)) ]
+    assert _names(FITSHeaderColumns.fromheaders(_headers()).search(**dict(search))) == expected
+
+def test_query():
+    """Queries on mixed numeric columns compare values, and regular expressions see the original text."""
+    columns = FITSHeaderColumns.fromheaders(_headers())
+    assert _names(columns.query(["EXPTIME>10"])) == ["a.fits", "c.fits", "d.fits"]
+    assert _names(columns.query(Query.parse([r"EXPTIME=^30$"], regex=True))) == ["a.fits", "c.fits"]
+
+def test_group():
+    """Groups keep values of different types apart, and skip headers missing a keyword."""
+    with pytest.warns(UserWarning):
+        groups = FITSHeaderColumns.fromheaders(_headers()).group(["OBJECT", "EXPTIME"])
+    assert sorted(len(group) for group in groups) == [1, 1, 1]
+    rows = FITSHeaderColumns.fromheaders(_headers()).group_rows(["EXPTIME"])
+    assert sorted(list(value) for value in rows.values()) == [[0, 2], [1], [3]]
+    assert (('int', 30),) in rows and (('float', 30.0),) in rows
+
+def test_roundtrip():
+    """Converting to headers and back keeps every value and its type."""
+    originals = _headers()
+    headers = FITSHeaderColumns.fromheaders(originals).toheaders()
+    assert [ header.filename for header in headers ] == [ header.filename for header in originals ]
+    for header, original in zip(headers, originals):
+        assert sorted(header.items()) == sorted(original.items())
+        assert [ type(value) for key, value in sorted(header.items()) ] == [ type(value) for key, value in sorted(original.items()) ]
+
+def test_take():
+    """Taking rows keeps the columns and file names together."""
+    columns = FITSHeaderColumns.fromheaders(_headers()).take(np.array([False, True, False, True]))
+    assert _names(columns) == ["b.fits", "d.fits"]
+    assert columns["EXPTIME"][0] == 2.5
+
+def test_fromvalues_length():
+    """Every column must have a row for each file."""
+    with pytest.raises(ValueError):
+        FITSHeaderColumns([HeaderColumn.fromvalues("A", [1, 2], [False, False])], ["a.fits"])
+
+def _build(*values):
+    """Build a column from `values`, one row each."""
+    builder = ColumnBuilder("A", len(values))
+    for row, value in enumerate(values):
+        builder[row] = value
+    return builder
+
+@pytest.mark.parametrize("values, kind", [
+    ((1, 2, 3), 'int'),
+    ((1.5, 2.5), 'float'),
+    ((True, False), 'bool'),
+    (("a", "b", "a"), 'str'),
+])
+def test_builder_kinds(values, kind):
+    """Columns of one type are built as arrays of that type."""
+    builder = _build(*values)
+    assert builder.kind == kind
+    assert list(builder.column()) == list(values)
+
+def test_builder_mixed_numbers():
+    """Integers and floats in one column keep their types."""
+    builder = _build(30, None, 2.5, 30)
+    assert builder.kind == 'object'
+    column = builder.column()
+    assert list(column.mask) == [False, True, False, False]
+    assert [ type(value) for value in column.data.data[~column.mask] ] == [int, float, int]
+    assert "{}".format(column[0]) == "30"
+
+def test_builder_strings():
+    """Mixing strings with other values makes a string column."""
+    builder = _build(30, 2.5, "thirty", True)
+    assert builder.kind == 'str'
+    assert list(builder.column()) == ["30", "2.5", "thirty", "True"]
+    assert list(_build("a", 1).column()) == ["a", "1"]
+
+def test_builder_missing():
+    """Rows which are never set are masked, and a column without values is a string column."""
+    builder = ColumnBuilder("A", 3)
+    builder[1] = 5
+    column = builder.column()
+    assert list(column.mask) == [True, False, True]
+    assert column[1] == 5
+    assert ColumnBuilder("A", 2).column().dtype.kind in 'US'
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+#
+#  test_fits_compressed.py
+#  pyobserver
+#
+#  Tests for reading the headers of gzipped and tile-compressed FITS files.
+#
+from __future__ import (absolute_import, unicode_literals, division,
+                        print_function)
+
+import gzip
+
+import numpy as np
+import pytest
+
+from astropy.io import fits
+
+from pyobserver.fits.scan import scan_headers
+from pyobserver.fits.compressed import GzipIndex, GzipStream, gzip_header_strings
+
+def _astropy(filename):
+    """The header of each HDU, read with astropy."""
+    with fits.open(filename) as HDUs:
+        return [ hdu.header.copy() for hdu in HDUs ]
+
+def _gzip(filename, members=1):
+    """Gzip `filename`, split into several gzip members."""
+    with open(filename, 'rb') as stream:
+        data = stream.read()
+    compressed = filename + ".gz"
+    size = len(data) // members + 1
+    with open(compressed, 'wb') as stream:
+        for start in range(0, len(data), size):
+            with gzip.GzipFile(fileobj=stream, mode='wb') as member:
+                member.write(data[start:start + size])
+    return compressed
+
+@pytest.fixture
+def filename(tmpdir):
+    """A FITS file with a large primary image and two extensions."""
+    random = np.random.RandomState(6)
+    primary = fits.PrimaryHDU(random.normal(size=(300, 200)))
+    primary.header['OBJECT'] = 'M31'
+    image = fits.ImageHDU(np.arange(1000, dtype=np.int32).reshape(25, 40), name='SCI')
+    image.header['EXPTIME'] = 30.0
+    table = fits.BinTableHDU.from_columns([fits.Column(name='a', format='D', array=np.arange(50.0))], name='TABLE')
+    filename = str(tmpdir.join("frame.fits"))
+    fits.HDUList([primary, image, table]).writeto(filename)
+    return filename
+
+@pytest.mark.parametrize("members", [1, 3])
+def test_gzip_headers(filename, members):
+    """Headers from gzipped files match astropy, card for card."""
+    compressed = _gzip(filename, members)
+    expected = _astropy(compressed)
+    headers = scan_headers(compressed)
+    assert len(headers) == len(expected)
+    for (header, name), reference in zip(headers, expected):
+        assert name == compressed
+        assert header.tostring() == reference.tostring()
+
+def test_gzip_keywords(filename):
+    """Gzipped headers can be projected, and scanning can stop early."""
+    compressed = _gzip(filename)
+    assert [ fits.Header.fromstring(raw).get('OBJECT') for raw in gzip_header_strings(compressed, keywords=['OBJECT']) ] == ['M31', None, None]
+    assert len(gzip_header_strings(compressed, hdus=1)) == 1
+
+def test_gzip_stream(filename):
+    """Reads from a gzip stream match the uncompressed file, in any order."""
+    with open(filename, 'rb') as stream:
+        data = stream.read()
+    compressed = _gzip(filename, 2)
+    index = GzipIndex(span=20000)
+    with GzipStream(compressed, index) as stream:
+        for position, size in [(0, 2880), (400000, 5000), (100, 50), (len(data) - 10, 100), (250000, 2880), (0, 10)]:
+            assert stream.read(position, size) == data[position:position + size]
+    assert len(index) > 1
+    with GzipStream(compressed, index) as stream:
+        assert stream.read(300000, 1000) == data[300000:301000]
+
+def test_gzip_not_fits(tmpdir):
+    """Gzipped files which aren't FITS files raise ValueError."""
+    filename = str(tmpdir.join("text.fits.gz"))
+    with gzip.open(filename, 'wb') as stream:
+        stream.write(b"Not a FITS file\n" * 400)
+    with pytest.raises(ValueError):
+        scan_headers(filename)
+
+def test_tile_compressed(tmpdir):
+    """Tile-compressed images are read as image headers, as astropy reads them."""
+    data = np.arange(12000, dtype=np.int32).reshape(100, 120)
+    image = fits.CompImageHDU(data, name='SCI')
+    image.header['OBJECT'] = 'M33'
+    image.header['EXPTIME'] = 60.0
+    filename = str(tmpdir.join("frame.fits.fz"))
+    fits.HDUList([fits.PrimaryHDU(), image]).writeto(filename)
+    expected = _astropy(filename)
+    headers = scan_headers(filename)
+    assert len(headers) == 2
+    header, reference = headers[1][0], expected[1]
+    assert header['XTENSION'] == 'IMAGE'
+    for keyword in ('BITPIX', 'NAXIS', 'NAXIS1', 'NAXIS2', 'PCOUNT', 'GCOUNT', 'EXTNAME', 'OBJECT', 'EXPTIME'):
+        assert header[keyword] == reference[keyword]
+    assert 'ZIMAGE' not in header
+    assert 'TTYPE1' not in header
+    assert set(header.keys()) == set(reference.keys())
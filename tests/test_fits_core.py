@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+#
+#  test_fits_core.py
+#  pyobserver
+#
+#  Tests for reading FITS headers, serially and with pools of workers.
+#
+from __future__ import (absolute_import, unicode_literals, division,
+                        print_function)
+
+import sys
+import time
+import warnings
+
+import pytest
+
+from pyobserver.fits.core import FITSHeaderTable, iter_headers, _getheaders
+from pyobserver.fits.record import HeaderRecord, LazyHeaderRecord
+
+from .helpers import write_fits
+
+def _forget_warnings():
+    """Python 2 doesn't repeat warnings which were ignored before, even with the "always" filter, so forget every warning which has been seen."""
+    for module in list(sys.modules.values()):
+        getattr(module, "__warningregistry__", {}).clear()
+
+def _values(headers):
+    """The cards of each header, with its name and extension."""
+    return [ (header["OPENNAME"], sorted(header.items())) for header in headers ]
+
+@pytest.fixture
+def files(tmpdir):
+    """More files than fit in one chunk of a small pool, some with extensions."""
+    return [ write_fits(tmpdir.join("f{:02d}.fits".format(i)), i % 3, OBJECT="M{:d}".format(i), EXPTIME=i) for i in range(20) ]
+
+@pytest.fixture
+def noisy(files):
+    """Files with trailing bytes, which astropy warns about when it reads them. The bytes differ between files, so that each warning is new."""
+    for i, filename in enumerate(files):
+        with open(filename, 'ab') as stream:
+            stream.write("X{:07d}".format(i).encode('ascii') * 360)
+    return files
+
+@pytest.mark.parametrize("workers, pool", [(2, 'thread'), (3, 'process')])
+@pytest.mark.parametrize("backend", ['astropy', 'scan'])
+def test_iter_headers(files, workers, pool, backend):
+    """Pools of workers produce the same headers in the same order as reading serially."""
+    serial = list(iter_headers(files, backend=backend))
+    assert len(serial) == 20 + 19
+    assert _values(iter_headers(files, workers=workers, pool=pool, backend=backend)) == _values(serial)
+
+@pytest.mark.parametrize("workers", [None, 2])
+def test_iter_headers_kinds(files, workers):
+    """Headers are produced as records, lazy records or full headers."""
+    assert all(isinstance(header, HeaderRecord) for header in iter_headers(files, workers=workers))
+    assert all(isinstance(header, LazyHeaderRecord) for header in iter_headers(files, workers=workers, lazy=True))
+    headers = list(iter_headers(files, workers=workers, records=False))
+    assert not any(isinstance(header, HeaderRecord) for header in headers)
+    assert headers[0]["FILENAME"] == "f00.fits"
+    assert _values(iter_headers(files, workers=workers, lazy=True, keywords=["OBJECT"])) == _values(iter_headers(files, keywords=["OBJECT"]))
+
+@pytest.mark.parametrize("workers, pool", [(None, 'thread'), (4, 'thread'), (2, 'process')])
+def test_iter_headers_warnings(noisy, workers, pool):
+    """Warnings from reading files are silenced, even while the consumer holds on to each header, but the consumer's own warnings are not."""
+    _forget_warnings()
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter("always")
+        assert len(_getheaders(noisy[0]))
+    assert len(caught)
+
+    _forget_warnings()
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter("always")
+        for header in iter_headers(noisy, workers=workers, pool=pool):
+            time.sleep(0.01)
+        warnings.warn("consumer")
+    assert [ str(warning.message) for warning in caught ] == ["consumer"]
+
+@pytest.mark.parametrize("workers, pool", [(2, 'thread'), (3, 'process')])
+@pytest.mark.parametrize("backend, lazy", [('astropy', False), ('scan', False), ('scan', True)])
+def test_fromfiles(files, workers, pool, backend, lazy):
+    """Tables read by pools of workers are the same as tables read serially."""
+    serial = FITSHeaderTable.fromfiles(files, backend=backend, lazy=lazy)
+    pooled = FITSHeaderTable.fromfiles(files, workers=workers, pool=pool, backend=backend, lazy=lazy)
+    assert [ type(header) for header in pooled ] == [ type(header) for header in serial ]
+    assert _values(pooled) == _values(serial)
+    assert pooled.table(["OBJECT", "EXPTIME"]).pformat(max_lines=-1) == serial.table(["OBJECT", "EXPTIME"]).pformat(max_lines=-1)
+
+@pytest.mark.parametrize("workers, pool", [(None, 'thread'), (4, 'thread'), (2, 'process')])
+def test_fromfiles_warnings(noisy, workers, pool):
+    """Warnings from reading files are silenced for whole tables too."""
+    serial = _values(iter_headers(noisy))
+    _forget_warnings()
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter("always")
+        table = FITSHeaderTable.fromfiles(noisy, workers=workers, pool=pool)
+    assert _values(table) == serial
+    assert [ str(warning.message) for warning in caught ] == []
+
+@pytest.mark.parametrize("backend, lazy, records", [('astropy', False, True), ('astropy', False, False), ('scan', False, True), ('scan', True, True)])
+def test_fromfiles_projection(files, backend, lazy, records):
+    """Only the projected keywords are kept, and searches on other keywords find nothing."""
+    table = FITSHeaderTable.fromfiles(files, workers=2, backend=backend, lazy=lazy, records=records, keywords=["object"])
+    assert len(table) == 20 + 19
+    assert all(set(header.keys()) <= set(["OBJECT", "FILENAME", "OPENNAME"]) for header in table)
+    assert [ header["OBJECT"] for header in table if "OBJECT" in header ] == [ "M{:d}".format(i) for i in range(20) ]
+    assert not any("EXPTIME" in header for header in table)
+    assert len(table.search(OBJECT="M3")) == 1
+    with pytest.warns(UserWarning) as caught:
+        assert len(table.search(EXPTIME=3)) == 0
+    assert "Couldn't find keyword 'EXPTIME'" in str(caught[0].message)
+    assert len(table.search(EXPTIME=False)) == len(table)
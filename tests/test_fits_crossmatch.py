@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+#
+#  test_fits_crossmatch.py
+#  pyobserver
+#
+#  Tests for matching starlist targets to frames.
+#
+from __future__ import (absolute_import, unicode_literals, division,
+                        print_function)
+
+import collections
+
+import astropy.units as u
+from astropy.coordinates import SkyCoord
+
+
+from pyobserver.fits.crossmatch import target_frames
+
+from .helpers import make_header
+
+def _target(name, ra, dec):
+    """A starlist target at `ra` and `dec` in degrees."""
+    return {"Name" : name, "Position" : SkyCoord(ra * u.deg, dec * u.deg, frame='icrs')}
+
+TARGETS = [ _target("M31", 10.6847, 41.2690), _target("Wrap", 359.999, 0.0), _target("Empty", 180.0, -45.0) ]
+
+HEADERS = [
+    make_header("a.fits", RA=10.6847, DEC=41.2690, EXPTIME=30.0, FILTER="Kp"),
+    make_header("b.fits", RA=10.6850, DEC=41.2695, EXPTIME=60.0, FILTER="H"),
+    make_header("c.fits", RA=10.6847, DEC=41.2690, EXPTIME=30.0, FILTER="Kp"),
+    make_header("d.fits", RA=10.7000, DEC=41.2690, EXPTIME=30.0, FILTER="Kp"),
+    make_header("e.fits", RA=0.0002, DEC=0.0002, EXPTIME=5.0),
+    make_header("f.fits", EXPTIME=5.0, FILTER="Kp"),
+]
+
+def test_frames():
+    """Frames within the tolerance are counted for each target, in the order of the targets."""
+    results = target_frames(TARGETS, HEADERS, tolerance=5 * u.arcsec)
+    assert [ result.name for result in results ] == ["M31", "Wrap", "Empty"]
+    assert [ result.frames for result in results ] == [3, 1, 0]
+    assert sorted(results[0].files) == ["a.fits", "b.fits", "c.fits"]
+    assert results[1].files == ["e.fits"]
+    assert results[2].files == []
+
+def test_exposure():
+    """Exposure times are totalled, and are ``None`` for targets without frames."""
+    results = target_frames(TARGETS, HEADERS, tolerance=5 * u.arcsec)
+    assert results[0].exposure == 120.0
+    assert results[1].exposure == 5.0
+    assert results[2].exposure is None
+
+def test_filters():
+    """Filters are counted in order, and frames without a filter are left out."""
+    results = target_frames(TARGETS, HEADERS, tolerance=5 * u.arcsec)
+    assert results[0].filters == collections.OrderedDict([("H", 1), ("Kp", 2)])
+    assert list(results[0].filters) == ["H", "Kp"]
+    assert results[1].filters == collections.OrderedDict()
+
+def test_tolerance():
+    """Frames are counted for every target within the tolerance, and tolerances without units are in degrees."""
+    results = target_frames(TARGETS + [ _target("M31 again", 10.6847, 41.2690) ], HEADERS, tolerance=0.1)
+    assert results[0].frames == results[3].frames == 4
+    assert results[0].ra == results[3].ra
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+#
+#  test_fits_footprint.py
+#  pyobserver
+#
+#  Tests for sky footprints, and footprint searches in the header index.
+#
+from __future__ import (absolute_import, unicode_literals, division,
+                        print_function)
+
+import os
+
+import numpy as np
+import pytest
+
+from astropy.io import fits
+from astropy.wcs import WCS
+
+from pyobserver.fits.footprint import Footprint
+from pyobserver.fits.index import FITSHeaderIndex
+
+def _wcs(ra, dec, scale=5e-4, angle=0.0):
+    """A tangent plane WCS for a 100x50 image centered on `ra` and `dec`."""
+    wcs = WCS(naxis=2)
+    wcs.wcs.ctype = ['RA---TAN', 'DEC--TAN']
+    wcs.wcs.crval = [ra, dec]
+    wcs.wcs.crpix = [50.5, 25.5]
+    wcs.wcs.cd = scale * np.array([[-np.cos(angle), np.sin(angle)], [np.sin(angle), np.cos(angle)]])
+    return wcs
+
+def _image(filename, ra, dec, **kwargs):
+    """Write an image with a celestial WCS."""
+    hdu = fits.PrimaryHDU(np.zeros((50, 100), dtype=np.int16), header=_wcs(ra, dec, **kwargs).to_header())
+    hdu.writeto(filename)
+    return filename
+
+def _pointing(filename, ra, dec):
+    """Write a header with only RA and DEC keywords."""
+    hdu = fits.PrimaryHDU()
+    hdu.header['RA'] = ra
+    hdu.header['DEC'] = dec
+    hdu.writeto(filename)
+    return filename
+
+@pytest.fixture
+def files(tmpdir):
+    """Frames scattered around zero right ascension, some with only a pointing."""
+    random = np.random.RandomState(5)
+    files = []
+    for i in range(60):
+        ra, dec = (359.5 + random.uniform(0, 1.5)) % 360.0, random.uniform(-1, 1)
+        if i % 5 == 0:
+            files.append(_pointing(str(tmpdir.join("p{:02d}.fits".format(i))), ra, dec))
+        else:
+            files.append(_image(str(tmpdir.join("w{:02d}.fits".format(i))), ra, dec,
+                scale=random.uniform(1e-4, 1e-3), angle=random.uniform(0, np.pi)))
+    return files
+
+def _footprints(files):
+    """The footprint of each primary header, by path and HDU."""
+    return dict(((os.path.abspath(filename), 0), Footprint.fromheader(fits.getheader(filename))) for filename in files)
+
+def test_fromheader_wcs():
+    """Headers with a celestial WCS have corners, and are centered on the image."""
+    header = fits.PrimaryHDU(np.zeros((50, 100), dtype=np.int16), header=_wcs(10.0, 20.0).to_header()).header
+    footprint = Footprint.fromheader(header)
+    assert footprint.corners.shape == (4, 2)
+    assert np.allclose([footprint.ra, footprint.dec], [10.0, 20.0])
+    assert np.isclose(footprint.radius, 5e-4 * np.hypot(50, 25), rtol=1e-3)
+
+def test_fromheader_pointing():
+    """Headers with only RA and DEC are a single point. Sexagesimal values are read in degrees."""
+    footprint = Footprint.fromheader({"RA" : "15:00:00", "DEC" : "-30:30:00"})
+    assert footprint.corners is None
+    assert np.allclose([footprint.ra, footprint.dec], [15.0, -30.5])
+    assert footprint.radius == 0.0
+    assert not footprint.contains(15.0, -30.5)
+    assert Footprint.fromheader({"OBJECT" : "M31"}) is None
+
+def test_contains():
+    """Footprints contain the positions which land on the image."""
+    wcs = _wcs(0.1, 0.5, angle=0.3)
+    header = fits.PrimaryHDU(np.zeros((50, 100), dtype=np.int16), header=wcs.to_header()).header
+    footprint = Footprint.fromheader(header)
+    random = np.random.RandomState(7)
+    pixels = random.uniform(-20, 120, size=(300, 2)) * [1.0, 0.5]
+    for (x, y), (ra, dec) in zip(pixels, wcs.wcs_pix2world(pixels, 1)):
+        if min(abs(x - 0.5), abs(x - 100.5), abs(y - 0.5), abs(y - 50.5)) < 1e-3:
+            continue
+        assert footprint.contains(ra, dec) == (0.5 <= x <= 100.5 and 0.5 <= y <= 50.5)
+        if footprint.contains(ra, dec):
+            assert footprint.distance(ra, dec) == 0.0
+            assert footprint.intersects_cone(ra, dec, 0.0)
+
+def test_intersects_box():
+    """Boxes overlap footprints when they share a corner, or when one is inside the other."""
+    footprint = Footprint(0.0, 0.0, [[359.9, -0.1], [0.1, -0.1], [0.1, 0.1], [359.9, 0.1]])
+    assert footprint.intersects_box(359.95, 0.05, -0.05, 0.05)
+    assert footprint.intersects_box(350.0, 10.0, -1.0, 1.0)
+    assert footprint.intersects_box(0.05, 1.0, -0.05, 0.05)
+    assert footprint.intersects_box(359.0, 0.0, -0.05, 0.05)
+    assert not footprint.intersects_box(0.2, 1.0, -1.0, 1.0)
+    assert not footprint.intersects_box(0.0, 359.0, 0.2, 1.0)
+    assert not Footprint(0.0, 0.0).intersects_box(1.0, 359.0, -1.0, 1.0)
+
+@pytest.mark.parametrize("footprint", [
+    Footprint(10.0, -20.0),
+    Footprint(359.99, 0.0, [[359.9, -0.1], [0.1, -0.1], [0.1, 0.1], [359.9, 0.1]]),
+])
+def test_tostring(footprint):
+    """Footprints are serialized to and from strings."""
+    assert Footprint.fromstring(footprint.tostring()) == footprint
+
+def test_cone(files, tmpdir):
+    """Cone searches in the index match each footprint, including through zero right ascension."""
+    footprints = _footprints(files)
+    random = np.random.RandomState(11)
+    with FITSHeaderIndex(str(tmpdir.join("index.sqlite"))) as index:
+        index.refresh(files)
+        for trial in range(30):
+            ra, dec, radius = (359.5 + random.uniform(0, 1.5)) % 360.0, random.uniform(-1, 1), random.uniform(0.001, 0.3)
+            matches = index.cone(ra, dec, radius)
+            assert sorted((path, hdu) for path, hdu, distance in matches) == sorted(key for key, footprint in footprints.items() if footprint.intersects_cone(ra, dec, radius))
+            assert [ distance for path, hdu, distance in matches ] == sorted(distance for path, hdu, distance in matches)
+        assert len(index.cone(0.0, 0.0, 180.0)) == len(files)
+
+def test_box(files, tmpdir):
+    """Box searches in the index match each footprint, including boxes which wrap through zero right ascension."""
+    footprints = _footprints(files)
+    random = np.random.RandomState(13)
+    with FITSHeaderIndex(str(tmpdir.join("index.sqlite"))) as index:
+        index.refresh(files)
+        for trial in range(30):
+            ra_min = (359.5 + random.uniform(0, 1.5)) % 360.0
+            ra_max = (ra_min + random.uniform(0.01, 0.6)) % 360.0
+            dec_min = random.uniform(-1, 0.8)
+            dec_max = dec_min + random.uniform(0.01, 0.5)
+            assert index.box(ra_min, ra_max, dec_min, dec_max) == sorted(key for key, footprint in footprints.items() if footprint.intersects_box(ra_min, ra_max, dec_min, dec_max))
+        assert len(index.box(0.0, 360.0, -90.0, 90.0)) == len(files)
+
+def test_refresh(files, tmpdir):
+    """Refreshing the index reads only the files which are new or have changed."""
+    with FITSHeaderIndex(str(tmpdir.join("index.sqlite"))) as index:
+        assert index.refresh(files[:10]) == files[:10]
+        assert index.stale(files) == files[10:]
+        assert index.refresh(files, backend='scan') == files[10:]
+        assert index.refresh(files) == []
+
+        _pointing(str(tmpdir.join("moved.fits")), 180.0, 45.0)
+        os.rename(str(tmpdir.join("moved.fits")), files[0])
+        assert index.stale(files) == [files[0]]
+        assert index.refresh(files) == [files[0]]
+        assert index.cone(180.0, 45.0, 0.01) == [(os.path.abspath(files[0]), 0, 0.0)]
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+#
+#  test_fits_groups.py
+#  pyobserver
+#
+#  Tests for grouping FITS headers by keyword values.
+#
+from __future__ import (absolute_import, unicode_literals, division,
+                        print_function)
+
+import pickle
+
+import pytest
+
+from pyobserver.fits.core import FITSHeaderTable, FITSDataGroups, FITSDataRollup, shard_group
+from pyobserver.fits.query import Query
+
+from .helpers import make_header, write_fits
+
+HEADERS = [
+    make_header("a.fits", OBJECT="M31", EXPTIME=30),
+    make_header("b.fits", OBJECT="M31", EXPTIME=30.0),
+    make_header("c.fits", OBJECT="M31", EXPTIME=30),
+    make_header("d.fits", OBJECT="M31", EXPTIME=True),
+    make_header("e.fits", OBJECT="M31", EXPTIME=1),
+]
+
+def test_types():
+    """Values which are equal but have different types are in different groups, as they are by hash."""
+    groups = FITSDataGroups(["OBJECT", "EXPTIME"]).update(HEADERS)
+    assert len(groups) == 4
+    assert len(set(groups.hashes)) == 4
+    assert sorted(len(group) for group in groups) == [1, 1, 1, 2]
+    assert groups.key(HEADERS[0]) != groups.key(HEADERS[1])
+    assert groups.key(HEADERS[3]) != groups.key(HEADERS[4])
+
+def test_find():
+    """Groups are found by key, by a tuple of values, and by header."""
+    groups = FITSDataGroups(["OBJECT", "EXPTIME"]).update(HEADERS)
+    assert groups.key(HEADERS[0]) in groups
+    assert ("M31", 30) in groups
+    assert ("M31", 60) not in groups
+    assert make_header("f.fits", OBJECT="M31", EXPTIME=30.0) in groups
+    assert make_header("g.fits", OBJECT="M33", EXPTIME=30.0) not in groups
+
+def test_merge():
+    """Merged and pickled groups keep the types of their keys."""
+    groups = FITSDataGroups(["OBJECT", "EXPTIME"]).update(HEADERS[:2])
+    other = pickle.loads(pickle.dumps(FITSDataGroups(["OBJECT", "EXPTIME"]).update(HEADERS[2:]), protocol=2))
+    groups.merge(other)
+    assert sorted(len(group) for group in groups) == [1, 1, 1, 2]
+
+def test_rollup_table():
+    """Rollup tables show keyword values, not keys."""
+    table = FITSDataRollup(["OBJECT", "EXPTIME"]).update(HEADERS[:3]).table()
+    assert list(table["Level"]) == [1, 2, 2]
+    assert list(table["OBJECT"]) == ["M31"] * 3
+    assert list(table["N"]) == [3, 2, 1]
+    assert table["EXPTIME"].mask[0]
+
+@pytest.fixture
+def shards(tmpdir):
+    """Three nights of files, where every group has files from more than one night."""
+    shards = []
+    for night in range(3):
+        files = []
+        for i in range(6):
+            files.append(write_fits(tmpdir.join("n{:d}-{:d}.fits".format(night, i)),
+                OBJECT=["M31", "M33"][i % 2], FILTER=["Kp", "H", "J"][(i + night) % 3], EXPTIME=[30, 60][i // 4]))
+        shards.append(files)
+    return shards
+
+def _summary(groups):
+    """The key, files and aggregates of each group, in a comparable form."""
+    return sorted((group.key, sorted(header["OPENNAME"] for header in group), list(groups.aggregate(group).items())) for group in groups)
+
+AGGREGATES = {"EXPTIME" : ("sum", "count", "max")}
+
+@pytest.mark.parametrize("workers", [None, 2])
+def test_shard_group(shards, workers):
+    """Grouping shards separately and merging them gives the same groups as grouping every file at once."""
+    keywords = ["OBJECT", "FILTER"]
+    single = FITSHeaderTable.fromfiles(sum(shards, [])).group(keywords, aggregates=AGGREGATES)
+    sharded = shard_group(shards, keywords, workers=workers, aggregates=AGGREGATES)
+    assert len(sharded) == len(single) == 6
+    assert _summary(sharded) == _summary(single)
+
+@pytest.mark.parametrize("workers", [None, 2])
+def test_shard_rollup(shards, workers):
+    """Sharded rollups match a single rollup at every level, and in their tables."""
+    keywords = ["OBJECT", "FILTER", "EXPTIME"]
+    single = FITSHeaderTable.fromfiles(sum(shards, [])).group(keywords, aggregates=AGGREGATES, rollup=True)
+    sharded = shard_group(shards, keywords, workers=workers, aggregates=AGGREGATES, rollup=True)
+    assert isinstance(sharded, FITSDataRollup)
+    assert [ _summary(groups) for groups in sharded ] == [ _summary(groups) for groups in single ]
+    assert sharded.table().pformat(max_lines=-1, max_width=-1) == single.table().pformat(max_lines=-1, max_width=-1)
+
+def test_shard_query(shards):
+    """Queries filter each shard before it is grouped, and projections still read the grouped keywords."""
+    query = Query.parse(["OBJECT=M31", "EXPTIME<60"])
+    single = FITSHeaderTable(query.filter(FITSHeaderTable.fromfiles(sum(shards, [])))).group(["OBJECT", "FILTER"], rollup=True)
+    sharded = shard_group(shards, ["OBJECT", "FILTER"], query=query, projection=["OBJECT", "FILTER", "EXPTIME"], rollup=True)
+    assert [ _summary(groups) for groups in sharded ] == [ _summary(groups) for groups in single ]
+    assert sum(len(group) for group in sharded.level(1)) == 6
@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+#
+#  test_fits_index.py
+#  pyobserver
+#
+#  Tests for the persistent FITS header index.
+#
+from __future__ import (absolute_import, unicode_literals, division,
+                        print_function)
+
+import os
+import re
+import warnings
+
+import pytest
+
+from pyobserver.fits.core import FITSHeaderTable, silent_getheaders
+from pyobserver.fits.index import FITSHeaderIndex
+
+from .helpers import write_fits
+
+def _touch(filename, seconds):
+    """Move the modification time of `filename` by `seconds`."""
+    stat = os.stat(filename)
+    os.utime(filename, (stat.st_atime, stat.st_mtime + seconds))
+
+@pytest.fixture
+def files(tmpdir):
+    """A few FITS files."""
+    return [
+        write_fits(tmpdir.join("a.fits"), OBJECT="M31", EXPTIME=30),
+        write_fits(tmpdir.join("b.fits"), 2, OBJECT="M33", EXPTIME=60),
+        write_fits(tmpdir.join("c.fits"), OBJECT="M31", EXPTIME=60),
+    ]
+
+@pytest.fixture
+def index(files):
+    """An in-memory index holding the headers of `files`."""
+    index = FITSHeaderIndex(":memory:")
+    index.update((filename, silent_getheaders(filename)) for filename in files)
+    yield index
+    index.close()
+
+def test_lookup(index, files, tmpdir):
+    """Indexed files are loaded from the index, and new files are stale."""
+    new = write_fits(tmpdir.join("d.fits"), OBJECT="M101")
+    cached, stale = index.lookup(files + [new])
+    assert stale == [new]
+    assert sorted(cached) == sorted(files)
+    for filename in files:
+        expected = silent_getheaders(filename)
+        assert [ header.tostring() for header, _ in cached[filename] ] == [ header.tostring() for header, _ in expected ]
+        assert all(name == filename for _, name in cached[filename])
+
+def test_lookup_keywords(index, files):
+    """Only the requested keywords are parsed from indexed headers."""
+    cached, stale = index.lookup(files, keywords=['OBJECT'])
+    assert [ list(header.keys()) for header, _ in cached[files[1]] ] == [['OBJECT'], [], []]
+
+def test_stale(index, files):
+    """Files which change are stale until they are stored again."""
+    assert all(filename in index for filename in files)
+    _touch(files[0], 10)
+    write_fits(files[1], 1, OBJECT="NGC 598")
+    assert files[0] not in index
+    assert index.get(files[1]) is None
+    cached, stale = index.lookup(files)
+    assert stale == files[:2]
+    index.update([ (filename, silent_getheaders(filename)) for filename in stale ])
+    cached, stale = index.lookup(files)
+    assert stale == []
+    assert [ header['OBJECT'] for header, _ in cached[files[1]][:1] ] == ["NGC 598"]
+    assert len(cached[files[1]]) == 2
+
+def test_discard_and_prune(index, files):
+    """Discarded and deleted files are removed from the index."""
+    assert len(index) == 3
+    index.discard(files[0])
+    os.remove(files[1])
+    assert index.prune() == 1
+    assert len(index) == 1
+    assert index.lookup(files[:1])[1] == files[:1]
+
+def test_persistent(files, tmpdir):
+    """Indexes are kept on disk, and are rebuilt when their schema version changes."""
+    filename = str(tmpdir.join("index.sqlite"))
+    with FITSHeaderIndex(filename) as index:
+        index.update((name, silent_getheaders(name)) for name in files)
+    with FITSHeaderIndex(filename) as index:
+        assert len(index) == 3
+        index.connection.execute("PRAGMA user_version = 0")
+    with FITSHeaderIndex(filename) as index:
+        assert len(index) == 0
+
+def test_sidecar(files, tmpdir):
+    """Sidecar indexes sit in the deepest directory which holds every file."""
+    nested = tmpdir.mkdir("night").join("e.fits")
+    write_fits(nested)
+    with FITSHeaderIndex.sidecar(files + [str(nested)]) as index:
+        assert index.filename == os.path.join(str(tmpdir), FITSHeaderIndex.SIDECAR)
+    with FITSHeaderIndex.sidecar([str(nested)]) as index:
+        assert index.filename == os.path.join(str(tmpdir), "night", FITSHeaderIndex.SIDECAR)
+
+@pytest.mark.parametrize("lazy", [False, True])
+def test_read(files, tmpdir, monkeypatch, lazy):
+    """Tables read through an index only read files which have changed."""
+    expected = FITSHeaderTable.fromfiles(files)
+    with FITSHeaderIndex(str(tmpdir.join("index.sqlite"))) as index:
+        first = FITSHeaderTable.fromfiles(files, index=index, lazy=lazy)
+        _touch(files[2], 10)
+        read = []
+        from pyobserver.fits import core
+        pool_getheaders = core.pool_getheaders
+        def spy(files, *args, **kwargs):
+            read.extend(files)
+            return pool_getheaders(files, *args, **kwargs)
+        monkeypatch.setattr(core, "pool_getheaders", spy)
+        second = FITSHeaderTable.fromfiles(files, index=index, lazy=lazy)
+    assert read == files[2:]
+    for table in (first, second):
+        assert [ header['OBJECT'] for header in table if 'OBJECT' in header ] == [ header['OBJECT'] for header in expected if 'OBJECT' in header ]
+        assert [ header.get('EXTNAME') for header in table ] == [ header.get('EXTNAME') for header in expected ]
+
+def test_post(index, files):
+    """Posted keywords have postings for every stored header."""
+    assert index.posted == []
+    index.post(['object', 'EXPTIME'])
+    index.post(['OBJECT'])
+    assert index.posted == ['EXPTIME', 'OBJECT']
+    rows = index.connection.execute("SELECT keyword, kind, value, path, hdu FROM postings ORDER BY path, keyword").fetchall()
+    assert [ tuple(row) for row in rows ] == [
+        ('EXPTIME', 'int', 30, os.path.abspath(files[0]), 0), ('OBJECT', 'str', 'M31', os.path.abspath(files[0]), 0),
+        ('EXPTIME', 'int', 60, os.path.abspath(files[1]), 0), ('OBJECT', 'str', 'M33', os.path.abspath(files[1]), 0),
+        ('EXPTIME', 'int', 60, os.path.abspath(files[2]), 0), ('OBJECT', 'str', 'M31', os.path.abspath(files[2]), 0),
+    ]
+
+def test_postings_update(index, files):
+    """Postings follow the stored headers when a file changes, and keep the type of each value."""
+    index.post(['OBJECT', 'EXPTIME'])
+    write_fits(files[0], OBJECT="M101", EXPTIME="30")
+    index.update([(files[0], silent_getheaders(files[0]))])
+    rows = index.connection.execute("SELECT keyword, kind, value FROM postings WHERE path = ? ORDER BY keyword",
+        (os.path.abspath(files[0]),)).fetchall()
+    assert [ tuple(row) for row in rows ] == [('EXPTIME', 'str', '30'), ('OBJECT', 'str', 'M101')]
+    index.discard(files[0])
+    assert index.connection.execute("SELECT COUNT(*) FROM postings WHERE path = ?", (os.path.abspath(files[0]),)).fetchone()[0] == 0
+
+def test_inverted(index, files):
+    """Inverted indexes from the stored postings match those built from the headers, and only hold the table's own headers."""
+    index.post(['OBJECT', 'EXPTIME'])
+    table = FITSHeaderTable.fromfiles(files[1:], index=index)
+    inverted = table.inverted_index
+    assert inverted is not None
+    assert sorted(inverted.keywords) == ['EXPTIME', 'OBJECT']
+    expected = FITSHeaderTable(table).invert(['OBJECT', 'EXPTIME'])
+    for keyword in ('OBJECT', 'EXPTIME'):
+        assert sorted(inverted.values(keyword)) == sorted(expected.values(keyword))
+        for value in expected.values(keyword):
+            assert list(inverted.rows(keyword, value)) == list(expected.rows(keyword, value))
+        assert inverted.missing(keyword) == expected.missing(keyword) == 2
+    assert list(inverted.rows('OBJECT', 'M31')) == [3]
+
+def test_read_posts(files, tmpdir):
+    """Keywords read through an index are posted, and later searches use the postings."""
+    with FITSHeaderIndex(str(tmpdir.join("index.sqlite"))) as index:
+        FITSHeaderTable.fromfiles(files, index=index, keywords=['OBJECT'])
+        assert index.posted == ['OBJECT']
+        table = FITSHeaderTable.fromfiles(files, index=index)
+    assert table.inverted_index.keywords == ['OBJECT']
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        found = table.search(OBJECT="M31")
+    assert [ os.path.basename(header.filename) for header in found ] == ["a.fits", "c.fits"]
+
+@pytest.mark.parametrize("search", [
+    dict(FLAG=re.compile("T")),
+    dict(FLAG=re.compile("^1$")),
+    dict(FLAG=True),
+    dict(FLAG=1),
+    dict(FLAG=lambda value : value is True),
+    dict(EXPTIME=re.compile("^30$")),
+    dict(EXPTIME=re.compile(r"^30\.0$")),
+    dict(EXPTIME=30),
+    dict(EXPTIME=lambda value : isinstance(value, float)),
+    dict(BIG=2**70),
+    dict(BIG=lambda value : value > 2**64),
+])
+def test_indexed_types(tmpdir, search):
+    """Searches with postings from the index find the same headers as searches without them, for booleans and for equal values of different types."""
+    cards = [ dict(FLAG=True, EXPTIME=30), dict(FLAG=False, EXPTIME=30.0), dict(FLAG=1, EXPTIME=1.5),
+        dict(FLAG=True, EXPTIME=1, BIG=2**70), dict(EXPTIME=True, BIG=12) ]
+    files = [ write_fits(tmpdir.join("t{:d}.fits".format(i)), **values) for i, values in enumerate(cards) ]
+    with FITSHeaderIndex(str(tmpdir.join("index.sqlite"))) as index:
+        FITSHeaderTable.fromfiles(files, index=index, keywords=['FLAG', 'EXPTIME', 'BIG'])
+        indexed = FITSHeaderTable.fromfiles(files, index=index)
+    assert sorted(indexed.inverted_index.keywords) == ['BIG', 'EXPTIME', 'FLAG']
+    plain = FITSHeaderTable.fromfiles(files)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        expected = [ header["OPENNAME"] for header in plain.search(**search) ]
+        assert [ header["OPENNAME"] for header in indexed.search(**search) ] == expected
+    assert len(expected)
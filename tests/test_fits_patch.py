@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+#
+#  test_fits_patch.py
+#  pyobserver
+#
+#  Tests for in-place FITS header patches.
+#
+from __future__ import (absolute_import, unicode_literals, division,
+                        print_function)
+
+import os
+import gzip
+import shutil
+
+import numpy as np
+import pytest
+
+from astropy.io import fits
+
+from pyobserver.fits.patch import HeaderPatch, apply_patch, patch_headers
+
+DATA = np.arange(10000, dtype=np.float32).reshape(100, 100)
+
+@pytest.fixture
+def filename(tmpdir):
+    """A FITS file with a primary HDU and an image extension."""
+    primary = fits.PrimaryHDU(DATA)
+    primary.header['OBJECT'] = 'gal0'
+    extension = fits.ImageHDU(DATA * 2)
+    extension.header['EXTNAME'] = 'SCI'
+    filename = str(tmpdir.join("frame.fits"))
+    fits.HDUList([primary, extension]).writeto(filename)
+    return filename
+
+def _check(filename):
+    """Verify a patched file with astropy, and check that the data are unchanged."""
+    with fits.open(filename) as HDUs:
+        HDUs.verify('exception')
+        assert (HDUs[0].data == DATA).all()
+        assert (HDUs[1].data == DATA * 2).all()
+        return [ hdu.header.copy() for hdu in HDUs ]
+
+def test_inplace(filename):
+    """A patch which fits in the header padding writes only the changed bytes."""
+    with open(filename, 'rb') as stream:
+        original = stream.read()
+    result = apply_patch(HeaderPatch(filename, {"OBJECT" : ("gal9", "MODIFIED")}, ["OLD OBJECT gal0"]))
+    assert result.inplace
+    assert result.size == len(original)
+    assert 0 < result.written < 2880
+    assert result.saved == result.size - result.written
+
+    with open(filename, 'rb') as stream:
+        patched = stream.read()
+    assert len(patched) == len(original)
+    changed = np.flatnonzero(np.frombuffer(patched, dtype=np.uint8) != np.frombuffer(original, dtype=np.uint8))
+    assert changed[-1] - changed[0] < result.written
+
+    headers = _check(filename)
+    assert headers[0]['OBJECT'] == 'gal9'
+    assert headers[0].comments['OBJECT'] == 'MODIFIED'
+    assert list(headers[0]['HISTORY']) == ["OLD OBJECT gal0"]
+    assert headers[1]['EXTNAME'] == 'SCI'
+
+def test_unchanged(filename):
+    """A patch which doesn't change the header writes nothing."""
+    result = apply_patch(HeaderPatch(filename, {"OBJECT" : "gal0"}))
+    assert result.inplace
+    assert result.written == 0
+
+def test_rewrite(filename, tmpdir):
+    """A header which grows into a new block rewrites the file."""
+    size = os.path.getsize(filename)
+    cards = dict(("K{:05d}".format(i), i) for i in range(60))
+    result = apply_patch(HeaderPatch(filename, cards, extension=1))
+    assert not result.inplace
+    assert result.size == size
+    assert result.written == os.path.getsize(filename) == size + 2880
+
+    headers = _check(filename)
+    assert headers[1]['K00059'] == 59
+    assert headers[1]['EXTNAME'] == 'SCI'
+    assert headers[0]['OBJECT'] == 'gal0'
+    assert sorted(os.listdir(str(tmpdir))) == ["frame.fits"]
+
+def test_gzip(filename):
+    """Gzipped files are patched with astropy."""
+    compressed = filename + ".gz"
+    with open(filename, 'rb') as source:
+        with gzip.open(compressed, 'wb') as destination:
+            shutil.copyfileobj(source, destination)
+    result = apply_patch(HeaderPatch(compressed, {"OBJECT" : "gal9"}))
+    assert not result.inplace
+    with fits.open(compressed) as HDUs:
+        assert HDUs[0].header['OBJECT'] == 'gal9'
+        assert (HDUs[1].data == DATA * 2).all()
+
+def test_missing_extension(filename):
+    """Patching an HDU which doesn't exist raises an IndexError."""
+    with pytest.raises(IndexError):
+        apply_patch(HeaderPatch(filename, {"OBJECT" : "gal9"}, extension=5))
+
+@pytest.mark.parametrize("cards", [1, 20])
+def test_same_file(filename, cards):
+    """Patches to the same file from a pool of workers are all applied, whether they fit in place or not."""
+    patches = [ HeaderPatch(filename, dict(("P{:02d}_{:02d}".format(i, j), j) for j in range(cards))) for i in range(10) ]
+    results = patch_headers(patches, workers=4, pool='thread')
+    assert [ result.filename for result in results ] == [ patch.filename for patch in patches ]
+    headers = _check(filename)
+    for i in range(10):
+        assert headers[0]["P{:02d}_{:02d}".format(i, cards - 1)] == cards - 1
+    assert headers[0]['OBJECT'] == 'gal0'
+    assert os.listdir(os.path.dirname(filename)) == ["frame.fits"]
+
+def test_many_files(tmpdir, filename):
+    """Patches to several files are returned in order."""
+    filenames = [filename]
+    for name in ("b.fits", "c.fits"):
+        filenames.append(str(tmpdir.join(name)))
+        shutil.copy(filename, filenames[-1])
+    results = patch_headers([ HeaderPatch(name, {"OBJECT" : os.path.basename(name)}) for name in filenames ], workers=3)
+    assert [ result.filename for result in results ] == filenames
+    assert all(result.inplace for result in results)
+    for name in filenames:
+        assert fits.getval(name, 'OBJECT') == os.path.basename(name)
@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+#
+#  test_fits_query.py
+#  pyobserver
+#
+#  Tests for FITS header queries.
+#
+from __future__ import (absolute_import, unicode_literals, division,
+                        print_function)
+
+import re
+import warnings
+
+import numpy as np
+import six
+import pytest
+
+from pyobserver.fits.core import FITSHeaderTable
+from pyobserver.fits import query as fitsquery
+from pyobserver.fits.query import Query, Predicate
+
+from .helpers import make_header
+
+ROWS = [
+    dict(OBJECT="M31", EXPTIME=30, FILTER="Kbb", AIRMASS=1.1),
+    dict(OBJECT="M31", EXPTIME=60.0, FILTER="Hbb", AIRMASS=1.3),
+    dict(OBJECT="M33", EXPTIME=30, FILTER="Kbb"),
+    dict(OBJECT="tt3", EXPTIME="30", AIRMASS=2.0),
+    dict(OBJECT="M101", EXPTIME=900, FILTER="Kbb", AIRMASS=1.05),
+    dict(EXPTIME=1.5, FILTER="Jbb", AIRMASS=1.2),
+]
+
+def _headers(rows):
+    """A header for each dictionary of cards in `rows`, named by row."""
+    return [ make_header("frame{:d}.fits".format(row), **cards) for row, cards in enumerate(rows) ]
+
+def _table():
+    """A table of headers with mixed types and missing keywords."""
+    return FITSHeaderTable(_headers(ROWS))
+
+@pytest.fixture
+def table():
+    """A table of headers with mixed types and missing keywords."""
+    return _table()
+
+def _names(table):
+    """The OPENNAME of each header."""
+    return [ header["OPENNAME"] for header in table ]
+
+def _query(table, query, inverted=None):
+    """Evaluate a query, with or without an inverted index, ignoring missing keyword warnings."""
+    if inverted is not None:
+        table.invert(inverted)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        return _names(table.query(query))
+
+def _search(table, **keywords):
+    """Search the table, ignoring missing keyword warnings. Searches for absent keywords fill them in, so each search needs its own headers."""
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        return _names(table.search(**keywords))
+
+SEARCHES = [
+    dict(OBJECT="M31"),
+    dict(EXPTIME=30),
+    dict(EXPTIME="30"),
+    dict(OBJECT="M31", FILTER="Kbb"),
+    dict(OBJECT=re.compile(r"M3\d")),
+    dict(FILTER=True),
+    dict(AIRMASS=False),
+    dict(AIRMASS=lambda value : value < 1.25),
+    dict(EXPTIME=lambda value : value > 40),
+    dict(OBJECT="NGC 1"),
+]
+
+@pytest.mark.parametrize("search", SEARCHES)
+def test_fromkeywords(table, search):
+    """Queries built from search keywords match search."""
+    expected = _search(_table(), **dict(search))
+    assert _query(table, Query.fromkeywords(**search)) == expected
+    assert _query(_table(), Query.fromkeywords(**search), inverted=list(search)) == expected
+
+@pytest.mark.parametrize("text, search", [
+    (["OBJECT=M31"], dict(OBJECT="M31")),
+    (["EXPTIME=30"], dict(EXPTIME=30)),
+    (["EXPTIME='30'"], dict(EXPTIME="30")),
+    (["OBJECT=M31", "FILTER=Kbb"], dict(OBJECT="M31", FILTER="Kbb")),
+    (["FILTER"], dict(FILTER=True)),
+    (["AIRMASS=False"], dict(AIRMASS=False)),
+    (["AIRMASS<1.25"], dict(AIRMASS=lambda value : value < 1.25)),
+    (["EXPTIME>=30"], dict(EXPTIME=lambda value : not isinstance(value, six.string_types) and value >= 30)),
+    (["FILTER!=Kbb"], dict(FILTER=lambda value : value != "Kbb")),
+])
+def test_parse(table, text, search):
+    """Parsed queries match the equivalent search."""
+    expected = _search(_table(), **search)
+    assert _query(table, Query.parse(text)) == expected
+    assert _query(_table(), Query.parse(text), inverted=list(search)) == expected
+
+MIXED = [ dict(EXPTIME=value) for value in (30, 30.0, True, 1, 30.0, 30, 1, True) ]
+
+TYPED = [
+    (re.compile("^30$"), [0, 5]),
+    (re.compile("^30.0$"), [1, 4]),
+    (re.compile("^1$"), [3, 6]),
+    (re.compile("^True$"), [2, 7]),
+    (lambda value : isinstance(value, float), [1, 4]),
+    (lambda value : isinstance(value, bool), [2, 7]),
+]
+
+def _orders(expected):
+    """The mixed rows in both orders, with the names of the `expected` rows in each order."""
+    for rows in (MIXED, MIXED[::-1]):
+        yield _headers(rows), sorted("frame{:d}.fits".format(row if rows is MIXED else len(rows) - 1 - row) for row in expected)
+
+@pytest.mark.parametrize("search, expected", TYPED)
+def test_search_types(search, expected):
+    """Searches are evaluated once for each value and its type, so equal values of different types, like 30 and 30.0 or True and 1, don't share results."""
+    for headers, names in _orders(expected):
+        assert sorted(_search(FITSHeaderTable(headers), EXPTIME=search)) == names
+
+@pytest.mark.parametrize("search, expected", TYPED)
+def test_filter_types(search, expected):
+    """Filters remember predicate results by value and type, as searches do."""
+    for headers, names in _orders(expected):
+        assert sorted(_names(Query.fromkeywords(EXPTIME=search).filter(iter(headers)))) == names
+
+def test_filter_lazy(table):
+    """Filters only read as many headers as they need, and drop headers which don't match."""
+    consumed = []
+    def headers():
+        for header in table:
+            consumed.append(header["OPENNAME"])
+            yield header
+    matches = Query.parse(["EXPTIME=30"]).filter(headers())
+    assert next(matches)["OPENNAME"] == "frame0.fits"
+    assert consumed == ["frame0.fits"]
+    assert next(matches)["OPENNAME"] == "frame2.fits"
+    assert consumed == ["frame0.fits", "frame1.fits", "frame2.fits"]
+
+def test_filter_missing(table):
+    """Filters report each missing keyword once, after the last header. Keywords after a predicate which fails are not checked."""
+    getattr(fitsquery, "__warningregistry__", {}).clear()
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter("always")
+        matches = Query.parse(["FILTER=Kbb", "NOTHERE=1", "OR", "AIRMASS>1.5"]).filter(table)
+        assert _names(matches) == ["frame3.fits"]
+    assert sorted(str(warning.message) for warning in caught) == ["Couldn't find keyword 'AIRMASS' in 1 headers",
+        "Couldn't find keyword 'FILTER' in 1 headers", "Couldn't find keyword 'NOTHERE' in 3 headers"]
+
+def test_regex(table):
+    """With regex set, equality predicates are regular expressions."""
+    query = Query.parse([r"OBJECT=M3\d"], regex=True)
+    assert query.groups[0][0].op == 'match'
+    assert _query(table, query) == _search(_table(), OBJECT=re.compile(r"M3\d"))
+
+def test_in(table):
+    """Lists of values, including lists split up by the shell."""
+    assert _query(table, Query.parse(["EXPTIME in [30, 900]"])) == ["frame0.fits", "frame2.fits", "frame4.fits"]
+    assert _query(table, Query.parse(["FILTER", "in", "[Hbb,", "Jbb]"])) == ["frame1.fits", "frame5.fits"]
+    assert _query(table, Query.parse(["FILTER", "not", "in", "[Kbb]"])) == ["frame1.fits", "frame5.fits"]
+
+def test_or(table):
+    """Groups of predicates are combined with OR."""
+    query = Query.parse(["OBJECT=M31", "EXPTIME>30", "OR", "FILTER=Jbb"])
+    assert len(query.groups) == 2
+    assert query.keywords == ["OBJECT", "EXPTIME", "FILTER"]
+    assert _query(table, query) == ["frame1.fits", "frame5.fits"]
+    with pytest.raises(ValueError):
+        query.todict()
+
+def test_todict(table):
+    """Queries without OR groups can be converted back into search keywords."""
+    query = Query.parse(["OBJECT=M31", "FILTER", "AIRMASS<1.2"])
+    search = query.todict()
+    assert search["OBJECT"] == "M31"
+    assert search["FILTER"] is True
+    assert _search(_table(), **search) == _query(table, query) == ["frame0.fits"]
+
+def test_match(table):
+    """Queries match single headers as they match whole tables."""
+    for text in (["OBJECT=M31"], ["EXPTIME>=30"], ["AIRMASS=False"], ["EXPTIME in [30, 900]", "OR", "FILTER=Jbb"]):
+        query = Query.parse(text)
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            assert _names(query.filter(table)) == _query(table, query)
+
+def test_missing(table):
+    """Missing keywords are reported in a single warning, and headers without them don't match."""
+    # Python 2 doesn't repeat warnings which were ignored before, even with the "always" filter.
+    getattr(fitsquery, "__warningregistry__", {}).clear()
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter("always")
+        result = table.query(Query.parse(["FILTER=Kbb", "NOTHERE=1"]))
+    assert len(result) == 0
+    messages = sorted(str(warning.message) for warning in caught)
+    assert messages == ["Couldn't find keyword 'FILTER' in 1 headers", "Couldn't find keyword 'NOTHERE' in 6 headers"]
+
+def test_predicate():
+    """Single predicates are callable with header values."""
+    assert Predicate.parse("EXPTIME>=30")(60)
+    assert not Predicate.parse("EXPTIME>=30")("60")
+    assert Predicate.parse("OBJECT=M31")("M31")
+    assert Predicate.parse("FILTER in [Kbb, Hbb]")("Hbb")
+    with pytest.raises(ValueError):
+        Predicate.parse("=30")
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+#
+#  test_fits_record.py
+#  pyobserver
+#
+#  Tests for compact and lazy FITS header records.
+#
+from __future__ import (absolute_import, unicode_literals, division,
+                        print_function)
+
+import os
+import pickle
+
+import numpy as np
+import pytest
+
+from astropy.io import fits
+
+from pyobserver.fits.record import HeaderRecord, LazyHeaderRecord
+from pyobserver.fits.scan import scan_header_strings
+from pyobserver.fits.core import FITSHeaderTable
+
+@pytest.fixture
+def filename(tmpdir):
+    """A FITS file with long string, HIERARCH and commentary cards, and an extension."""
+    primary = fits.PrimaryHDU(np.zeros((4, 4), dtype=np.float32))
+    primary.header['OBJECT'] = ('M31', 'Target name')
+    primary.header['EXPTIME'] = 30.0
+    primary.header['COADDS'] = 4
+    primary.header['DONE'] = True
+    primary.header['LONGSTR'] = "a long string value " * 8
+    primary.header['HIERARCH ESO DET DIT'] = 1.5
+    primary.header.add_history("A history card")
+    extension = fits.ImageHDU(np.zeros((2, 2), dtype=np.float32), name='SCI')
+    extension.header['OBJECT'] = 'M31 sky'
+    filename = str(tmpdir.join("frame.fits"))
+    fits.HDUList([primary, extension]).writeto(filename)
+    return filename
+
+def _header(filename, extension=0):
+    """The header of one HDU, read with astropy."""
+    header = fits.getheader(filename, extension)
+    header.filename = filename
+    return header
+
+def _records(filename):
+    """A record and a lazy record of the primary header."""
+    header = _header(filename)
+    return [ HeaderRecord.fromheader(header), LazyHeaderRecord(scan_header_strings(filename)[0], filename, 0) ]
+
+def _values(header):
+    """The keyword values of a header, without commentary cards."""
+    return [ (card.keyword, card.value) for card in header.cards if card.keyword not in ("", "COMMENT", "HISTORY") ]
+
+@pytest.mark.parametrize("kind", [0, 1])
+def test_values(filename, kind):
+    """Records hold the same values as the header."""
+    header = _header(filename)
+    record = _records(filename)[kind]
+    for keyword, value in _values(header):
+        assert keyword in record
+        assert record[keyword] == value
+        assert type(record[keyword]) == type(value)
+    assert record.keys() == [ keyword for keyword, value in _values(header) ] + ["FILENAME", "OPENNAME"]
+    assert record["object"] == "M31"
+    assert record["ESO DET DIT"] == 1.5
+    assert record["FILENAME"] == "frame.fits"
+    assert record["OPENNAME"] == os.path.relpath(filename)
+    assert "HISTORY" not in record
+    assert "NOTHERE" not in record
+    assert record.get("NOTHERE", 1) == 1
+    with pytest.raises(KeyError):
+        record["NOTHERE"]
+    assert len(record) == len(record.keys()) == len(record.values()) == len(record.items())
+
+@pytest.mark.parametrize("kind", [0, 1])
+def test_set(filename, kind):
+    """Records can be changed, and copies are independent."""
+    record = _records(filename)[kind]
+    copy = record.copy()
+    record["OBJECT"] = ("M33", "A comment")
+    record["NEWKEY"] = 5
+    assert record["OBJECT"] == "M33"
+    assert record["NEWKEY"] == 5
+    assert copy["OBJECT"] == "M31"
+    assert "NEWKEY" not in copy
+    assert "NEWKEY" in record.keys()
+    assert record.keys()[-2:] == ["FILENAME", "OPENNAME"]
+
+@pytest.mark.parametrize("kind", [0, 1])
+def test_toheader(filename, kind):
+    """Records are promoted to full headers, with their changes applied."""
+    record = _records(filename)[kind]
+    record["OBJECT"] = "M33"
+    header = record.toheader()
+    assert isinstance(header, fits.Header)
+    assert header["OBJECT"] == "M33"
+    assert header.comments["EXPTIME"] == _header(filename).comments["EXPTIME"]
+    assert list(header["HISTORY"]) == ["A history card"]
+    assert header["FILENAME"] == "frame.fits"
+    assert header.filename == filename
+
+def test_toheader_extension(filename):
+    """Records of extensions are promoted from the right HDU."""
+    record = HeaderRecord.fromheader(_header(filename, 1), extension=1)
+    assert record.toheader()["OBJECT"] == "M31 sky"
+    assert record.toheader()["EXTNAME"] == "SCI"
+
+@pytest.mark.parametrize("kind", [0, 1])
+def test_pickle(filename, kind):
+    """Records survive a round trip through pickle, as they do when headers are read by a process pool."""
+    record = _records(filename)[kind]
+    record["NEWKEY"] = 5
+    copy = pickle.loads(pickle.dumps(record))
+    assert type(copy) == type(record)
+    assert copy.items() == record.items()
+    assert copy.filename == filename
+
+def test_shared_layout(filename):
+    """Records with the same keywords share their layout."""
+    first, second = HeaderRecord.fromheader(_header(filename)), HeaderRecord.fromheader(_header(filename))
+    assert first._layout is second._layout
+
+def test_shared_limits(monkeypatch):
+    """Only a limited number of keywords and layouts are shared, and records which used forgotten ones still work."""
+    from pyobserver.fits import record
+    monkeypatch.setattr(record, "MAX_KEYWORDS", 8)
+    monkeypatch.setattr(record, "MAX_LAYOUTS", 4)
+    records = [ HeaderRecord([("KEY{:d}".format(i), i), ("OBJECT", "M31")]) for i in range(20) ]
+    assert len(record._KEYWORDS) <= 8
+    assert len(record._LAYOUTS) <= 4
+    assert [ r["KEY{:d}".format(i)] for i, r in enumerate(records) ] == list(range(20))
+    assert HeaderRecord([("KEY19", 0), ("OBJECT", "M33")])._layout is records[-1]._layout
+    assert HeaderRecord([("KEY0", 0), ("OBJECT", "M33")])._layout is not records[0]._layout
+
+def test_extended_layout():
+    """Records which gain the same keywords in the same order share their extended layouts."""
+    first, second = HeaderRecord([("OBJECT", "M31")]), HeaderRecord([("OBJECT", "M33")])
+    for i in range(200):
+        first["KEY{:d}".format(i)] = i
+        second["KEY{:d}".format(i)] = -i
+    assert first._layout is second._layout
+    assert first["KEY150"] == 150 and second["KEY150"] == -150
+    assert first.keys()[:3] == ["OBJECT", "KEY0", "KEY1"]
+
+def test_extended_layout_limit():
+    """Layouts only remember a few extensions, but records can always gain keywords."""
+    from pyobserver.fits import record
+    records = [ HeaderRecord([("LIMITS", "M31")]) for i in range(record.MAX_EXTENSIONS + 4) ]
+    for i, r in enumerate(records):
+        r["NEW{:d}".format(i)] = i
+    assert len(HeaderRecord([("LIMITS", "M31")])._layout.extensions) == record.MAX_EXTENSIONS
+    assert [ r.keys() for r in records ] == [ ["LIMITS", "NEW{:d}".format(i)] for i in range(len(records)) ]
+
+def test_lazy(filename):
+    """Lazy records only parse the cards which are used."""
+    record = _records(filename)[1]
+    assert record._layout.keys == ()
+    assert record["EXPTIME"] == 30.0
+    assert record._layout.keys == ("EXPTIME",)
+    assert "OBJECT" in record
+    assert record._layout.keys == ("EXPTIME",)
+    assert record["LONGSTR"] == _header(filename)["LONGSTR"]
+
+def test_lazy_project(filename):
+    """Lazy records can be projected onto a few keywords."""
+    record = _records(filename)[1].project(["OBJECT", "COADDS"])
+    assert record.keys() == ["OBJECT", "COADDS", "FILENAME", "OPENNAME"]
+    assert record["COADDS"] == 4
+
+@pytest.mark.parametrize("lazy", [False, True])
+def test_read(filename, lazy):
+    """Tables hold records by default, one per HDU."""
+    table = FITSHeaderTable.fromfiles([filename], lazy=lazy, backend='scan')
+    assert [ type(header) for header in table ] == [LazyHeaderRecord if lazy else HeaderRecord] * 2
+    assert [ header.extension for header in table ] == [0, 1]
+    assert [ header["OBJECT"] for header in table ] == ["M31", "M31 sky"]
+    assert [ header["OBJECT"] for header in table.promoted() ] == ["M31", "M31 sky"]
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+#
+#  test_fits_scan.py
+#  pyobserver
+#
+#  Tests for the block-level FITS header scanner.
+#
+from __future__ import (absolute_import, unicode_literals, division,
+                        print_function)
+
+import numpy as np
+import pytest
+
+from astropy.io import fits
+
+from pyobserver.fits.scan import scan_headers, scan_header_strings, iter_extents, project_header_string, padded, _mapfile
+from pyobserver.fits.core import silent_getheaders, silent_scanheaders
+
+def _astropy(filename):
+    """The header of each HDU, read with astropy."""
+    with fits.open(filename) as HDUs:
+        return [ hdu.header.copy() for hdu in HDUs ]
+
+@pytest.fixture
+def filename(tmpdir):
+    """A FITS file with an image, an empty extension, an image extension with a long header, and a binary table."""
+    primary = fits.PrimaryHDU(np.arange(30, dtype=np.int16).reshape(5, 6))
+    primary.header['OBJECT'] = ('M31', 'Target name')
+    primary.header['EXPTIME'] = 30.0
+    primary.header['HIERARCH ESO DET DIT'] = 1.5
+    primary.header['LONGSTR'] = "a long string value " * 8
+    primary.header.add_history("A history card")
+    primary.header.add_comment("A comment card")
+    empty = fits.ImageHDU(name='EMPTY')
+    image = fits.ImageHDU(np.ones((7, 11), dtype=np.float64), name='SCI')
+    for i in range(100):
+        image.header['KEY{:05d}'.format(i)] = i
+    table = fits.BinTableHDU.from_columns([
+        fits.Column(name='a', format='J', array=np.arange(13)),
+        fits.Column(name='b', format='PE()', array=[ np.ones(n, dtype=np.float32) for n in range(13) ]),
+    ], name='TABLE')
+    filename = str(tmpdir.join("scan.fits"))
+    fits.HDUList([primary, empty, image, table]).writeto(filename)
+    return filename
+
+def test_headers(filename):
+    """Scanned headers match astropy, card for card."""
+    expected = _astropy(filename)
+    headers = scan_headers(filename)
+    assert len(headers) == len(expected)
+    for (header, name), reference in zip(headers, expected):
+        assert name == filename
+        assert header.filename == filename
+        assert header.tostring() == reference.tostring()
+
+def test_values(filename):
+    """Values, comments, HIERARCH and CONTINUE cards are parsed as astropy parses them."""
+    header, _ = scan_headers(filename)[0]
+    reference = _astropy(filename)[0]
+    for keyword in ('OBJECT', 'EXPTIME', 'ESO DET DIT', 'LONGSTR'):
+        assert header[keyword] == reference[keyword]
+    assert header.comments['OBJECT'] == 'Target name'
+    assert list(header['HISTORY']) == list(reference['HISTORY'])
+
+def test_extents(filename):
+    """HDU offsets match astropy."""
+    buf = _mapfile(filename)
+    try:
+        extents = list(iter_extents(buf))
+    finally:
+        buf.close()
+    with fits.open(filename) as HDUs:
+        info = [ hdu.fileinfo() for hdu in HDUs ]
+    assert [ extent.header for extent in extents ] == [ item['hdrLoc'] for item in info ]
+    assert [ extent.data for extent in extents ] == [ item['datLoc'] for item in info ]
+    assert [ padded(extent.size) for extent in extents ] == [ item['datSpan'] for item in info ]
+    assert extents[0].size == 5 * 6 * 2
+
+def test_hdus(filename):
+    """Scanning stops after the requested number of headers."""
+    headers = scan_headers(filename, hdus=2)
+    assert len(headers) == 2
+    assert headers[1][0]['EXTNAME'] == 'EMPTY'
+
+def test_keywords(filename):
+    """Only the requested cards are kept."""
+    headers = scan_headers(filename, keywords=['OBJECT', 'EXTNAME', 'LONGSTR'])
+    assert list(headers[0][0].keys()) == ['OBJECT', 'LONGSTR']
+    assert headers[0][0]['LONGSTR'] == _astropy(filename)[0]['LONGSTR']
+    assert [ list(header.keys()) for header, _ in headers[1:] ] == [['EXTNAME']] * 3
+
+def test_hierarch_keywords(filename):
+    """HIERARCH cards are kept when a long keyword is requested."""
+    header, _ = scan_headers(filename, keywords=['ESO DET DIT'])[0]
+    assert header['ESO DET DIT'] == 1.5
+
+def test_project_header_string(filename):
+    """Raw headers can be projected after they are read."""
+    raw = scan_header_strings(filename)[0]
+    projected = fits.Header.fromstring(project_header_string(raw, ['EXPTIME']))
+    assert list(projected.items()) == [('EXPTIME', 30.0)]
+
+def test_backend(filename):
+    """The scan backend returns the same headers as the astropy backend."""
+    expected = silent_getheaders(filename)
+    for (header, name), (reference, _) in zip(silent_scanheaders(filename), expected):
+        assert header.tostring() == reference.tostring()
+
+def test_not_fits(tmpdir):
+    """Files which aren't FITS files raise ValueError."""
+    filename = str(tmpdir.join("text.fits"))
+    with open(filename, 'w') as stream:
+        stream.write("Not a FITS file\n" * 400)
+    with pytest.raises(ValueError):
+        scan_headers(filename)
+
+def test_truncated(tmpdir, filename):
+    """Headers without an END card raise ValueError."""
+    with open(filename, 'rb') as stream:
+        data = stream.read(2880)
+    truncated = str(tmpdir.join("truncated.fits"))
+    with open(truncated, 'wb') as stream:
+        stream.write(data.replace(b"END     ", b"NOTEND  "))
+    with pytest.raises(ValueError):
+        scan_headers(truncated)
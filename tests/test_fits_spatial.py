@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+#
+#  test_fits_spatial.py
+#  pyobserver
+#
+#  Tests for the sky position index, clustering and crossmatching.
+#
+from __future__ import (absolute_import, unicode_literals, division,
+                        print_function)
+
+import numpy as np
+import pytest
+import astropy.units as u
+
+from pyobserver.fits import spatial
+from pyobserver.fits.spatial import SkyIndex, friends_of_friends, crossmatch, unit_vectors, angular_separation
+
+def _separations(ra, dec, other_ra, other_dec):
+    """Every separation between two catalogs, in degrees."""
+    vectors, others = unit_vectors(ra, dec), unit_vectors(other_ra, other_dec)
+    return np.degrees(np.array([ angular_separation(others, vector) for vector in vectors ]).reshape(len(vectors), len(others)))
+
+def _clusters(ra, dec, linking_length):
+    """Friends-of-friends clusters by brute force, numbered in order of their first position."""
+    linked = _separations(ra, dec, ra, dec) <= linking_length.to(u.deg).value
+    labels = -np.ones(len(ra), dtype=int)
+    count = 0
+    for start in range(len(ra)):
+        if labels[start] >= 0:
+            continue
+        labels[start] = count
+        stack = [start]
+        while stack:
+            row = stack.pop()
+            for other in np.flatnonzero(linked[row] & (labels < 0)):
+                labels[other] = count
+                stack.append(other)
+        count += 1
+    return labels
+
+@pytest.fixture
+def pointings():
+    """Dithered pointings around a few targets, including a chain of targets across RA = 0."""
+    random = np.random.RandomState(4)
+    ra = np.concatenate([[359.999, 0.0, 0.004], random.uniform(10.0, 10.05, 300), random.uniform(0, 360, 50)])
+    dec = np.concatenate([[0.0, 0.0, 0.0], random.uniform(-20.02, -19.98, 300), random.uniform(-80, 80, 50)])
+    return ra, dec
+
+def test_friends_of_friends(pointings):
+    """Clusters match a brute force search."""
+    ra, dec = pointings
+    for linking_length in (5 * u.arcsec, 20 * u.arcsec, 1 * u.arcmin):
+        assert (friends_of_friends(ra, dec, linking_length) == _clusters(ra, dec, linking_length)).all()
+
+def test_friends_of_friends_blocks(pointings, monkeypatch):
+    """Clusters don't depend on the block size."""
+    ra, dec = pointings
+    expected = friends_of_friends(ra, dec, 20 * u.arcsec)
+    monkeypatch.setattr(spatial, "BLOCK", 7)
+    assert (friends_of_friends(ra, dec, 20 * u.arcsec) == expected).all()
+
+def test_friends_of_friends_colocated():
+    """Many pointings at the same target are a single cluster."""
+    random = np.random.RandomState(5)
+    ra, dec = 150.0 + random.normal(0, 1 / 3600, 2000), 2.0 + random.normal(0, 1 / 3600, 2000)
+    assert not friends_of_friends(ra, dec, 20 * u.arcsec).any()
+
+def test_friends_of_friends_empty():
+    """Empty and single positions."""
+    assert len(friends_of_friends([], [], 1 * u.arcsec)) == 0
+    assert list(friends_of_friends([1.0], [1.0], 1 * u.arcsec)) == [0]
+
+def test_crossmatch(pointings, monkeypatch):
+    """Crossmatched pairs match a brute force search, sorted by the first row and separation."""
+    ra, dec = pointings
+    targets_ra, targets_dec = np.array([0.0, 10.02, 10.5, 200.0]), np.array([0.0, -20.0, -20.0, 10.0])
+    separations = _separations(targets_ra, targets_dec, ra, dec)
+    for block in (spatial.BLOCK, 2):
+        monkeypatch.setattr(spatial, "BLOCK", block)
+        first, second, found = crossmatch(targets_ra, targets_dec, ra, dec, 1 * u.arcmin)
+        expected = sorted(zip(*np.nonzero(separations <= 1 / 60)), key=lambda pair: (pair[0], separations[pair]))
+        assert list(zip(first, second)) == expected
+        assert np.allclose(found.to(u.deg).value, [ separations[pair] for pair in expected ])
+
+def test_sky_index():
+    """The nearest labelled position within a radius."""
+    index = SkyIndex(20 * u.arcsec)
+    index.add("M31", 10.6847, 41.2690)
+    index.add("M33", 23.4621, 30.6599)
+    assert index.nearest(10.6850, 41.2691, 20 * u.arcsec)[0] == "M31"
+    assert index.nearest(10.7, 41.3, 20 * u.arcsec) == (None, None)
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+#
+#  test_fits_stream.py
+#  pyobserver
+#
+#  Tests for streaming table output.
+#
+from __future__ import (absolute_import, unicode_literals, division,
+                        print_function)
+
+import argparse
+import io
+import json
+
+import pytest
+
+from astropy.io import fits
+
+from pyobserver.fits import cli
+from pyobserver.fits.core import iter_headers
+from pyobserver.fits.stream import NDJSONWriter, TSVWriter, FixedWidthWriter, write_rows
+
+from .helpers import write_fits
+
+NAMES = ["file", "OBJECT", "EXPTIME"]
+
+KEYS = ["OPENNAME", "OBJECT", "EXPTIME"]
+
+HEADERS = [
+    dict(OPENNAME="a.fits", OBJECT="M31", EXPTIME=30),
+    dict(OPENNAME="b.fits", EXPTIME=2.5),
+    dict(OPENNAME="c.fits", OBJECT="NGC\t598", FLAG=True),
+]
+
+def _write(writer, headers=HEADERS, keys=KEYS):
+    """Write rows for `headers` with `writer` into a text stream, and return the text."""
+    stream = io.StringIO()
+    rows = writer(stream)
+    assert write_rows(rows, headers, keys) == len(headers)
+    assert rows.rows == len(headers)
+    return stream.getvalue()
+
+def test_ndjson():
+    """Each row is a JSON object, and missing values are null."""
+    lines = _write(lambda stream : NDJSONWriter(stream, NAMES)).splitlines()
+    assert [ json.loads(line) for line in lines ] == [
+        {"file" : "a.fits", "OBJECT" : "M31", "EXPTIME" : 30},
+        {"file" : "b.fits", "OBJECT" : None, "EXPTIME" : 2.5},
+        {"file" : "c.fits", "OBJECT" : "NGC\t598", "EXPTIME" : None},
+    ]
+
+def test_tsv():
+    """Rows are tab separated after a line of names, missing values are empty, and tabs in values are replaced."""
+    assert _write(lambda stream : TSVWriter(stream, NAMES)) == (
+        "file\tOBJECT\tEXPTIME\n"
+        "a.fits\tM31\t30\n"
+        "b.fits\t\t2.5\n"
+        "c.fits\tNGC 598\t\n")
+    assert _write(lambda stream : TSVWriter(stream, NAMES, header=False)).splitlines()[0] == "a.fits\tM31\t30"
+
+def test_fixed_sampled():
+    """Column widths are sampled from the names and the rows."""
+    assert _write(lambda stream : FixedWidthWriter(stream, NAMES)) == (
+        "file   OBJECT  EXPTIME\n"
+        "a.fits M31     30\n"
+        "b.fits         2.5\n"
+        "c.fits NGC\t598\n")
+
+def test_fixed_widths():
+    """Given column widths are used as soon as rows arrive, and wider values and names are not truncated."""
+    stream = io.StringIO()
+    writer = FixedWidthWriter(stream, NAMES, widths=[3, 4, 2])
+    writer.write(["a.fits", None, 30])
+    assert stream.getvalue() == "file OBJECT EXPTIME\na.fits      30\n"
+    with pytest.raises(ValueError):
+        FixedWidthWriter(stream, NAMES, widths=[3])
+
+def test_fixed_holds_sample():
+    """Rows are held back until the widths are known."""
+    stream = io.StringIO()
+    writer = FixedWidthWriter(stream, ["n"], header=False)
+    writer.SAMPLE = 3
+    for i in range(2):
+        writer.write([i])
+    assert stream.getvalue() == ""
+    writer.write([100])
+    assert stream.getvalue() == "0\n1\n100\n"
+    assert writer.close() == 3
+
+def test_empty():
+    """Tables without rows still have a header line."""
+    assert _write(lambda stream : TSVWriter(stream, NAMES), headers=[]) == "file\tOBJECT\tEXPTIME\n"
+    assert _write(lambda stream : FixedWidthWriter(stream, NAMES), headers=[]) == "file OBJECT EXPTIME\n"
+    assert _write(lambda stream : NDJSONWriter(stream, NAMES), headers=[]) == ""
+
+def test_latency():
+    """The time to the first row is recorded."""
+    stream = io.StringIO()
+    writer = NDJSONWriter(stream, NAMES)
+    assert writer.latency is None
+    writer.write(["a.fits", "M31", 30])
+    assert writer.latency >= 0.0
+
+def test_binary():
+    """Text is encoded as UTF-8 for binary streams."""
+    stream = io.BytesIO()
+    TSVWriter(stream, ["OBJECT"], header=False).write(["α Cen"])
+    assert stream.getvalue() == "α Cen\n".encode("utf-8")
+
+def test_extensions(tmpdir):
+    """Extensions which are missing a keyword have empty values."""
+    primary = fits.PrimaryHDU()
+    primary.header["OBJECT"] = "M31"
+    extension = fits.ImageHDU(name="SCI")
+    extension.header["EXPTIME"] = 30
+    filename = str(tmpdir.join("mef.fits"))
+    fits.HDUList([primary, extension]).writeto(filename)
+    stream = io.StringIO()
+    write_rows(TSVWriter(stream, ["FILENAME", "OBJECT", "EXPTIME"], header=False), iter_headers([filename]), ["FILENAME", "OBJECT", "EXPTIME"])
+    assert stream.getvalue() == "mef.fits\tM31\t\nmef.fits\t\t30\n"
+
+@pytest.mark.parametrize("stream", ["ndjson", "tsv", "fixed"])
+def test_output_stream(tmpdir, capsys, stream):
+    """Only rows are written to standard output, and messages go to standard error."""
+    files = [ write_fits(tmpdir.join("{:s}.fits".format(name)), OBJECT=name) for name in ("a", "b") ]
+    command = cli.FITSList.__new__(cli.FITSList)
+    command.opts = argparse.Namespace(stream=stream, widths=None, log=True, output=False)
+    command.config = {}
+    command.output_stream(iter_headers(files), ["OBJECT"], less=False)
+    out, err = capsys.readouterr()
+    rows = out.splitlines()
+    if stream == "ndjson":
+        assert [ json.loads(row)["OBJECT"] for row in rows ] == ["a", "b"]
+    else:
+        assert len(rows) == 3 and rows[1].split()[1:] == ["a"]
+    assert "2 files found." in err
+    assert "First row after" in err
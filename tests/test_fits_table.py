@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+#
+#  test_fits_table.py
+#  pyobserver
+#
+#  Tests for building tables from FITS header collections.
+#
+from __future__ import (absolute_import, unicode_literals, division,
+                        print_function)
+
+import os
+
+import numpy as np
+import pytest
+
+from pyobserver.fits.core import FITSHeaderTable
+
+from .helpers import write_fits
+
+@pytest.fixture
+def files(tmpdir):
+    """A few FITS files, one of which is missing the OBJECT keyword."""
+    return [
+        write_fits(tmpdir.join("a.fits"), OBJECT="M31", RA=10.68, EXPTIME=30),
+        write_fits(tmpdir.join("b.fits"), OBJECT="M33", RA=23.46, EXPTIME=60),
+        write_fits(tmpdir.join("c.fits"), RA=83.82, EXPTIME=30),
+    ]
+
+def test_columns(files):
+    """Tables have a file column, and a column for each keyword."""
+    table = FITSHeaderTable.fromfiles(files).normalize(['OBJECT'], warn=False).table(['OBJECT', 'RA'])
+    assert table.colnames == ['file', 'OBJECT', 'RA']
+    assert len(table) == 3
+    assert [ os.path.abspath(name) for name in table['file'] ] == files
+    assert list(table['OBJECT'][:2]) == ['M31', 'M33']
+    assert np.allclose(table['RA'], [10.68, 23.46, 83.82])
+
+def test_types(files):
+    """Columns are typed by their values."""
+    table = FITSHeaderTable.fromfiles(files).table(['OBJECT', 'RA', 'EXPTIME'])
+    assert table['RA'].dtype.kind == 'f'
+    assert table['EXPTIME'].dtype.kind == 'i'
+    assert table['OBJECT'].dtype.kind in 'US'
+
+def test_missing(files):
+    """Missing keywords are masked."""
+    table = FITSHeaderTable.fromfiles(files).table(['OBJECT', 'RA'])
+    assert list(np.ma.getmaskarray(table['OBJECT'])) == [False, False, True]
+    assert not np.ma.getmaskarray(table['RA']).any()
+
+def test_all_missing(files):
+    """A keyword which no header has gives a fully masked string column."""
+    table = FITSHeaderTable.fromfiles(files).table(['NOTHING'])
+    assert table['NOTHING'].dtype.kind in 'US'
+    assert np.ma.getmaskarray(table['NOTHING']).all()
+
+@pytest.fixture
+def extended(tmpdir):
+    """Files with extensions, which don't have the primary header keywords."""
+    return [ write_fits(tmpdir.join("e{:d}.fits".format(i)), 2, OBJECT="M31", EXPTIME=30) for i in range(5) ]
+
+def test_report_some_hdus(extended):
+    """Keywords missing from only some HDUs are counted by header, with a few distinct example files."""
+    table = FITSHeaderTable.fromfiles(extended)
+    report = table.missing(['OBJECT', 'EXPTIME', 'NAXIS'])
+    assert list(report) == ['OBJECT', 'EXPTIME']
+    count, samples = report['OBJECT']
+    assert count == 10
+    assert [ os.path.basename(sample) for sample in samples ] == ["e0.fits", "e1.fits", "e2.fits"]
+    assert len(table.missing(['OBJECT'], samples=10)['OBJECT'][1]) == 5
+
+def test_report_every_file(files):
+    """Keywords which no header has are counted for every header, and keywords every header has are left out."""
+    report = FITSHeaderTable.fromfiles(files).missing(['NOTHING', 'OBJECT', 'RA'])
+    assert list(report) == ['NOTHING', 'OBJECT']
+    assert report['NOTHING'][0] == 3
+    assert [ os.path.abspath(sample) for sample in report['NOTHING'][1] ] == files
+    assert report['OBJECT'][0] == 1
+    assert FITSHeaderTable.fromfiles(files).missing(['RA']) == {}
+
+def test_normalize(files):
+    """Missing keywords are reported in one warning, or an error, and headers are not changed."""
+    table = FITSHeaderTable.fromfiles(files)
+    with pytest.warns(UserWarning) as caught:
+        assert table.normalize(['OBJECT', 'NOTHING']) is table
+    assert len(caught) == 1
+    assert "keyword 'OBJECT' in 1 headers" in str(caught[0].message)
+    assert "keyword 'NOTHING' in 3 headers" in str(caught[0].message)
+    assert "OBJECT" not in table[2]
+    with pytest.raises(KeyError):
+        table.normalize(['NOTHING'], error=True)